@@ -6,8 +6,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
+import itertools
+import multiprocessing
+import os
+import random
+import threading
+import time
+
 import ga4gh.datamodel as datamodel
 import ga4gh.exceptions as exceptions
+import ga4gh.npy as npy
 import ga4gh.protocol as protocol
 
 
@@ -50,6 +59,221 @@ def _parsePageToken(pageToken, numValues):
     return values
 
 
+def _getReadsRequestSortKey(request):
+    """
+    Returns the key by which SearchReadsRequests in a batch are ordered,
+    so that regions are read from each file in sequence.
+    """
+    return (
+        tuple(request.read_group_ids), request.reference_id,
+        request.start, request.end)
+
+
+def _getVariantsRequestSortKey(request):
+    """
+    Returns the key by which SearchVariantsRequests in a batch are
+    ordered, so that regions are read from each file in sequence.
+    """
+    return (
+        request.variant_set_id, request.reference_name,
+        request.start, request.end)
+
+
+def _encodeGenotypeMatrix(matrix):
+    """
+    Returns the specified GenotypeMatrix encoded as a NumPy .npz archive
+    holding the arrays call_set_ids (byte strings), start and end (one
+    int64 per variant), genotype (an int8 array of allele indexes of
+    shape variants x call sets x ploidy, with -1 for missing alleles,
+    widened to int16 if there are more than 127 alleles) and,
+    if the matrix has likelihoods, genotype_likelihood (a float32 array
+    of shape variants x call sets x likelihoods, with NaN for missing
+    values).
+    """
+    callSetIds = [
+        callSetId.encode("utf-8") for callSetId in matrix.getCallSetIds()]
+    numVariants = len(matrix.getStarts())
+    numCallSets = len(callSetIds)
+    genotypes = matrix.getGenotypes()
+    genotypeDtype = {"b": "<i1", "h": "<i2"}[genotypes.typecode]
+    arrays = [
+        ("call_set_ids",
+            "|S{}".format(max([len(id_) for id_ in callSetIds] or [1])),
+            (numCallSets,), callSetIds),
+        ("start", "<i8", (numVariants,), matrix.getStarts()),
+        ("end", "<i8", (numVariants,), matrix.getEnds()),
+        ("genotype", genotypeDtype,
+            (numVariants, numCallSets, matrix.getPloidy()), genotypes),
+    ]
+    if matrix.hasGenotypeLikelihoods():
+        arrays.append((
+            "genotype_likelihood", "<f4",
+            (numVariants, numCallSets, matrix.getNumLikelihoods()),
+            matrix.getGenotypeLikelihoods()))
+    return npy.encodeArchive(arrays)
+
+
+# The backend used by a conversion process; see Backend.setConversionProcesses
+_conversionBackend = None
+
+
+def _initialiseConversionProcess(backend, postFork):
+    global _conversionBackend
+    _conversionBackend = backend
+    if postFork is not None:
+        postFork()
+
+
+def _convertRecords(task):
+    """
+    Runs in a conversion process. Picks up the iteration of the specified
+    object generator of the backend from the page token of the specified
+    request, and returns the next numObjects objects serialised in the
+    specified mimetype.
+    """
+    generatorName, request, fieldMask, numObjects, mimetype = task
+    objectIterator = getattr(_conversionBackend, generatorName)(
+        request, fieldMask)
+    try:
+        return [
+            protocol.serialize(obj, mimetype) for obj, _ in
+            itertools.islice(objectIterator, numObjects)]
+    finally:
+        # Returns the file handle of the search to the file handle cache.
+        _closeIterator(objectIterator)
+
+
+def _closeIterator(iterator):
+    """
+    Closes the specified iterator if it is a generator (or otherwise has a
+    close method), running its cleanup code.
+    """
+    close = getattr(iterator, "close", None)
+    if close is not None:
+        close()
+
+
+class IntervalCursor(object):
+    """
+    The live state of a suspended IntervalIterator: the underlying search
+    iterator together with its lookahead records, and the anchor:skip
+    position that it corresponds to.
+    """
+    def __init__(
+            self, searchSignature, searchIterator, currentRecord,
+            nextRecord, searchAnchor, distanceFromAnchor):
+        self.searchSignature = searchSignature
+        self.searchIterator = searchIterator
+        self.currentRecord = currentRecord
+        self.nextRecord = nextRecord
+        self.searchAnchor = searchAnchor
+        self.distanceFromAnchor = distanceFromAnchor
+
+    def close(self):
+        """
+        Closes the search iterator, releasing the file handle that it
+        has checked out.
+        """
+        _closeIterator(self.searchIterator)
+
+
+class IntervalCursorCache(object):
+    """
+    A bounded registry of suspended IntervalCursors, keyed by an opaque
+    integer cursor ID. Cursors are evicted once they are older than the
+    time to live, or when the cache is full (oldest first). A cursor can
+    only be taken from the cache once; resuming from the same page token
+    again falls back to re-fetching from the anchor:skip position.
+    Evicted cursors are closed, so that the file handles they hold are
+    returned to the file handle cache.
+    """
+    def __init__(self, maxCacheSize=100, timeToLive=60):
+        self._lock = threading.Lock()
+        self._cursors = collections.OrderedDict()
+        self._random = random.SystemRandom()
+        self._maxCacheSize = maxCacheSize
+        self._timeToLive = timeToLive
+
+    def setMaxCacheSize(self, size):
+        """
+        Sets the maximum number of cursors held in the cache. A size of 0
+        disables the cache.
+        """
+        if size < 0:
+            raise ValueError(
+                "The size of the cursor cache must be a positive value")
+        self._maxCacheSize = size
+
+    def setTimeToLive(self, timeToLive):
+        """
+        Sets the number of seconds for which a suspended cursor is kept.
+        """
+        if timeToLive <= 0:
+            raise ValueError(
+                "The cursor time to live must be a strictly positive value")
+        self._timeToLive = timeToLive
+
+    def getNumCursors(self):
+        """
+        Returns the number of cursors currently held in the cache.
+        """
+        return len(self._cursors)
+
+    def _removeExpired(self, now):
+        """
+        Removes the cursors that have outlived the time to live, and
+        returns them. Cursors are stored in insertion order, so we stop at
+        the first live one.
+        """
+        expired = []
+        while len(self._cursors) > 0:
+            cursorId, (timestamp, cursor) = next(iter(self._cursors.items()))
+            if now - timestamp < self._timeToLive:
+                break
+            del self._cursors[cursorId]
+            expired.append(cursor)
+        return expired
+
+    def _closeCursors(self, cursors):
+        # Called outside the lock, as closing a cursor may close files.
+        for cursor in cursors:
+            cursor.close()
+
+    def add(self, cursor):
+        """
+        Stores the specified cursor and returns its cursor ID, or None
+        if the cache is disabled.
+        """
+        if self._maxCacheSize == 0:
+            return None
+        now = time.time()
+        with self._lock:
+            evicted = self._removeExpired(now)
+            cursorId = self._random.getrandbits(62)
+            while cursorId in self._cursors:
+                cursorId = self._random.getrandbits(62)
+            self._cursors[cursorId] = now, cursor
+            while len(self._cursors) > self._maxCacheSize:
+                evicted.append(self._cursors.popitem(last=False)[1][1])
+        self._closeCursors(evicted)
+        return cursorId
+
+    def take(self, cursorId):
+        """
+        Removes the cursor with the specified ID from the cache and
+        returns it. Returns None if there is no such cursor, or if it
+        has expired.
+        """
+        now = time.time()
+        with self._lock:
+            expired = self._removeExpired(now)
+            entry = self._cursors.pop(cursorId, None)
+        self._closeCursors(expired)
+        if entry is None:
+            return None
+        return entry[1]
+
+
 class IntervalIterator(object):
     """
     Implements generator logic for types which accept a start/end
@@ -57,13 +281,36 @@ class IntervalIterator(object):
     (object, pageToken) pairs. The pageToken is a string which allows
     us to pick up the iteration at any point, and is None for the last
     value in the iterator.
+
+    Internally, iteration is over (start, record) pairs returned by
+    _searchRecords, and records are only converted into the objects
+    returned (using _convertRecord) once they are actually returned.
+    Skipping forward to the position described by a page token
+    therefore does not pay the conversion cost of the skipped records.
+
+    If a cursorCache is provided, the iteration state can be stored in
+    it when a page is complete (see suspend), and page tokens then have
+    the form anchor:skip:cursorId. A later request using such a token
+    continues the stored iteration directly, falling back to the
+    anchor:skip position if the cursor is no longer available.
+
+    Records are converted with the specified FieldMask, so that only
+    the fields requested by the client are built.
     """
-    def __init__(self, request, parentContainer):
+    # Whether the records of a page can be converted in separate
+    # processes, which each pick up the iteration from a page token.
+    supportsParallelConversion = False
+
+    def __init__(
+            self, request, parentContainer, cursorCache=None,
+            fieldMask=protocol.ALL_FIELDS):
         self._request = request
         self._parentContainer = parentContainer
+        self._cursorCache = cursorCache
+        self._fieldMask = fieldMask
         self._searchIterator = None
-        self._currentObject = None
-        self._nextObject = None
+        self._currentRecord = None
+        self._nextRecord = None
         self._searchAnchor = None
         self._distanceFromAnchor = None
         if not request.page_token:
@@ -71,9 +318,17 @@ class IntervalIterator(object):
         else:
             # Set the search start point and the number of records to skip from
             # the page token.
-            searchAnchor, objectsToSkip = _parsePageToken(
-                request.page_token, 2)
-            self._pickUpIteration(searchAnchor, objectsToSkip)
+            if request.page_token.count(":") == 2:
+                searchAnchor, objectsToSkip, cursorId = _parsePageToken(
+                    request.page_token, 3)
+                resumed = self._resumeIteration(
+                    cursorId, searchAnchor, objectsToSkip)
+            else:
+                searchAnchor, objectsToSkip = _parsePageToken(
+                    request.page_token, 2)
+                resumed = False
+            if not resumed:
+                self._pickUpIteration(searchAnchor, objectsToSkip)
 
     def _extractProtocolObject(self, obj):
         """
@@ -81,22 +336,72 @@ class IntervalIterator(object):
         """
         return obj
 
+    def _searchRecords(self, start, end):
+        """
+        Returns an iterator over the (start, record) pairs in the specified
+        interval. By default, records are the objects returned by _search.
+        """
+        for obj in self._search(start, end):
+            yield self._getStart(obj), obj
+
+    def _convertRecord(self, record):
+        """
+        Returns the object corresponding to the specified record returned
+        by _searchRecords.
+        """
+        return record
+
+    def _getSearchSignature(self):
+        """
+        Returns a value identifying the search performed by this iterator,
+        so that a stored cursor is only ever resumed by the same search.
+        """
+        return (
+            type(self), self._parentContainer.getId(),
+            self._request.start, self._request.end)
+
     def _initialiseIteration(self):
         """
         Starts a new iteration.
         """
-        self._searchIterator = self._search(
+        self._searchIterator = self._searchRecords(
             self._request.start,
             self._request.end if self._request.end != 0 else None)
-        self._currentObject = next(self._searchIterator, None)
-        if self._currentObject is not None:
-            self._nextObject = next(self._searchIterator, None)
+        self._currentRecord = next(self._searchIterator, None)
+        if self._currentRecord is not None:
+            self._nextRecord = next(self._searchIterator, None)
             self._searchAnchor = self._request.start
             self._distanceFromAnchor = 0
-            firstObjectStart = self._getStart(self._currentObject)
+            firstObjectStart = self._currentRecord[0]
             if firstObjectStart > self._request.start:
                 self._searchAnchor = firstObjectStart
 
+    def _resumeIteration(self, cursorId, searchAnchor, objectsToSkip):
+        """
+        Attempts to continue the iteration stored in the cursor cache
+        under the specified cursorId. Returns True if the cursor was
+        found and corresponds to this search at the specified position,
+        and False otherwise.
+        """
+        if self._cursorCache is None:
+            return False
+        cursor = self._cursorCache.take(cursorId)
+        valid = (
+            cursor is not None and
+            cursor.searchSignature == self._getSearchSignature() and
+            cursor.searchAnchor == searchAnchor and
+            cursor.distanceFromAnchor == objectsToSkip)
+        if not valid:
+            if cursor is not None:
+                cursor.close()
+            return False
+        self._searchIterator = cursor.searchIterator
+        self._currentRecord = cursor.currentRecord
+        self._nextRecord = cursor.nextRecord
+        self._searchAnchor = cursor.searchAnchor
+        self._distanceFromAnchor = cursor.distanceFromAnchor
+        return True
+
     def _pickUpIteration(self, searchAnchor, objectsToSkip):
         """
         Picks up iteration from a previously provided page token. There are two
@@ -108,39 +413,45 @@ class IntervalIterator(object):
         """
         self._searchAnchor = searchAnchor
         self._distanceFromAnchor = objectsToSkip
-        self._searchIterator = self._search(
+        self._searchIterator = self._searchRecords(
             searchAnchor,
             self._request.end if self._request.end != 0 else None)
-        obj = next(self._searchIterator)
+        record = next(self._searchIterator)
         if searchAnchor == self._request.start:
             # This is the initial set of intervals, we just skip forward
             # objectsToSkip positions
             for _ in range(objectsToSkip):
-                obj = next(self._searchIterator)
+                record = next(self._searchIterator)
         else:
             # Now, we are past this initial set of intervals.
             # First, we need to skip forward over the intervals where
             # start < searchAnchor, as we've seen these already.
-            while self._getStart(obj) < searchAnchor:
-                obj = next(self._searchIterator)
+            while record[0] < searchAnchor:
+                record = next(self._searchIterator)
             # Now, we skip over objectsToSkip objects such that
             # start == searchAnchor
             for _ in range(objectsToSkip):
-                if self._getStart(obj) != searchAnchor:
+                if record[0] != searchAnchor:
                     raise exceptions.BadPageTokenException
-                obj = next(self._searchIterator)
-        self._currentObject = obj
-        self._nextObject = next(self._searchIterator, None)
+                record = next(self._searchIterator)
+        self._currentRecord = record
+        self._nextRecord = next(self._searchIterator, None)
 
-    def next(self):
+    def _getPageToken(self):
         """
-        Returns the next (object, nextPageToken) pair.
+        Returns the anchor:skip page token for the current record, or None
+        if the iteration is complete.
         """
-        if self._currentObject is None:
-            raise StopIteration()
-        nextPageToken = None
-        if self._nextObject is not None:
-            start = self._getStart(self._nextObject)
+        if self._currentRecord is None:
+            return None
+        return "{}:{}".format(self._searchAnchor, self._distanceFromAnchor)
+
+    def _advance(self):
+        """
+        Moves the iteration on to the next record.
+        """
+        if self._nextRecord is not None:
+            start = self._nextRecord[0]
             # If start > the search anchor, move the search anchor. Otherwise,
             # increment the distance from the anchor.
             if start > self._searchAnchor:
@@ -148,12 +459,70 @@ class IntervalIterator(object):
                 self._distanceFromAnchor = 0
             else:
                 self._distanceFromAnchor += 1
-            nextPageToken = "{}:{}".format(
-                self._searchAnchor, self._distanceFromAnchor)
-        ret = self._extractProtocolObject(self._currentObject), nextPageToken
-        self._currentObject = self._nextObject
-        self._nextObject = next(self._searchIterator, None)
-        return ret
+        self._currentRecord = self._nextRecord
+        self._nextRecord = next(self._searchIterator, None)
+
+    def skipRecords(self, maxRecords):
+        """
+        Moves the iteration forward over at most the specified number of
+        records without converting them, and returns the list of page
+        tokens from which iteration over each of these records can be
+        picked up.
+        """
+        pageTokens = []
+        while self._currentRecord is not None and (
+                len(pageTokens) < maxRecords):
+            pageTokens.append(self._getPageToken())
+            self._advance()
+        return pageTokens
+
+    def _readsAhead(self):
+        """
+        Returns True if records are read ahead of the iteration in a
+        separate thread (see datamodel.prefetch). Such iterations are not
+        stored as cursors, as the thread would go on reading while the
+        iteration is suspended.
+        """
+        return datamodel.PysamDatamodelMixin.prefetchSize > 0
+
+    def suspend(self):
+        """
+        Stores the state of this iteration in the cursor cache, so that
+        the next page can continue from where this one stopped. Returns
+        the page token for the next page, which is None if the iteration
+        is complete. If the iteration is not stored, the search iterator
+        is closed, so that its file handle is released straight away.
+        """
+        pageToken = self._getPageToken()
+        cursorId = None
+        if (pageToken is not None and self._cursorCache is not None and
+                not self._readsAhead()):
+            cursor = IntervalCursor(
+                self._getSearchSignature(), self._searchIterator,
+                self._currentRecord, self._nextRecord, self._searchAnchor,
+                self._distanceFromAnchor)
+            cursorId = self._cursorCache.add(cursor)
+        if cursorId is None:
+            self.close()
+            return pageToken
+        return "{}:{}".format(pageToken, cursorId)
+
+    def close(self):
+        """
+        Ends this iteration, closing the search iterator so that its file
+        handle is released straight away.
+        """
+        _closeIterator(self._searchIterator)
+
+    def next(self):
+        """
+        Returns the next (object, nextPageToken) pair.
+        """
+        if self._currentRecord is None:
+            raise StopIteration()
+        obj = self._convertRecord(self._currentRecord[1])
+        self._advance()
+        return self._extractProtocolObject(obj), self._getPageToken()
 
     def __iter__(self):
         return self
@@ -163,14 +532,31 @@ class ReadsIntervalIterator(IntervalIterator):
     """
     An interval iterator for reads
     """
-    def __init__(self, request, parentContainer, reference):
+    supportsParallelConversion = True
+
+    def __init__(
+            self, request, parentContainer, reference, cursorCache=None,
+            fieldMask=protocol.ALL_FIELDS):
         self._reference = reference
-        super(ReadsIntervalIterator, self).__init__(request, parentContainer)
+        super(ReadsIntervalIterator, self).__init__(
+            request, parentContainer, cursorCache, fieldMask)
+
+    def _getSearchSignature(self):
+        return super(ReadsIntervalIterator, self)._getSearchSignature() + (
+            self._reference.getId(),)
 
     def _search(self, start, end):
         return self._parentContainer.getReadAlignments(
             self._reference, start, end)
 
+    def _searchRecords(self, start, end):
+        return self._parentContainer.getReadAlignmentRecords(
+            self._reference, start, end)
+
+    def _convertRecord(self, record):
+        return self._parentContainer.convertReadAlignmentRecord(
+            record, self._fieldMask)
+
     @classmethod
     def _getStart(cls, readAlignment):
         if readAlignment.alignment.position.position == 0:
@@ -191,12 +577,26 @@ class VariantsIntervalIterator(IntervalIterator):
     """
     An interval iterator for variants
     """
+    supportsParallelConversion = True
+
+    def _getSearchSignature(self):
+        return super(VariantsIntervalIterator, self)._getSearchSignature() + (
+            self._request.reference_name, tuple(self._request.call_set_ids))
 
     def _search(self, start, end):
         return self._parentContainer.getVariants(
             self._request.reference_name, start, end,
             self._request.call_set_ids)
 
+    def _searchRecords(self, start, end):
+        return self._parentContainer.getVariantRecords(
+            self._request.reference_name, start, end,
+            self._request.call_set_ids)
+
+    def _convertRecord(self, record):
+        return self._parentContainer.convertVariantRecord(
+            record, self._request.call_set_ids, self._fieldMask)
+
     @classmethod
     def _getStart(cls, variant):
         return variant.start
@@ -211,19 +611,42 @@ class VariantAnnotationsIntervalIterator(IntervalIterator):
     An interval iterator for annotations
     """
 
-    def __init__(self, request, parentContainer):
+    def __init__(
+            self, request, parentContainer, cursorCache=None,
+            fieldMask=protocol.ALL_FIELDS):
         super(VariantAnnotationsIntervalIterator, self).__init__(
-            request, parentContainer)
+            request, parentContainer, cursorCache, fieldMask)
         # TODO do input validation somewhere more sensible
         if self._request.effects is None:
             self._effects = []
         else:
             self._effects = self._request.effects
+        # Filtering by effect needs the transcript effects, which are
+        # only removed once the annotation has been filtered.
+        self._conversionFieldMask = fieldMask
+        if len(self._effects) > 0:
+            self._conversionFieldMask = fieldMask.union(
+                ["transcript_effects"])
+
+    def _getSearchSignature(self):
+        signature = super(
+            VariantAnnotationsIntervalIterator, self)._getSearchSignature()
+        return signature + (
+            self._request.reference_name,
+            tuple(effect.id for effect in self._request.effects))
 
     def _search(self, start, end):
         return self._parentContainer.getVariantAnnotations(
             self._request.reference_name, start, end)
 
+    def _searchRecords(self, start, end):
+        return self._parentContainer.getVariantAnnotationRecords(
+            self._request.reference_name, start, end)
+
+    def _convertRecord(self, record):
+        return self._parentContainer.convertVariantAnnotationRecord(
+            record, self._conversionFieldMask)
+
     def _extractProtocolObject(self, pair):
         variant, annotation = pair
         return annotation
@@ -243,7 +666,8 @@ class VariantAnnotationsIntervalIterator(IntervalIterator):
             ret = super(VariantAnnotationsIntervalIterator, self).next()
             vann = ret[0]
             if self.filterVariantAnnotation(vann):
-                return self._removeNonMatchingTranscriptEffects(vann), ret[1]
+                vann = self._removeNonMatchingTranscriptEffects(vann)
+                return self._fieldMask.apply(vann), ret[1]
         return None
 
     def filterVariantAnnotation(self, vann):
@@ -308,12 +732,23 @@ class Backend(object):
     Backend for handling the server requests.
     This class provides methods for all of the GA4GH protocol end points.
     """
+    # The number of records converted by each conversion process at a time
+    _conversionBatchSize = 64
+
     def __init__(self, dataRepository):
         self._requestValidation = False
         self._responseValidation = False
         self._defaultPageSize = 100
         self._maxResponseLength = 2**20  # 1 MiB
+        self._maxBatchSearchRequests = 100
+        self._maxGenotypeMatrixCells = 1024 * 1024
         self._dataRepository = dataRepository
+        self._intervalCursorCache = IntervalCursorCache()
+        self._streamSearchResponses = False
+        self._conversionProcesses = 0
+        self._conversionPostFork = None
+        self._conversionPool = None
+        self._conversionPoolPid = None
 
     def getDataRepository(self):
         """
@@ -346,6 +781,84 @@ class Backend(object):
         """
         self._maxResponseLength = maxResponseLength
 
+    def setMaxBatchSearchRequests(self, maxBatchSearchRequests):
+        """
+        Sets the maximum number of requests in a batch search.
+        """
+        self._maxBatchSearchRequests = maxBatchSearchRequests
+
+    def setMaxGenotypeMatrixCells(self, maxGenotypeMatrixCells):
+        """
+        Sets the maximum number of variants x call sets in a genotype
+        matrix.
+        """
+        self._maxGenotypeMatrixCells = maxGenotypeMatrixCells
+
+    def setStreamSearchResponses(self, streamSearchResponses):
+        """
+        Sets whether search requests return an iterator over the pieces
+        of the serialised response rather than a single string, so that
+        they can be sent as a chunked HTTP response.
+        """
+        self._streamSearchResponses = streamSearchResponses
+
+    def setIntervalCursorCacheMaxSize(self, maxCacheSize):
+        """
+        Sets the maximum number of suspended interval search cursors
+        retained between pages. A value of 0 disables cursor caching.
+        """
+        self._intervalCursorCache.setMaxCacheSize(maxCacheSize)
+
+    def setIntervalCursorTimeToLive(self, timeToLive):
+        """
+        Sets the number of seconds for which a suspended interval search
+        cursor is retained.
+        """
+        self._intervalCursorCache.setTimeToLive(timeToLive)
+
+    def setConversionProcesses(self, numProcesses, postFork=None):
+        """
+        Sets the number of processes used to convert the reads and
+        variants of each page, or 0 to convert them in the thread
+        handling the request. The processes are forked by
+        startConversionPool, and call postFork (if it is not None) on
+        startup.
+        """
+        if numProcesses < 0:
+            raise ValueError(
+                "The number of conversion processes must be positive")
+        self._conversionProcesses = numProcesses
+        self._conversionPostFork = postFork
+
+    def startConversionPool(self):
+        """
+        Starts the pool of conversion processes, if there are any. This
+        must be called before the threads handling requests are started,
+        as forking from a process with several threads can copy locks
+        that are held, and again in each process forked after that, which
+        cannot use its parent's pool.
+        """
+        self.stopConversionPool()
+        # A pool inherited from the parent process is dropped.
+        self._conversionPool = None
+        self._conversionPoolPid = None
+        if self._conversionProcesses > 0:
+            self._conversionPool = multiprocessing.Pool(
+                self._conversionProcesses, _initialiseConversionProcess,
+                (self, self._conversionPostFork))
+            self._conversionPoolPid = os.getpid()
+
+    def stopConversionPool(self):
+        """
+        Stops the pool of conversion processes started in this process,
+        if there is one.
+        """
+        if self._conversionPoolPid == os.getpid():
+            self._conversionPool.close()
+            self._conversionPool.join()
+            self._conversionPool = None
+            self._conversionPoolPid = None
+
     def startProfile(self):
         """
         Profiling hook. Called at the start of the runSearchRequest method
@@ -384,27 +897,9 @@ class Backend(object):
         returned by call to the specified method, which must take a single
         integer as an argument. The returned generator yields a sequence of
         (object, nextPageToken) pairs, which allows this iteration to be picked
-        up at any point.
-        """
-        currentIndex = 0
-        if request.page_token:
-            currentIndex, = _parsePageToken(request.page_token, 1)
-        while currentIndex < numObjects:
-            object_ = getByIndexMethod(currentIndex)
-            currentIndex += 1
-            nextPageToken = None
-            if currentIndex < numObjects:
-                nextPageToken = str(currentIndex)
-            yield object_.toProtocolElement(), nextPageToken
-
-    def _protocolObjectGenerator(self, request, numObjects, getByIndexMethod):
-        """
-        Returns a generator over the results for the specified request, from
-        a set of protocol objects of the specified size. The objects are
-        returned by call to the specified method, which must take a single
-        integer as an argument. The returned generator yields a sequence of
-        (object, nextPageToken) pairs, which allows this iteration to be picked
-        up at any point.
+        up at any point. The objects are either datamodel objects, whose
+        serialised protocol elements are added to the response, or protocol
+        objects.
         """
         currentIndex = 0
         if request.page_token:
@@ -417,14 +912,6 @@ class Backend(object):
                 nextPageToken = str(currentIndex)
             yield object_, nextPageToken
 
-    def _protocolListGenerator(self, request, objectList):
-        """
-        Returns a generator over the objects in the specified list using
-        _protocolObjectGenerator to generate page tokens.
-        """
-        return self._protocolObjectGenerator(
-            request, len(objectList), lambda index: objectList[index])
-
     def _objectListGenerator(self, request, objectList):
         """
         Returns a generator over the objects in the specified list using
@@ -438,7 +925,7 @@ class Backend(object):
         Returns a generator suitable for a search method in which the
         result set is a single object.
         """
-        yield (datamodelObject.toProtocolElement(), None)
+        yield (datamodelObject, None)
 
     def _noObjectGenerator(self):
         """
@@ -453,33 +940,17 @@ class Backend(object):
         """
         return self._topLevelObjectGenerator(
             request, self.getDataRepository().getNumDatasets(),
-            self.getDataRepository().getDatasetByIndex)
+            self.getDataRepository().getDatasetSummaryByIndex)
 
     def bioSamplesGenerator(self, request):
         dataset = self.getDataRepository().getDataset(request.dataset_id)
-        results = []
-        for obj in dataset.getBioSamples():
-            include = True
-            if request.name:
-                if request.name != obj.getLocalId():
-                    include = False
-            if request.individual_id:
-                if request.individual_id != obj.getIndividualId():
-                    include = False
-            if include:
-                results.append(obj)
+        results = dataset.searchBioSamples(
+            request.name, request.individual_id)
         return self._objectListGenerator(request, results)
 
     def individualsGenerator(self, request):
         dataset = self.getDataRepository().getDataset(request.dataset_id)
-        results = []
-        for obj in dataset.getIndividuals():
-            include = True
-            if request.name:
-                if request.name != obj.getLocalId():
-                    include = False
-            if include:
-                results.append(obj)
+        results = dataset.searchIndividuals(request.name)
         return self._objectListGenerator(request, results)
 
     def readGroupSetsGenerator(self, request):
@@ -488,49 +959,28 @@ class Backend(object):
         defined by the specified request.
         """
         dataset = self.getDataRepository().getDataset(request.dataset_id)
+        readGroupSets = dataset.searchReadGroupSets(
+            request.name, request.bio_sample_id)
+        if not request.bio_sample_id:
+            return self._objectListGenerator(request, readGroupSets)
+        # Only the read groups for the requested biosample are returned
         results = []
-        for obj in dataset.getReadGroupSets():
-            include = True
-            rgsp = obj.toProtocolElement()
-            if request.name:
-                if request.name != obj.getLocalId():
-                    include = False
-            if request.bio_sample_id:
-                rgsp.ClearField("read_groups")
-                for readGroup in obj.getReadGroups():
-                    if request.bio_sample_id == readGroup.getBioSampleId():
-                        rgsp.read_groups.extend(
-                            [readGroup.toProtocolElement()])
-                # If none of the biosamples match and the readgroupset
-                # contains reagroups, don't include in the response
-                if len(rgsp.read_groups) == 0 and \
-                        len(obj.getReadGroups()) != 0:
-                    include = False
-                else:
-                    include = True and include
-            if include:
-                results.append(rgsp)
-        return self._protocolListGenerator(request, results)
+        for readGroupSet in readGroupSets:
+            rgsp = readGroupSet.toProtocolElement()
+            rgsp.ClearField("read_groups")
+            for readGroup in readGroupSet.getReadGroups():
+                if request.bio_sample_id == readGroup.getBioSampleId():
+                    rgsp.read_groups.extend([readGroup.toProtocolElement()])
+            results.append(rgsp)
+        return self._objectListGenerator(request, results)
 
     def referenceSetsGenerator(self, request):
         """
         Returns a generator over the (referenceSet, nextPageToken) pairs
         defined by the specified request.
         """
-        results = []
-        for obj in self.getDataRepository().getReferenceSets():
-            include = True
-            if request.md5checksum:
-                if request.md5checksum != obj.getMd5Checksum():
-                    include = False
-            if request.accession:
-                if request.accession not in obj.getSourceAccessions():
-                    include = False
-            if request.assembly_id:
-                if request.assembly_id != obj.getAssemblyId():
-                    include = False
-            if include:
-                results.append(obj)
+        results = self.getDataRepository().searchReferenceSets(
+            request.md5checksum, request.accession, request.assembly_id)
         return self._objectListGenerator(request, results)
 
     def referencesGenerator(self, request):
@@ -540,17 +990,8 @@ class Backend(object):
         """
         referenceSet = self.getDataRepository().getReferenceSet(
             request.reference_set_id)
-        results = []
-        for obj in referenceSet.getReferences():
-            include = True
-            if request.md5checksum:
-                if request.md5checksum != obj.getMd5Checksum():
-                    include = False
-            if request.accession:
-                if request.accession not in obj.getSourceAccessions():
-                    include = False
-            if include:
-                results.append(obj)
+        results = referenceSet.searchReferences(
+            request.md5checksum, request.accession)
         return self._objectListGenerator(request, results)
 
     def variantSetsGenerator(self, request):
@@ -576,10 +1017,11 @@ class Backend(object):
             request, variantSet.getNumVariantAnnotationSets(),
             variantSet.getVariantAnnotationSetByIndex)
 
-    def readsGenerator(self, request):
+    def readsGenerator(self, request, fieldMask=protocol.ALL_FIELDS):
         """
         Returns a generator over the (read, nextPageToken) pairs defined
-        by the specified request
+        by the specified request, with the fields in the specified
+        FieldMask.
         """
         if not request.reference_id:
             raise exceptions.UnmappedReadsNotSupported()
@@ -587,11 +1029,11 @@ class Backend(object):
             raise exceptions.BadRequestException(
                 "At least one readGroupId must be specified")
         elif len(request.read_group_ids) == 1:
-            return self._readsGeneratorSingle(request)
+            return self._readsGeneratorSingle(request, fieldMask)
         else:
-            return self._readsGeneratorMultiple(request)
+            return self._readsGeneratorMultiple(request, fieldMask)
 
-    def _readsGeneratorSingle(self, request):
+    def _readsGeneratorSingle(self, request, fieldMask):
         compoundId = datamodel.ReadGroupCompoundId.parse(
             request.read_group_ids[0])
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
@@ -603,10 +1045,11 @@ class Backend(object):
         reference = referenceSet.getReference(request.reference_id)
         readGroup = readGroupSet.getReadGroup(compoundId.read_group_id)
         intervalIterator = ReadsIntervalIterator(
-            request, readGroup, reference)
+            request, readGroup, reference, self._intervalCursorCache,
+            fieldMask)
         return intervalIterator
 
-    def _readsGeneratorMultiple(self, request):
+    def _readsGeneratorMultiple(self, request, fieldMask):
         compoundId = datamodel.ReadGroupCompoundId.parse(
             request.read_group_ids[0])
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
@@ -622,25 +1065,30 @@ class Backend(object):
                 "If multiple readGroupIds are specified, "
                 "they must be all of the readGroupIds in a ReadGroup")
         intervalIterator = ReadsIntervalIterator(
-            request, readGroupSet, reference)
+            request, readGroupSet, reference, self._intervalCursorCache,
+            fieldMask)
         return intervalIterator
 
-    def variantsGenerator(self, request):
+    def variantsGenerator(self, request, fieldMask=protocol.ALL_FIELDS):
         """
         Returns a generator over the (variant, nextPageToken) pairs defined
-        by the specified request.
+        by the specified request, with the fields in the specified
+        FieldMask.
         """
         compoundId = datamodel.VariantSetCompoundId \
             .parse(request.variant_set_id)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         variantSet = dataset.getVariantSet(compoundId.variant_set_id)
-        intervalIterator = VariantsIntervalIterator(request, variantSet)
+        intervalIterator = VariantsIntervalIterator(
+            request, variantSet, self._intervalCursorCache, fieldMask)
         return intervalIterator
 
-    def variantAnnotationsGenerator(self, request):
+    def variantAnnotationsGenerator(
+            self, request, fieldMask=protocol.ALL_FIELDS):
         """
         Returns a generator over the (variantAnnotaitons, nextPageToken) pairs
-        defined by the specified request.
+        defined by the specified request, with the fields in the specified
+        FieldMask.
         """
         compoundId = datamodel.VariantAnnotationSetCompoundId.parse(
             request.variant_annotation_set_id)
@@ -649,13 +1097,15 @@ class Backend(object):
         variantAnnotationSet = variantSet.getVariantAnnotationSet(
             request.variant_annotation_set_id)
         intervalIterator = VariantAnnotationsIntervalIterator(
-            request, variantAnnotationSet)
+            request, variantAnnotationSet, self._intervalCursorCache,
+            fieldMask)
         return intervalIterator
 
-    def featuresGenerator(self, request):
+    def featuresGenerator(self, request, fieldMask=protocol.ALL_FIELDS):
         """
         Returns a generator over the (features, nextPageToken) pairs
-        defined by the (JSON string) request.
+        defined by the (JSON string) request, with the fields in the
+        specified FieldMask.
         """
         compoundId = None
         parentId = None
@@ -696,7 +1146,8 @@ class Backend(object):
         return featureSet.getFeatures(
             request.reference_name, start, end,
             request.page_token, request.page_size,
-            request.feature_types, parentId, request.name, request.gene_symbol)
+            request.feature_types, parentId, request.name, request.gene_symbol,
+            fieldMask=fieldMask)
 
     def callSetsGenerator(self, request):
         """
@@ -707,17 +1158,8 @@ class Backend(object):
             request.variant_set_id)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         variantSet = dataset.getVariantSet(compoundId.variant_set_id)
-        results = []
-        for obj in variantSet.getCallSets():
-            include = True
-            if request.name:
-                if request.name != obj.getLocalId():
-                    include = False
-            if request.bio_sample_id:
-                if request.bio_sample_id != obj.getBioSampleId():
-                    include = False
-            if include:
-                results.append(obj)
+        results = variantSet.searchCallSets(
+            request.name, request.bio_sample_id)
         return self._objectListGenerator(request, results)
 
     def featureSetsGenerator(self, request):
@@ -738,61 +1180,230 @@ class Backend(object):
     #
     ###########################################################
 
-    def runGetRequest(self, obj):
+    def runGetRequest(self, obj, mimetype=protocol.MIMETYPE):
         """
-        Runs a get request by converting the specified datamodel
-        object into its protocol representation.
+        Runs a get request by returning the protocol representation of
+        the specified datamodel object, serialised in the specified
+        mimetype.
         """
-        protocolElement = obj.toProtocolElement()
-        jsonString = protocol.toJson(protocolElement)
-        return jsonString
+        return obj.getSerializedProtocolElement(mimetype)
 
     def runSearchRequest(
-            self, requestStr, requestClass, responseClass, objectGenerator):
+            self, requestStr, requestClass, responseClass, objectGenerator,
+            requestMimetype=protocol.MIMETYPE, mimetype=protocol.MIMETYPE,
+            fields=None):
         """
         Runs the specified request. The request is a string containing
-        a JSON representation of an instance of the specified requestClass.
+        a representation of an instance of the specified requestClass in
+        requestMimetype format (JSON, or the protobuf wire format).
         We return a string representation of an instance of the specified
-        responseClass in JSON format. Objects are filled into the page list
-        using the specified object generator, which must return
-        (object, nextPageToken) pairs, and be able to resume iteration from
-        any point using the nextPageToken attribute of the request object.
+        responseClass in mimetype format (or an iterator over the pieces of
+        this string, if streaming search responses is enabled). Objects
+        are filled into the page list using the specified object
+        generator, which must return (object, nextPageToken) pairs, and be
+        able to resume iteration from any point using the nextPageToken
+        attribute of the request object.
+
+        If fields is not None, it is the comma separated list of the
+        fields of the objects in the response that the client wants
+        returned (see protocol.FieldMask). The object generator is then
+        called with the corresponding FieldMask as a second argument.
+        """
+        self.startProfile()
+        request = self._parseRequest(requestStr, requestClass, requestMimetype)
+        fieldMask = self._parseFieldMask(fields, responseClass)
+        responseBuilder = self._buildSearchResponse(
+            request, responseClass, objectGenerator, mimetype, fieldMask)
+        if self._streamSearchResponses:
+            responseString = responseBuilder.getSerializedResponseChunks()
+        else:
+            responseString = responseBuilder.getSerializedResponse()
+        self.endProfile()
+        return responseString
+
+    def _parseFieldMask(self, fields, responseClass):
+        """
+        Returns the FieldMask for the objects in the specified response
+        class given by the specified list of fields, or None if fields
+        is None.
+        """
+        if fields is None:
+            return None
+        valueListName = protocol.getValueListName(responseClass)
+        descriptor = responseClass.DESCRIPTOR.fields_by_name[
+            valueListName].message_type
+        try:
+            return protocol.FieldMask.parse(descriptor, fields)
+        except ValueError as error:
+            raise exceptions.BadFieldMaskException(error.args[0])
+
+    def _parseRequest(self, requestStr, requestClass, requestMimetype):
+        """
+        Returns the instance of requestClass represented by the specified
+        string in requestMimetype format.
+        """
+        if requestMimetype == protocol.PROTOBUF_MIMETYPE:
+            try:
+                return protocol.deserialize(
+                    requestStr, requestClass, requestMimetype)
+            except protocol.message.DecodeError:
+                raise exceptions.InvalidProtobufException()
+        else:
+            try:
+                return protocol.fromJson(requestStr, requestClass)
+            except protocol.json_format.ParseError:
+                raise exceptions.InvalidJsonException(requestStr)
+
+    def runBatchSearchRequest(
+            self, requestStr, requestClass, responseClass, objectGenerator,
+            sortKey, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
+        """
+        Runs the specified batch of search requests, which is a string
+        representation of a list of instances of requestClass (see
+        protocol.deserializeBatchRequest). Returns the corresponding
+        batch of responseClass instances, in the same order, as a string
+        or an iterator over the pieces of this string as for
+        runSearchRequest. Each request is run using objectGenerator and
+        fields as in runSearchRequest and has its own nextPageToken.
+
+        Requests are run in the order given by the specified sortKey
+        function, so that neighbouring regions are read from the data
+        files in turn. Identical requests are only run once. Batches of
+        more than the maximum number of batch search requests are
+        rejected, as the responses are all held in memory at once.
         """
         self.startProfile()
         try:
-            request = protocol.fromJson(requestStr, requestClass)
-        except protocol.json_format.ParseError:
+            requests = protocol.deserializeBatchRequest(
+                requestStr, requestClass, requestMimetype)
+        except protocol.message.DecodeError:
+            raise exceptions.InvalidProtobufException()
+        except ValueError:
             raise exceptions.InvalidJsonException(requestStr)
+        if len(requests) > self._maxBatchSearchRequests:
+            raise exceptions.BatchTooLargeException(
+                len(requests), self._maxBatchSearchRequests)
+        fieldMask = self._parseFieldMask(fields, responseClass)
+        responseBuilders = [None for _ in requests]
+        builtResponses = {}
+        for index in sorted(
+                range(len(requests)), key=lambda i: sortKey(requests[i])):
+            request = requests[index]
+            requestKey = request.SerializeToString()
+            if requestKey not in builtResponses:
+                builtResponses[requestKey] = self._buildSearchResponse(
+                    request, responseClass, objectGenerator, mimetype,
+                    fieldMask)
+            responseBuilders[index] = builtResponses[requestKey]
+        responseString = protocol.getSerializedBatchResponseChunks(
+            responseBuilders, mimetype)
+        if not self._streamSearchResponses:
+            responseString = b"".join(responseString)
+        self.endProfile()
+        return responseString
+
+    def _buildSearchResponse(
+            self, request, responseClass, objectGenerator, mimetype,
+            fieldMask=None):
+        """
+        Fills a page of the response to the specified request, using the
+        specified object generator (with the specified FieldMask, if it is
+        not None), and returns the SearchResponseBuilder holding it.
+        """
         # TODO How do we detect when the page size is not set?
         if not request.page_size:
             request.page_size = self._defaultPageSize
         if request.page_size < 0:
             raise exceptions.BadPageSizeException(request.page_size)
         responseBuilder = protocol.SearchResponseBuilder(
-            responseClass, request.page_size, self._maxResponseLength)
+            responseClass, request.page_size, self._maxResponseLength,
+            mimetype)
         nextPageToken = None
-        for obj, nextPageToken in objectGenerator(request):
-            responseBuilder.addValue(obj)
+        if fieldMask is None:
+            objectIterator = objectGenerator(request)
+        else:
+            objectIterator = objectGenerator(request, fieldMask)
+        if self._conversionPoolPid == os.getpid() and isinstance(
+                objectIterator, IntervalIterator) and (
+                objectIterator.supportsParallelConversion):
+            nextPageToken = self._fillPageInParallel(
+                request, responseBuilder, objectIterator,
+                objectGenerator.__name__, fieldMask or protocol.ALL_FIELDS,
+                mimetype)
+            responseBuilder.setNextPageToken(nextPageToken)
+            return responseBuilder
+        for obj, nextPageToken in objectIterator:
+            if isinstance(obj, datamodel.DatamodelObject):
+                responseBuilder.addSerializedValue(
+                    obj.getSerializedProtocolElement(mimetype))
+            else:
+                responseBuilder.addValue(obj)
             if responseBuilder.isFull():
                 break
+        if nextPageToken is not None and isinstance(
+                objectIterator, IntervalIterator):
+            # Keep the live search open so the next page can continue it.
+            nextPageToken = objectIterator.suspend()
         responseBuilder.setNextPageToken(nextPageToken)
-        responseString = responseBuilder.getSerializedResponse()
-        self.endProfile()
-        return responseString
-
-    def runListReferenceBases(self, id_, requestArgs):
+        return responseBuilder
+
+    def _fillPageInParallel(
+            self, request, responseBuilder, objectIterator, generatorName,
+            fieldMask, mimetype):
+        """
+        Fills the page in the specified response builder from the
+        specified interval iterator using the conversion processes, and
+        returns the next page token.
+
+        The records are walked in rounds of up to _conversionBatchSize
+        records for each process, without converting them. Each round is
+        split into consecutive batches, and each process picks up the
+        iteration from the page token of the start of its batch using
+        the backend's generatorName method with the specified FieldMask,
+        and converts the batch. The serialised objects are then added to
+        the page in order, so the page and its page token are the same as
+        for a serial conversion.
+        """
+        pool = self._conversionPool
+        numObjects = 0
+        while True:
+            pageTokens = objectIterator.skipRecords(min(
+                request.page_size - numObjects,
+                self._conversionBatchSize * self._conversionProcesses))
+            if len(pageTokens) == 0:
+                return None
+            batchSize = -(-len(pageTokens) // self._conversionProcesses)
+            tasks = []
+            for index in range(0, len(pageTokens), batchSize):
+                batchRequest = type(request)()
+                batchRequest.CopyFrom(request)
+                batchRequest.page_token = pageTokens[index]
+                tasks.append((
+                    generatorName, batchRequest, fieldMask,
+                    len(pageTokens[index:index + batchSize]), mimetype))
+            batches = pool.map(_convertRecords, tasks)
+            for index, value in enumerate(itertools.chain(*batches)):
+                responseBuilder.addSerializedValue(value)
+                numObjects += 1
+                if responseBuilder.isFull():
+                    if index + 1 < len(pageTokens):
+                        # The page was filled before the end of the round,
+                        # so the next page starts within it and the
+                        # iteration, which has moved past it, is ended.
+                        objectIterator.close()
+                        return pageTokens[index + 1]
+                    return objectIterator.suspend()
+
+    def runListReferenceBases(
+            self, id_, requestArgs, mimetype=protocol.MIMETYPE):
         """
         Runs a listReferenceBases request for the specified ID and
-        request arguments.
+        request arguments, returning the response in the specified
+        mimetype.
         """
-        compoundId = datamodel.ReferenceCompoundId.parse(id_)
-        referenceSet = self.getDataRepository().getReferenceSet(
-            compoundId.reference_set_id)
-        reference = referenceSet.getReference(id_)
-        start = _parseIntegerArgument(requestArgs, 'start', 0)
-        end = _parseIntegerArgument(requestArgs, 'end', reference.getLength())
-        if end == 0:  # assume meant "get all"
-            end = reference.getLength()
+        reference = self._getReference(id_)
+        start, end = self._getReferenceBasesRange(reference, requestArgs)
         if 'pageToken' in requestArgs:
             pageTokenStr = requestArgs['pageToken']
             if pageTokenStr != "":
@@ -811,11 +1422,54 @@ class Backend(object):
         response.sequence = sequence
         if nextPageToken is not None:
             response.next_page_token = nextPageToken
-        return protocol.toJson(response)
+        return protocol.serialize(response, mimetype)
+
+    def runListReferenceBasesRaw(self, id_, requestArgs, byteRange=None):
+        """
+        Runs a listReferenceBases request for the specified ID and request
+        arguments, returning the bases unpaged and without a protocol
+        response wrapper. Returns a tuple (start, end, length, chunks),
+        where chunks is an iterator over the bases from start to end and
+        length is the length of the reference.
+
+        If specified, byteRange is a (start, stop) pair taken from an HTTP
+        Range header and takes precedence over the request arguments; stop
+        is exclusive and may be None, and a negative start selects a suffix
+        of the reference.
+        """
+        reference = self._getReference(id_)
+        length = reference.getLength()
+        if byteRange is None:
+            start, end = self._getReferenceBasesRange(reference, requestArgs)
+        else:
+            rangeStart, rangeStop = byteRange
+            if rangeStart < 0:
+                start = max(length + rangeStart, 0)
+                end = length
+            else:
+                start = rangeStart
+                end = length if rangeStop is None else min(rangeStop, length)
+        # Check the range now, rather than once the response has started.
+        reference.checkQueryRange(start, end)
+        chunks = reference.getBasesChunks(start, end, self._maxResponseLength)
+        return start, end, length, chunks
+
+    def _getReference(self, id_):
+        compoundId = datamodel.ReferenceCompoundId.parse(id_)
+        referenceSet = self.getDataRepository().getReferenceSet(
+            compoundId.reference_set_id)
+        return referenceSet.getReference(id_)
+
+    def _getReferenceBasesRange(self, reference, requestArgs):
+        start = _parseIntegerArgument(requestArgs, 'start', 0)
+        end = _parseIntegerArgument(requestArgs, 'end', reference.getLength())
+        if end == 0:  # assume meant "get all"
+            end = reference.getLength()
+        return start, end
 
     # Get requests.
 
-    def runGetCallSet(self, id_):
+    def runGetCallSet(self, id_, mimetype=protocol.MIMETYPE):
         """
         Returns a callset with the given id
         """
@@ -823,9 +1477,9 @@ class Backend(object):
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         variantSet = dataset.getVariantSet(compoundId.variant_set_id)
         callSet = variantSet.getCallSet(id_)
-        return self.runGetRequest(callSet)
+        return self.runGetRequest(callSet, mimetype)
 
-    def runGetVariant(self, id_):
+    def runGetVariant(self, id_, mimetype=protocol.MIMETYPE):
         """
         Returns a variant with the given id
         """
@@ -836,28 +1490,27 @@ class Backend(object):
         # TODO variant is a special case here, as it's returning a
         # protocol element rather than a datamodel object. We should
         # fix this for consistency.
-        jsonString = protocol.toJson(gaVariant)
-        return jsonString
+        return protocol.serialize(gaVariant, mimetype)
 
-    def runGetBioSample(self, id_):
+    def runGetBioSample(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getBioSample request for the specified ID.
         """
         compoundId = datamodel.BioSampleCompoundId.parse(id_)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         bioSample = dataset.getBioSample(id_)
-        return self.runGetRequest(bioSample)
+        return self.runGetRequest(bioSample, mimetype)
 
-    def runGetIndividual(self, id_):
+    def runGetIndividual(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getIndividual request for the specified ID.
         """
         compoundId = datamodel.BioSampleCompoundId.parse(id_)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         individual = dataset.getIndividual(id_)
-        return self.runGetRequest(individual)
+        return self.runGetRequest(individual, mimetype)
 
-    def runGetFeature(self, id_):
+    def runGetFeature(self, id_, mimetype=protocol.MIMETYPE):
         """
         Returns JSON string of the feature object corresponding to
         the feature compoundID passed in.
@@ -866,19 +1519,18 @@ class Backend(object):
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         featureSet = dataset.getFeatureSet(compoundId.feature_set_id)
         gaFeature = featureSet.getFeature(compoundId)
-        jsonString = protocol.toJson(gaFeature)
-        return jsonString
+        return protocol.serialize(gaFeature, mimetype)
 
-    def runGetReadGroupSet(self, id_):
+    def runGetReadGroupSet(self, id_, mimetype=protocol.MIMETYPE):
         """
         Returns a readGroupSet with the given id_
         """
         compoundId = datamodel.ReadGroupSetCompoundId.parse(id_)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         readGroupSet = dataset.getReadGroupSet(id_)
-        return self.runGetRequest(readGroupSet)
+        return self.runGetRequest(readGroupSet, mimetype)
 
-    def runGetReadGroup(self, id_):
+    def runGetReadGroup(self, id_, mimetype=protocol.MIMETYPE):
         """
         Returns a read group with the given id_
         """
@@ -886,9 +1538,9 @@ class Backend(object):
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         readGroupSet = dataset.getReadGroupSet(compoundId.read_group_set_id)
         readGroup = readGroupSet.getReadGroup(id_)
-        return self.runGetRequest(readGroup)
+        return self.runGetRequest(readGroup, mimetype)
 
-    def runGetReference(self, id_):
+    def runGetReference(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getReference request for the specified ID.
         """
@@ -896,41 +1548,41 @@ class Backend(object):
         referenceSet = self.getDataRepository().getReferenceSet(
             compoundId.reference_set_id)
         reference = referenceSet.getReference(id_)
-        return self.runGetRequest(reference)
+        return self.runGetRequest(reference, mimetype)
 
-    def runGetReferenceSet(self, id_):
+    def runGetReferenceSet(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getReferenceSet request for the specified ID.
         """
         referenceSet = self.getDataRepository().getReferenceSet(id_)
-        return self.runGetRequest(referenceSet)
+        return self.runGetRequest(referenceSet, mimetype)
 
-    def runGetVariantSet(self, id_):
+    def runGetVariantSet(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getVariantSet request for the specified ID.
         """
         compoundId = datamodel.VariantSetCompoundId.parse(id_)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         variantSet = dataset.getVariantSet(id_)
-        return self.runGetRequest(variantSet)
+        return self.runGetRequest(variantSet, mimetype)
 
-    def runGetFeatureSet(self, id_):
+    def runGetFeatureSet(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getFeatureSet request for the specified ID.
         """
         compoundId = datamodel.FeatureSetCompoundId.parse(id_)
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         featureSet = dataset.getFeatureSet(id_)
-        return self.runGetRequest(featureSet)
+        return self.runGetRequest(featureSet, mimetype)
 
-    def runGetDataset(self, id_):
+    def runGetDataset(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getDataset request for the specified ID.
         """
         dataset = self.getDataRepository().getDataset(id_)
-        return self.runGetRequest(dataset)
+        return self.runGetRequest(dataset, mimetype)
 
-    def runGetVariantAnnotationSet(self, id_):
+    def runGetVariantAnnotationSet(self, id_, mimetype=protocol.MIMETYPE):
         """
         Runs a getVariantSet request for the specified ID.
         """
@@ -938,119 +1590,207 @@ class Backend(object):
         dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
         variantSet = dataset.getVariantSet(compoundId.variant_set_id)
         variantAnnotationSet = variantSet.getVariantAnnotationSet(id_)
-        return self.runGetRequest(variantAnnotationSet)
+        return self.runGetRequest(variantAnnotationSet, mimetype)
 
     # Search requests.
 
-    def runSearchReadGroupSets(self, request):
+    def runSearchReadGroupSets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchReadGroupSetsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchReadGroupSetsRequest,
             protocol.SearchReadGroupSetsResponse,
-            self.readGroupSetsGenerator)
+            self.readGroupSetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchIndividuals(self, request):
+    def runSearchIndividuals(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified search SearchIndividualsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchIndividualsRequest,
             protocol.SearchIndividualsResponse,
-            self.individualsGenerator)
+            self.individualsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchBioSamples(self, request):
+    def runSearchBioSamples(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchBioSamplesRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchBioSamplesRequest,
             protocol.SearchBioSamplesResponse,
-            self.bioSamplesGenerator)
+            self.bioSamplesGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchReads(self, request):
+    def runSearchReads(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
         """
         Runs the specified SearchReadsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchReadsRequest,
             protocol.SearchReadsResponse,
-            self.readsGenerator)
+            self.readsGenerator,
+            requestMimetype, mimetype, fields)
 
-    def runSearchReferenceSets(self, request):
+    def runBatchSearchReads(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
+        """
+        Runs the specified batch of SearchReadsRequests.
+        """
+        return self.runBatchSearchRequest(
+            request, protocol.SearchReadsRequest,
+            protocol.SearchReadsResponse,
+            self.readsGenerator, _getReadsRequestSortKey,
+            requestMimetype, mimetype, fields)
+
+    def runSearchReferenceSets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchReferenceSetsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchReferenceSetsRequest,
             protocol.SearchReferenceSetsResponse,
-            self.referenceSetsGenerator)
+            self.referenceSetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchReferences(self, request):
+    def runSearchReferences(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchReferenceRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchReferencesRequest,
             protocol.SearchReferencesResponse,
-            self.referencesGenerator)
+            self.referencesGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchVariantSets(self, request):
+    def runSearchVariantSets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchVariantSetsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchVariantSetsRequest,
             protocol.SearchVariantSetsResponse,
-            self.variantSetsGenerator)
+            self.variantSetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchVariantAnnotationSets(self, request):
+    def runSearchVariantAnnotationSets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchVariantAnnotationSetsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchVariantAnnotationSetsRequest,
             protocol.SearchVariantAnnotationSetsResponse,
-            self.variantAnnotationSetsGenerator)
+            self.variantAnnotationSetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchVariants(self, request):
+    def runSearchVariants(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
         """
         Runs the specified SearchVariantRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchVariantsRequest,
             protocol.SearchVariantsResponse,
-            self.variantsGenerator)
+            self.variantsGenerator,
+            requestMimetype, mimetype, fields)
+
+    def runBatchSearchVariants(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
+        """
+        Runs the specified batch of SearchVariantsRequests.
+        """
+        return self.runBatchSearchRequest(
+            request, protocol.SearchVariantsRequest,
+            protocol.SearchVariantsResponse,
+            self.variantsGenerator, _getVariantsRequestSortKey,
+            requestMimetype, mimetype, fields)
+
+    def runGetGenotypeMatrix(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            includeLikelihoods=False):
+        """
+        Runs the specified SearchVariantsRequest, returning the genotypes
+        of all the matching variants as dense arrays in the .npz format
+        rather than as pages of Variants (see _encodeGenotypeMatrix). An
+        empty list of call set IDs in the request selects all call sets.
+        Regions holding more than the maximum number of variants x call
+        sets are rejected, and must be requested in smaller pieces.
+        """
+        self.startProfile()
+        request = self._parseRequest(
+            request, protocol.SearchVariantsRequest, requestMimetype)
+        compoundId = datamodel.VariantSetCompoundId.parse(
+            request.variant_set_id)
+        dataset = self.getDataRepository().getDataset(compoundId.dataset_id)
+        variantSet = dataset.getVariantSet(compoundId.variant_set_id)
+        matrix = variantSet.getGenotypeMatrix(
+            request.reference_name, request.start, request.end,
+            request.call_set_ids, includeLikelihoods,
+            self._maxGenotypeMatrixCells)
+        responseString = _encodeGenotypeMatrix(matrix)
+        self.endProfile()
+        return responseString
 
-    def runSearchVariantAnnotations(self, request):
+    def runSearchVariantAnnotations(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
         """
         Runs the specified SearchVariantAnnotationsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchVariantAnnotationsRequest,
             protocol.SearchVariantAnnotationsResponse,
-            self.variantAnnotationsGenerator)
+            self.variantAnnotationsGenerator,
+            requestMimetype, mimetype, fields)
 
-    def runSearchCallSets(self, request):
+    def runSearchCallSets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchCallSetsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchCallSetsRequest,
             protocol.SearchCallSetsResponse,
-            self.callSetsGenerator)
+            self.callSetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchDatasets(self, request):
+    def runSearchDatasets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Runs the specified SearchDatasetsRequest.
         """
         return self.runSearchRequest(
             request, protocol.SearchDatasetsRequest,
             protocol.SearchDatasetsResponse,
-            self.datasetsGenerator)
+            self.datasetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchFeatureSets(self, request):
+    def runSearchFeatureSets(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE):
         """
         Returns a SearchFeatureSetsResponse for the specified
         SearchFeatureSetsRequest object.
@@ -1058,9 +1798,12 @@ class Backend(object):
         return self.runSearchRequest(
             request, protocol.SearchFeatureSetsRequest,
             protocol.SearchFeatureSetsResponse,
-            self.featureSetsGenerator)
+            self.featureSetsGenerator,
+            requestMimetype, mimetype)
 
-    def runSearchFeatures(self, request):
+    def runSearchFeatures(
+            self, request, requestMimetype=protocol.MIMETYPE,
+            mimetype=protocol.MIMETYPE, fields=None):
         """
         Returns a SearchFeaturesResponse for the specified
         SearchFeaturesRequest object.
@@ -1071,4 +1814,5 @@ class Backend(object):
         return self.runSearchRequest(
             request, protocol.SearchFeaturesRequest,
             protocol.SearchFeaturesResponse,
-            self.featuresGenerator)
+            self.featuresGenerator,
+            requestMimetype, mimetype, fields)
@@ -30,6 +30,7 @@ import ga4gh.frontend as frontend
 import ga4gh.configtest as configtest
 import ga4gh.exceptions as exceptions
 import ga4gh.datarepo as datarepo
+import ga4gh.prefork as prefork
 import ga4gh.protocol as protocol
 import ga4gh.datamodel.reads as reads
 import ga4gh.datamodel.variants as variants
@@ -125,6 +126,20 @@ def addServerOptions(parser):
     parser.add_argument(
         "--dont-use-reloader", default=False, action="store_true",
         help="Don't use the flask reloader")
+    parser.add_argument(
+        "--workers", "-w", default=0, type=int,
+        help="The number of worker processes to fork after loading the "
+        "data repository; 0 runs the flask development server instead")
+    parser.add_argument(
+        "--threads", default=1, type=int,
+        help="The number of threads handling requests in each worker")
+    parser.add_argument(
+        "--max-requests", default=None, type=int,
+        help="The number of requests after which a worker is replaced")
+    parser.add_argument(
+        "--buffer-responses", default=False, action="store_true",
+        help="Send the responses of the workers from a single thread each, "
+        "so that slow clients do not hold request handling threads")
     addVersionArgument(parser)
     addDisableUrllibWarningsArgument(parser)
 
@@ -145,10 +160,21 @@ def server_main(args=None):
     sslContext = None
     if parsedArgs.tls or ("OIDC_PROVIDER" in frontend.app.config):
         sslContext = "adhoc"
-    frontend.app.run(
-        host=parsedArgs.host, port=parsedArgs.port,
-        use_reloader=not parsedArgs.dont_use_reloader,
-        ssl_context=sslContext)
+    if parsedArgs.workers > 0:
+        # Each worker starts its own conversion processes after the fork.
+        frontend.app.backend.stopConversionPool()
+        server = prefork.PreforkServer(
+            frontend.app, parsedArgs.host, parsedArgs.port,
+            parsedArgs.workers, numThreads=parsedArgs.threads,
+            maxRequests=parsedArgs.max_requests,
+            postFork=frontend.reinitialiseAfterFork, sslContext=sslContext,
+            bufferResponses=parsedArgs.buffer_responses)
+        server.serveForever()
+    else:
+        frontend.app.run(
+            host=parsedArgs.host, port=parsedArgs.port,
+            use_reloader=not parsedArgs.dont_use_reloader,
+            ssl_context=sslContext, threaded=parsedArgs.threads > 1)
 
 
 ##############################################################################
@@ -1797,7 +1823,8 @@ class RepoManager(object):
         if name is None:
             name = getNameFromPath(self._args.filePath)
         referenceSet = references.HtslibReferenceSet(name)
-        referenceSet.populateFromFile(filePath)
+        referenceSet.populateFromFile(
+            filePath, self._args.numProcesses, self._args.useChecksumFile)
         referenceSet.setDescription(self._args.description)
         referenceSet.setNcbiTaxonId(self._args.ncbiTaxonId)
         referenceSet.setIsDerived(self._args.isDerived)
@@ -2246,6 +2273,15 @@ class RepoManager(object):
         addReferenceSetParser.add_argument(
             "--sourceUri", default=None,
             help="The source URI")
+        addReferenceSetParser.add_argument(
+            "--numProcesses", "-p", default=1, type=int,
+            help="The number of processes used to compute the MD5 "
+            "checksums of the references")
+        addReferenceSetParser.add_argument(
+            "--useChecksumFile", default=False, action='store_true',
+            help="Reuse the reference MD5 checksums stored in the '{}' "
+            "file next to the FASTA file, writing this file if it does "
+            "not exist".format(references.CHECKSUM_FILE_SUFFIX))
 
         removeReferenceSetParser = addSubparser(
             subparsers, "remove-referenceset",
@@ -5,10 +5,12 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
 import requests
 import posixpath
 import logging
 
+import ga4gh.npy as npy
 import ga4gh.protocol as protocol
 import ga4gh.pb as pb
 import ga4gh.exceptions as exceptions
@@ -16,10 +18,13 @@ import ga4gh.exceptions as exceptions
 
 class AbstractClient(object):
     """
-    The abstract superclass of GA4GH Client objects.
+    The abstract superclass of GA4GH Client objects. Messages are
+    exchanged with the server in the specified mimetype; either JSON
+    (the default) or the binary protobuf wire format.
     """
 
-    def __init__(self, log_level=0):
+    def __init__(self, log_level=0, mimetype=protocol.MIMETYPE):
+        self._mimetype = mimetype
         self._page_size = None
         self._log_level = log_level
         self._protocol_bytes_received = 0
@@ -27,13 +32,18 @@ class AbstractClient(object):
         self._logger = logging.getLogger(__name__)
         self._logger.setLevel(log_level)
 
+    def _serialize_request(self, protocol_request):
+        return protocol.serialize(protocol_request, self._mimetype)
+
     def _deserialize_response(
-            self, json_response_string, protocol_response_class):
-        self._protocol_bytes_received += len(json_response_string)
-        self._logger.debug("response:{}".format(json_response_string))
-        if not json_response_string:
+            self, response_string, protocol_response_class):
+        self._protocol_bytes_received += len(response_string)
+        if self._mimetype == protocol.MIMETYPE:
+            self._logger.debug("response:{}".format(response_string))
+        if not response_string and self._mimetype == protocol.MIMETYPE:
             raise exceptions.EmptyResponseException()
-        return protocol.fromJson(json_response_string, protocol_response_class)
+        return protocol.deserialize(
+            response_string, protocol_response_class, self._mimetype)
 
     def _run_search_page_request(
             self, protocol_request, object_name, protocol_response_class):
@@ -92,6 +102,65 @@ class AbstractClient(object):
             request.page_token = response.next_page_token
         return "".join(bases_list)
 
+    def _run_genotype_matrix_request(
+            self, protocol_request, include_likelihoods):
+        """
+        Runs a complete transaction with the server to get the genotype
+        matrix for the specified SearchVariantsRequest, returning the
+        bytes of the .npz archive.
+        """
+        raise NotImplemented()
+
+    def get_genotype_matrix(
+            self, variant_set_id, start=None, end=None, reference_name=None,
+            call_set_ids=None, include_likelihoods=False):
+        """
+        Returns the genotypes of the variants in the specified region of
+        the specified VariantSet as a dict of NumPy arrays, which is
+        much more compact than the Call objects returned by
+        search_variants. This requires NumPy to be installed.
+
+        The dict holds ``call_set_ids``, ``start`` and ``end`` arrays, and
+        ``genotype``, an int8 array of allele indexes of shape
+        (variants, call sets, ploidy) where missing alleles are -1 (int16
+        if a variant has more than 127 alternate alleles). If
+        include_likelihoods is True it also holds
+        ``genotype_likelihood``, a float32 array of shape (variants,
+        call sets, likelihoods) where missing values are NaN.
+
+        :param str variant_set_id: The ID of the
+            :class:`ga4gh.protocol.VariantSet` of interest.
+        :param int start: The beginning of the window (0-based, inclusive)
+            for which overlapping variants should be returned.
+        :param int end: The end of the window (0-based, exclusive) for
+            which overlapping variants should be returned.
+        :param str reference_name: The name of the
+            :class:`ga4gh.protocol.Reference` we wish to return variants
+            from.
+        :param list call_set_ids: The IDs of the call sets, in the order
+            of the columns of the matrix. If empty or null, all call sets
+            in the VariantSet are returned.
+        :param bool include_likelihoods: Whether to return the genotype
+            likelihoods.
+        :return: A dict mapping array names to NumPy arrays.
+        :rtype: dict
+        """
+        import numpy
+        request = protocol.SearchVariantsRequest()
+        request.reference_name = pb.string(reference_name)
+        request.start = pb.int(start)
+        request.end = pb.int(end)
+        request.variant_set_id = variant_set_id
+        request.call_set_ids.extend(pb.string(call_set_ids))
+        data = self._run_genotype_matrix_request(
+            request, include_likelihoods)
+        self._protocol_bytes_received += len(data)
+        archive = numpy.load(io.BytesIO(data))
+        try:
+            return dict((name, archive[name]) for name in archive.files)
+        finally:
+            archive.close()
+
     def _run_get_request(self, object_name, protocol_response_class, id_):
         """
         Requests an object from the server and returns the object of
@@ -623,12 +692,15 @@ class HttpClient(AbstractClient):
         the :mod:`logging` module. This is :data:`logging.WARNING` by default.
     :param str authentication_key: The authentication key provided by the
         server after logging in.
+    :param str mimetype: The media type used to exchange messages with
+        the server; either :data:`ga4gh.protocol.MIMETYPE` (JSON, the
+        default) or :data:`ga4gh.protocol.PROTOBUF_MIMETYPE`.
     """
 
     def __init__(
             self, url_prefix, logLevel=logging.WARNING,
-            authentication_key=None):
-        super(HttpClient, self).__init__(logLevel)
+            authentication_key=None, mimetype=protocol.MIMETYPE):
+        super(HttpClient, self).__init__(logLevel, mimetype)
         self._url_prefix = url_prefix
         self._authentication_key = authentication_key
         self._session = requests.Session()
@@ -641,7 +713,7 @@ class HttpClient(AbstractClient):
         """
         Sets up the common HTTP session parameters used by requests.
         """
-        headers = {"Content-type": "application/json"}
+        headers = {"Content-type": self._mimetype, "Accept": self._mimetype}
         self._session.headers.update(headers)
         # TODO is this unsafe????
         self._session.verify = False
@@ -664,16 +736,26 @@ class HttpClient(AbstractClient):
         """
         return {'key': self._authentication_key}
 
+    def _get_response_data(self, response):
+        """
+        Returns the body of the specified HTTP response; text for JSON
+        and bytes for the protobuf wire format.
+        """
+        if self._mimetype == protocol.PROTOBUF_MIMETYPE:
+            return response.content
+        return response.text
+
     def _run_search_page_request(
             self, protocol_request, object_name, protocol_response_class):
         url = posixpath.join(self._url_prefix, object_name + '/search')
-        data = protocol.toJson(protocol_request)
-        self._logger.debug("request:{}".format(data))
+        data = self._serialize_request(protocol_request)
+        if self._mimetype == protocol.MIMETYPE:
+            self._logger.debug("request:{}".format(data))
         response = self._session.post(
             url, params=self._get_http_parameters(), data=data)
         self._check_response_status(response)
         return self._deserialize_response(
-            response.text, protocol_response_class)
+            self._get_response_data(response), protocol_response_class)
 
     def _run_get_request(self, object_name, protocol_response_class, id_):
         url_suffix = "{object_name}/{id}".format(
@@ -682,7 +764,7 @@ class HttpClient(AbstractClient):
         response = self._session.get(url, params=self._get_http_parameters())
         self._check_response_status(response)
         return self._deserialize_response(
-            response.text, protocol_response_class)
+            self._get_response_data(response), protocol_response_class)
 
     def _run_list_reference_bases_page_request(self, id_, request):
         url_suffix = "references/{id}/bases".format(id=id_)
@@ -692,13 +774,27 @@ class HttpClient(AbstractClient):
         response = self._session.get(url, params=params)
         self._check_response_status(response)
         return self._deserialize_response(
-            response.text, protocol.ListReferenceBasesResponse)
+            self._get_response_data(response),
+            protocol.ListReferenceBasesResponse)
+
+    def _run_genotype_matrix_request(
+            self, protocol_request, include_likelihoods):
+        url = posixpath.join(self._url_prefix, "variants/genotypematrix")
+        params = self._get_http_parameters()
+        if include_likelihoods:
+            params["includeLikelihoods"] = "true"
+        response = self._session.post(
+            url, params=params,
+            data=self._serialize_request(protocol_request),
+            headers={"Accept": npy.MIMETYPE})
+        self._check_response_status(response)
+        return response.content
 
 
 class LocalClient(AbstractClient):
 
-    def __init__(self, backend):
-        super(LocalClient, self).__init__()
+    def __init__(self, backend, mimetype=protocol.MIMETYPE):
+        super(LocalClient, self).__init__(mimetype=mimetype)
         self._backend = backend
         self._get_method_map = {
             "callsets": self._backend.runGetCallSet,
@@ -735,16 +831,18 @@ class LocalClient(AbstractClient):
 
     def _run_get_request(self, object_name, protocol_response_class, id_):
         get_method = self._get_method_map[object_name]
-        response_json = get_method(id_)
+        response_string = get_method(id_, self._mimetype)
         return self._deserialize_response(
-            response_json, protocol_response_class)
+            response_string, protocol_response_class)
 
     def _run_search_page_request(
             self, protocol_request, object_name, protocol_response_class):
         search_method = self._search_method_map[object_name]
-        response_json = search_method(protocol.toJson(protocol_request))
+        response_string = search_method(
+            self._serialize_request(protocol_request), self._mimetype,
+            self._mimetype)
         return self._deserialize_response(
-            response_json, protocol_response_class)
+            response_string, protocol_response_class)
 
     def _run_list_reference_bases_page_request(self, id_, request):
         request_args = protocol.toJsonDict(request)
@@ -757,6 +855,13 @@ class LocalClient(AbstractClient):
             del request_args["end"]
         if request.page_token == '':
             del request_args["pageToken"]
-        response_json = self._backend.runListReferenceBases(id_, request_args)
+        response_string = self._backend.runListReferenceBases(
+            id_, request_args, self._mimetype)
         return self._deserialize_response(
-            response_json, protocol.ListReferenceBasesResponse)
+            response_string, protocol.ListReferenceBasesResponse)
+
+    def _run_genotype_matrix_request(
+            self, protocol_request, include_likelihoods):
+        return self._backend.runGetGenotypeMatrix(
+            self._serialize_request(protocol_request), self._mimetype,
+            include_likelihoods)
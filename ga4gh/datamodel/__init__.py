@@ -9,22 +9,43 @@ from __future__ import unicode_literals
 import json
 import base64
 import collections
+import contextlib
+import Queue
+import sys
+import threading
 
 import ga4gh.exceptions as exceptions
+import ga4gh.protocol as protocol
 
 
 class PysamFileHandleCache(object):
     """
-    Cache for opened file handles. We use a deque which has the
-    advantage to have push/pop operations in O(1) We always add
-    elements on the left of the deque and pop elements from the right.
-    When a file is accessed via getFileHandle, its priority gets
-    updated, it is put at the "top" of the deque.
+    LRU cache for opened file handles, held in an OrderedDict so that
+    lookups and updates of a handle's priority are O(1). The least
+    recently used handle is at the front of the OrderedDict, and the most
+    recently used at the back.
+
+    Handles are checked out for exclusive use (see checkOutFileHandle),
+    so that no two iterators ever drive the same pysam handle, whichever
+    threads they run in. Only handles that are not checked out are held
+    in the cache; a file being read by several iterators at once has a
+    handle open for each of them, which are all cached when checked in.
     """
 
     def __init__(self):
-        self._cache = collections.deque()
-        self._memoTable = dict()
+        # Idle handles, keyed by (dataFile, id(handle))
+        self._cache = collections.OrderedDict()
+        # The keys of the idle handles for each file, most recently used
+        # last
+        self._idleKeys = {}
+        self._lock = threading.RLock()
+        # Checked out handles, keyed by id(handle)
+        self._checkedOut = {}
+        # Checked out handles to be closed rather than cached on check in
+        self._closePending = set()
+        self._numHits = 0
+        self._numMisses = 0
+        self._numEvictions = 0
         # Initialize the value even if it will be set up by the config
         self._maxCacheSize = 50
 
@@ -35,61 +56,124 @@ class PysamFileHandleCache(object):
         if size <= 0:
             raise ValueError(
                 "The size of the cache must be a strictly positive value")
-        self._maxCacheSize = size
+        with self._lock:
+            self._maxCacheSize = size
+            self._removeLru()
+
+    def getNumHits(self):
+        """
+        Returns the number of checkouts for which a handle was cached.
+        """
+        return self._numHits
+
+    def getNumMisses(self):
+        """
+        Returns the number of checkouts for which a file had to be opened.
+        """
+        return self._numMisses
 
-    def _add(self, dataFile, handle):
+    def getNumEvictions(self):
         """
-        Add a file handle to the left of the deque
+        Returns the number of handles evicted from the cache.
         """
-        self._cache.appendleft((dataFile, handle))
+        return self._numEvictions
 
-    def _update(self, dataFile, handle):
+    def getNumCheckedOut(self):
         """
-        Update the priority of the file handle. The element is first
-        removed and then added to the left of the deque.
+        Returns the number of handles currently checked out.
         """
-        self._cache.remove((dataFile, handle))
-        self._add(dataFile, handle)
+        return len(self._checkedOut)
 
     def _removeLru(self):
         """
-        Remove the least recently used file handle from the cache.
-        The pop method removes an element from the right of the deque.
-        Returns the name of the file that has been removed.
+        Closes least recently used file handles until the cache is within
+        its maximum size.
+        """
+        while len(self._cache) > self._maxCacheSize:
+            (dataFile, handleId), handle = self._cache.popitem(last=False)
+            idleKeys = self._idleKeys[dataFile]
+            idleKeys.remove((dataFile, handleId))
+            if len(idleKeys) == 0:
+                del self._idleKeys[dataFile]
+            self._numEvictions += 1
+            handle.close()
+
+    def clear(self):
+        """
+        Closes all cached file handles. Handles that are checked out are
+        closed when they are checked back in.
         """
-        (dataFile, handle) = self._cache.pop()
-        handle.close()
-        return dataFile
+        with self._lock:
+            maxCacheSize = self._maxCacheSize
+            self._maxCacheSize = 0
+            self._removeLru()
+            self._maxCacheSize = maxCacheSize
+            self._closePending.update(self._checkedOut)
 
     def getCachedFiles(self):
         """
         Returns all file names stored in the cache.
         """
-        return self._memoTable.keys()
+        with self._lock:
+            return list(self._idleKeys)
 
-    def getFileHandle(self, dataFile, openMethod):
+    def checkOutFileHandle(self, dataFile, openMethod):
         """
-        Returns handle associated to the filename. If the file is
-        already opened, update its priority in the cache and return
-        its handle. Otherwise, open the file using openMethod, store
-        it in the cache and return the corresponding handle.
+        Returns a handle for the specified file for the exclusive use of
+        the caller until it is passed to checkInFileHandle. The most
+        recently used cached handle for the file is returned if there is
+        one, and otherwise the file is opened using openMethod.
         """
-        if dataFile in self._memoTable:
-            handle = self._memoTable[dataFile]
-            self._update(dataFile, handle)
-            return handle
-        else:
+        with self._lock:
+            idleKeys = self._idleKeys.get(dataFile)
+            if idleKeys is not None:
+                self._numHits += 1
+                key = idleKeys.pop()
+                if len(idleKeys) == 0:
+                    del self._idleKeys[dataFile]
+                handle = self._cache.pop(key)
+            else:
+                self._numMisses += 1
+                handle = None
+        if handle is None:
+            # Files are opened outside the lock, so that other files can
+            # be checked out meanwhile.
             try:
                 handle = openMethod(dataFile)
             except ValueError:
                 raise exceptions.FileOpenFailedException(dataFile)
-
-            self._memoTable[dataFile] = handle
-            self._add(dataFile, handle)
-            if len(self._memoTable) > self._maxCacheSize:
-                dataFile = self._removeLru()
-                del self._memoTable[dataFile]
-            return handle
+        with self._lock:
+            self._checkedOut[id(handle)] = dataFile
+        return handle
+
+    def checkInFileHandle(self, handle):
+        """
+        Returns a handle obtained from checkOutFileHandle to the cache,
+        as the most recently used handle.
+        """
+        with self._lock:
+            handleId = id(handle)
+            dataFile = self._checkedOut.pop(handleId)
+            if handleId in self._closePending:
+                self._closePending.remove(handleId)
+                handle.close()
+                return
+            key = dataFile, handleId
+            self._cache[key] = handle
+            self._idleKeys.setdefault(dataFile, []).append(key)
+            self._removeLru()
+
+    @contextlib.contextmanager
+    def fileHandle(self, dataFile, openMethod):
+        """
+        Returns a context manager that checks out a handle for the
+        specified file and checks it back in on exit.
+        """
+        handle = self.checkOutFileHandle(dataFile, openMethod)
+        try:
+            yield handle
+        finally:
+            self.checkInFileHandle(handle)
 
 
 # LRU cache of open file handles
@@ -137,7 +221,15 @@ class CompoundId(object):
         values from the parent compound ID, and must have localIds
         corresponding to its fields. If no parent id is present,
         parentCompoundId should be set to None.
+
+        The string form of the ID and the IDs of the containers are only
+        computed when first used. When a parent is given, the string form
+        reuses the encoding of the parent's fields, so that only the
+        local identifiers are encoded for each new ID.
         """
+        self._parentCompoundId = parentCompoundId
+        self._compoundIdStr = None
+        self._obfuscatedPrefix = None
         index = 0
         if parentCompoundId is not None:
             for field in parentCompoundId.fields:
@@ -159,16 +251,65 @@ class CompoundId(object):
         if len(localIds) != len(self.fields) - index:
             raise ValueError(
                 "Incorrect number of fields provided to instantiate ID")
+
+    def __getattr__(self, name):
+        # Only called for attributes that have not been set, so each
+        # container ID is computed on first access and then stored.
         for idFieldName, prefix in self.containerIds:
-            values = [getattr(self, f) for f in self.fields[:prefix + 1]]
-            containerId = self.join(values)
-            obfuscated = self.obfuscate(containerId)
-            setattr(self, idFieldName, obfuscated)
+            if idFieldName == name:
+                containerId = self._getContainerId(prefix)
+                setattr(self, idFieldName, containerId)
+                return containerId
+        raise AttributeError(name)
 
     def __str__(self):
-        values = [getattr(self, f) for f in self.fields]
-        compoundIdStr = self.join(values)
-        return self.obfuscate(compoundIdStr)
+        return self._getCompoundIdStr()
+
+    def _getCompoundIdStr(self):
+        if self._compoundIdStr is None:
+            parent = self._parentCompoundId
+            numParentFields = 0
+            if parent is not None:
+                numParentFields = len(parent.fields)
+            if 0 < numParentFields < len(self.fields):
+                values = [
+                    getattr(self, f) for f in self.fields[numParentFields:]]
+                # Drop the opening bracket, which is part of the prefix
+                self._compoundIdStr = parent._obfuscateWithPrefix(
+                    self.join(values)[1:])
+            else:
+                values = [getattr(self, f) for f in self.fields]
+                self._compoundIdStr = self.obfuscate(self.join(values))
+        return self._compoundIdStr
+
+    def _getContainerId(self, prefix):
+        """
+        Returns the ID of the container formed by the fields of this ID
+        up to and including the specified index.
+        """
+        parent = self._parentCompoundId
+        if parent is not None and len(parent.fields) == prefix + 1:
+            return parent._getCompoundIdStr()
+        values = [getattr(self, f) for f in self.fields[:prefix + 1]]
+        return self.obfuscate(self.join(values))
+
+    def _obfuscateWithPrefix(self, suffix):
+        """
+        Returns the obfuscated ID string formed by the fields of this ID
+        followed by the specified (joined) suffix. Base64 encodes each
+        group of three bytes independently, so the encoding of the whole
+        groups in the joined fields of this ID is computed only once.
+        """
+        if self._obfuscatedPrefix is None:
+            values = [getattr(self, f) for f in self.fields]
+            prefix = (self.join(values)[:-1] + ',').encode('utf-8')
+            length = len(prefix) - len(prefix) % 3
+            self._obfuscatedPrefix = (
+                unicode(base64.urlsafe_b64encode(prefix[:length])),
+                prefix[length:])
+        obfuscatedPrefix, remainder = self._obfuscatedPrefix
+        return obfuscatedPrefix + unicode(base64.urlsafe_b64encode(
+            remainder + suffix.encode('utf-8')).replace(b'=', b''))
 
     @classmethod
     def join(cls, splits):
@@ -209,7 +350,9 @@ class CompoundId(object):
     def parse(cls, compoundIdStr):
         """
         Parses the specified compoundId string and returns an instance
-        of this CompoundId class.
+        of this CompoundId class. Parsed IDs are cached in
+        compoundIdCache, so the returned instance may be shared and must
+        not be modified.
 
         :raises: An ObjectWithIdNotFoundException if parsing fails. This is
         because this method is a client-facing method, and if a malformed
@@ -218,6 +361,13 @@ class CompoundId(object):
         """
         if not isinstance(compoundIdStr, basestring):
             raise exceptions.BadIdentifierException(compoundIdStr)
+        return compoundIdCache.getCompoundId(cls, compoundIdStr)
+
+    @classmethod
+    def _parse(cls, compoundIdStr):
+        """
+        Parses the specified compoundId string without using the cache.
+        """
         try:
             deobfuscated = cls.deobfuscate(compoundIdStr)
         except TypeError:
@@ -280,6 +430,84 @@ class CompoundId(object):
         return cls.join(['notValid'] * len(cls.fields))
 
 
+class CompoundIdCache(object):
+    """
+    LRU cache of parsed CompoundIds, keyed by the CompoundId class and
+    the ID string, so that the IDs that clients send repeatedly are only
+    decoded once. IDs that fail to parse are not cached.
+    """
+
+    def __init__(self):
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._numHits = 0
+        self._numMisses = 0
+        # Initialize the value even if it will be set up by the config
+        self._maxCacheSize = 10000
+
+    def setMaxCacheSize(self, size):
+        """
+        Sets the maximum size of the cache; 0 disables caching.
+        """
+        if size < 0:
+            raise ValueError("The size of the cache must not be negative")
+        with self._lock:
+            self._maxCacheSize = size
+            self._removeLru()
+
+    def getNumHits(self):
+        """
+        Returns the number of IDs that were found in the cache.
+        """
+        return self._numHits
+
+    def getNumMisses(self):
+        """
+        Returns the number of IDs that had to be parsed.
+        """
+        return self._numMisses
+
+    def getCacheSize(self):
+        """
+        Returns the number of parsed IDs in the cache.
+        """
+        return len(self._cache)
+
+    def clear(self):
+        """
+        Removes all parsed IDs from the cache.
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def _removeLru(self):
+        while len(self._cache) > self._maxCacheSize:
+            self._cache.popitem(last=False)
+
+    def getCompoundId(self, compoundIdClass, compoundIdStr):
+        """
+        Returns the instance of compoundIdClass parsed from the specified
+        string, from the cache if possible.
+        """
+        key = (compoundIdClass, compoundIdStr)
+        with self._lock:
+            compoundId = self._cache.pop(key, None)
+            if compoundId is not None:
+                self._numHits += 1
+                self._cache[key] = compoundId
+                return compoundId
+            self._numMisses += 1
+        compoundId = compoundIdClass._parse(compoundIdStr)
+        with self._lock:
+            self._cache[key] = compoundId
+            self._removeLru()
+        return compoundId
+
+
+# LRU cache of parsed compound IDs
+compoundIdCache = CompoundIdCache()
+
+
 class ReferenceSetCompoundId(CompoundId):
     """
     The compound ID for reference sets.
@@ -430,6 +658,67 @@ class ReadAlignmentCompoundId(ReadGroupSetCompoundId):
         [('read_alignment_id', 2)]
 
 
+class DatamodelObjectIndex(object):
+    """
+    Hash indexes on the attributes of the objects in a container, used
+    to resolve search filters by lookups rather than by scanning every
+    object. Each index is defined by a function returning the keys of
+    an object, or None if the object matches any value of the key. The
+    indexes are built when first searched, and must be invalidated when
+    objects are added to the container.
+    """
+    def __init__(self, getObjectsMethod, keyFunctions):
+        self._getObjects = getObjectsMethod
+        self._keyFunctions = keyFunctions
+        self._indexes = None
+
+    def invalidate(self):
+        """
+        Discards the indexes, so that they are rebuilt on the next search.
+        """
+        self._indexes = None
+
+    def _buildIndexes(self):
+        objects = self._getObjects()
+        indexes = {}
+        for name, keyFunction in self._keyFunctions.items():
+            index = collections.defaultdict(list)
+            wildcards = []
+            for position, obj in enumerate(objects):
+                keys = keyFunction(obj)
+                if keys is None:
+                    wildcards.append(position)
+                else:
+                    for key in set(keys):
+                        index[key].append(position)
+            indexes[name] = (dict(index), wildcards)
+        return objects, indexes
+
+    def search(self, **filters):
+        """
+        Returns the objects, in container order, matching all of the
+        specified filters, which map index names to values. Filters with
+        empty values are ignored.
+        """
+        if self._indexes is None:
+            self._indexes = self._buildIndexes()
+        objects, indexes = self._indexes
+        positions = None
+        for name, value in filters.items():
+            if not value:
+                continue
+            index, wildcards = indexes[name]
+            matches = set(index.get(value, []))
+            matches.update(wildcards)
+            if positions is None:
+                positions = matches
+            else:
+                positions &= matches
+        if positions is None:
+            return list(objects)
+        return [objects[position] for position in sorted(positions)]
+
+
 class DatamodelObject(object):
     """
     Superclass of all datamodel types. A datamodel object is a concrete
@@ -451,6 +740,7 @@ class DatamodelObject(object):
         if parentContainer is not None:
             parentId = parentContainer.getCompoundId()
         self._compoundId = self.compoundIdClass(parentId, localId)
+        self._serializedProtocolElements = {}
 
     def getId(self):
         """
@@ -459,6 +749,20 @@ class DatamodelObject(object):
         """
         return str(self._compoundId)
 
+    def getSerializedProtocolElement(self, mimetype):
+        """
+        Returns the protocol element for this DatamodelObject serialised
+        in the specified mimetype. Datamodel objects do not change once
+        the data repository has been loaded, so the serialised form is
+        only computed once for each mimetype.
+        """
+        serialized = self._serializedProtocolElements.get(mimetype)
+        if serialized is None:
+            serialized = protocol.serialize(
+                self.toProtocolElement(), mimetype)
+            self._serializedProtocolElements[mimetype] = serialized
+        return serialized
+
     def getCompoundId(self):
         """
         Returns the CompoundId instance that identifies this object
@@ -484,6 +788,65 @@ class DatamodelObject(object):
         return self._parentContainer
 
 
+# The number of items passed from a prefetch thread to its caller at once
+_prefetchBatchSize = 64
+
+
+def _prefetchBatches(iterator, batches, stopped):
+    # The last batch put is always marked as done, including when the
+    # thread is stopped early.
+    # Errors are passed on with their tracebacks, so that they are
+    # re-raised to the caller from where they occurred.
+    batch = []
+    excInfo = None
+    try:
+        for item in iterator:
+            batch.append(item)
+            if len(batch) == _prefetchBatchSize:
+                if stopped.is_set():
+                    break
+                batches.put((batch, False, None))
+                batch = []
+    except Exception:
+        excInfo = sys.exc_info()
+    batches.put((batch, True, excInfo))
+
+
+def prefetch(iterator, maxSize):
+    """
+    Returns an iterator over the items of the specified iterator, which is
+    advanced in a separate thread that stays up to maxSize items ahead of
+    the caller. Exceptions raised by the iterator are re-raised to the
+    caller. The thread is stopped when the returned iterator is exhausted
+    or closed. If maxSize is 0, the iterator is advanced by the caller.
+    """
+    if maxSize <= 0:
+        for item in iterator:
+            yield item
+        return
+    batches = Queue.Queue(max(1, maxSize // _prefetchBatchSize))
+    stopped = threading.Event()
+    thread = threading.Thread(
+        target=_prefetchBatches, args=(iterator, batches, stopped))
+    thread.daemon = True
+    thread.start()
+    done = False
+    try:
+        while not done:
+            batch, done, excInfo = batches.get()
+            for item in batch:
+                yield item
+            if excInfo is not None:
+                raise excInfo[0], excInfo[1], excInfo[2]
+    finally:
+        stopped.set()
+        # Take batches until the last one, so that the thread is not left
+        # waiting for space in the queue.
+        while not done:
+            _, done, _ = batches.get()
+        thread.join()
+
+
 class PysamDatamodelMixin(object):
     """
     A mixin class to simplify working with DatamodelObjects based on
@@ -505,6 +868,41 @@ class PysamDatamodelMixin(object):
 
     maxStringLength = 2**10  # arbitrary
 
+    # The number of records read ahead of their conversion in a separate
+    # thread, or 0 to read records as they are converted.
+    prefetchSize = 0
+    # The number of threads htslib uses to decompress each open file.
+    htslibThreads = 1
+
+    @classmethod
+    def setPrefetchSize(cls, prefetchSize):
+        """
+        Sets the number of records read ahead of their conversion.
+        """
+        if prefetchSize < 0:
+            raise ValueError("The prefetch size must not be negative")
+        cls.prefetchSize = prefetchSize
+
+    @classmethod
+    def setHtslibThreads(cls, htslibThreads):
+        """
+        Sets the number of decompression threads for each open file.
+        """
+        if htslibThreads < 1:
+            raise ValueError("There must be at least one htslib thread")
+        cls.htslibThreads = htslibThreads
+
+    @classmethod
+    def getPysamOpenOptions(cls):
+        """
+        Returns the keyword arguments with which to open pysam files. The
+        threads argument needs pysam 0.10 or later, so it is only given
+        when more than one thread has been set.
+        """
+        if cls.htslibThreads > 1:
+            return {"threads": cls.htslibThreads}
+        return {}
+
     @classmethod
     def sanitizeVariantFileFetch(cls, contig=None, start=None, stop=None):
         if contig is not None:
@@ -572,5 +970,19 @@ class PysamDatamodelMixin(object):
             attr = attr[:cls.maxStringLength]
         return attr
 
-    def getFileHandle(self, dataFile):
-        return fileHandleCache.getFileHandle(dataFile, self.openFile)
+    def fileHandle(self, dataFile):
+        return fileHandleCache.fileHandle(dataFile, self.openFile)
+
+    def checkOutFileHandle(self, dataFile):
+        return fileHandleCache.checkOutFileHandle(dataFile, self.openFile)
+
+    def checkInFileHandle(self, handle):
+        fileHandleCache.checkInFileHandle(handle)
+
+    def prefetchRecords(self, records):
+        """
+        Returns an iterator over the specified records that reads them
+        ahead of the caller according to prefetchSize. It must be closed
+        before the file handle the records are read from is checked in.
+        """
+        return prefetch(records, self.prefetchSize)
@@ -15,6 +15,18 @@ import ga4gh.datamodel.bio_metadata as biodata
 from ga4gh import pb
 
 
+def _getReadGroupSetBioSampleIds(readGroupSet):
+    """
+    Returns the biosample IDs of the read groups in the specified read
+    group set. A read group set without read groups matches any
+    biosample.
+    """
+    readGroups = readGroupSet.getReadGroups()
+    if len(readGroups) == 0:
+        return None
+    return [readGroup.getBioSampleId() for readGroup in readGroups]
+
+
 class Dataset(datamodel.DatamodelObject):
     """
     The base class of datasets containing variants and reads
@@ -39,6 +51,18 @@ class Dataset(datamodel.DatamodelObject):
         self._individualIds = []
         self._individualIdMap = {}
         self._individualNameMap = {}
+        self._bioSampleIndex = datamodel.DatamodelObjectIndex(
+            self.getBioSamples, {
+                "name": lambda bioSample: [bioSample.getLocalId()],
+                "individualId": lambda bioSample: [
+                    bioSample.getIndividualId()]})
+        self._individualIndex = datamodel.DatamodelObjectIndex(
+            self.getIndividuals, {
+                "name": lambda individual: [individual.getLocalId()]})
+        self._readGroupSetIndex = datamodel.DatamodelObjectIndex(
+            self.getReadGroupSets, {
+                "name": lambda readGroupSet: [readGroupSet.getLocalId()],
+                "bioSampleId": _getReadGroupSetBioSampleIds})
 
     def populateFromRow(self, row):
         """
@@ -70,6 +94,7 @@ class Dataset(datamodel.DatamodelObject):
         self._bioSampleIdMap[id_] = bioSample
         self._bioSampleIds.append(id_)
         self._bioSampleNameMap[bioSample.getName()] = bioSample
+        self._bioSampleIndex.invalidate()
 
     def addIndividual(self, individual):
         """
@@ -79,6 +104,7 @@ class Dataset(datamodel.DatamodelObject):
         self._individualIdMap[id_] = individual
         self._individualIds.append(id_)
         self._individualNameMap[individual.getName()] = individual
+        self._individualIndex.invalidate()
 
     def addFeatureSet(self, featureSet):
         """
@@ -98,6 +124,7 @@ class Dataset(datamodel.DatamodelObject):
         self._readGroupSetIdMap[id_] = readGroupSet
         self._readGroupSetNameMap[readGroupSet.getLocalId()] = readGroupSet
         self._readGroupSetIds.append(id_)
+        self._readGroupSetIndex.invalidate()
 
     def toProtocolElement(self):
         dataset = protocol.Dataset()
@@ -190,6 +217,14 @@ class Dataset(datamodel.DatamodelObject):
         """
         return [self._bioSampleIdMap[id_] for id_ in self._bioSampleIds]
 
+    def searchBioSamples(self, name=None, individualId=None):
+        """
+        Returns the list of biosamples in this dataset with the specified
+        name and individual ID; empty values match any biosample.
+        """
+        return self._bioSampleIndex.search(
+            name=name, individualId=individualId)
+
     def getBioSampleByName(self, name):
         """
         Returns a BioSample with the specified name, or raises a
@@ -226,6 +261,13 @@ class Dataset(datamodel.DatamodelObject):
         """
         return [self._individualIdMap[id_] for id_ in self._individualIds]
 
+    def searchIndividuals(self, name=None):
+        """
+        Returns the list of individuals in this dataset with the specified
+        name; an empty name matches any individual.
+        """
+        return self._individualIndex.search(name=name)
+
     def getIndividualByName(self, name):
         """
         Returns an individual with the specified name, or raises a
@@ -262,6 +304,15 @@ class Dataset(datamodel.DatamodelObject):
         """
         return [self._readGroupSetIdMap[id_] for id_ in self._readGroupSetIds]
 
+    def searchReadGroupSets(self, name=None, bioSampleId=None):
+        """
+        Returns the list of ReadGroupSets in this dataset with the
+        specified name and containing read groups for the specified
+        biosample; empty values match any ReadGroupSet.
+        """
+        return self._readGroupSetIndex.search(
+            name=name, bioSampleId=bioSampleId)
+
     def getReadGroupSetByName(self, name):
         """
         Returns a ReadGroupSet with the specified name, or raises a
@@ -6,7 +6,9 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import collections
+import json
 import os.path
+import threading
 
 import ga4gh.protocol as protocol
 import ga4gh.exceptions as exceptions
@@ -44,10 +46,18 @@ class Ontology(object):
         self._dataUrl = None
         # There can be duplicate names, so we need to store a list of IDs.
         self._nameIdMap = collections.defaultdict(list)
+        self._fileRead = False
+        self._readFileLock = threading.Lock()
+        self._fileSize = None
+        self._fileModificationTime = None
+        self._gaTermCache = {}
 
     def _readFile(self):
         if not os.path.exists(self._dataUrl):
             raise exceptions.FileOpenFailedException(self._dataUrl)
+        fileStat = os.stat(self._dataUrl)
+        self._fileSize = fileStat.st_size
+        self._fileModificationTime = fileStat.st_mtime
         reader = OboReader(obo_file=self._dataUrl)
         ids = set()
         for record in reader:
@@ -63,6 +73,15 @@ class Ontology(object):
         # To get prefix, pull out an ID and parse it.
         self._ontologyPrefix = record.id.split(":")[0]
         self._sourceVersion = reader.data_version
+        self._fileRead = True
+
+    def _checkFileRead(self):
+        # Ontologies populated with readFile=False parse their OBO file
+        # on first use.
+        if not self._fileRead:
+            with self._readFileLock:
+                if not self._fileRead:
+                    self._readFile()
 
     def populateFromFile(self, dataUrl):
         """
@@ -73,13 +92,43 @@ class Ontology(object):
         self._dataUrl = dataUrl
         self._readFile()
 
-    def populateFromRow(self, row):
-        """
-        Populates this Ontology using values in the specified DB row.
+    def _isCompiledRowCurrent(self, compiledRow):
+        # Compiled terms are only used if the OBO file has not changed
+        # since they were compiled from it.
+        try:
+            fileStat = os.stat(self._dataUrl)
+        except OSError:
+            return False
+        return (
+            fileStat.st_size == compiledRow[b'fileSize'] and
+            fileStat.st_mtime == compiledRow[b'fileModificationTime'])
+
+    def _populateFromCompiledRow(self, compiledRow):
+        for termId, name in json.loads(compiledRow[b'terms']):
+            self._nameIdMap[name].append(termId)
+        self._sourceVersion = compiledRow[b'sourceVersion']
+        self._fileSize = compiledRow[b'fileSize']
+        self._fileModificationTime = compiledRow[b'fileModificationTime']
+        self._fileRead = True
+
+    def populateFromRow(self, row, compiledRow=None, readFile=True):
+        """
+        Populates this Ontology using values in the specified DB row. The
+        terms are taken from the specified row of compiled terms if the
+        OBO file has not changed since they were compiled, and otherwise
+        read from the OBO file. If readFile is False, the OBO file is not
+        parsed until the terms of this ontology are first needed.
         """
         self._id = row[b'id']
         self._dataUrl = row[b'dataUrl']
-        self._readFile()
+        if compiledRow is not None and self._isCompiledRowCurrent(
+                compiledRow):
+            self._ontologyPrefix = row[b'ontologyPrefix']
+            self._populateFromCompiledRow(compiledRow)
+        elif readFile:
+            self._readFile()
+        else:
+            self._ontologyPrefix = row[b'ontologyPrefix']
         # TODO sanity check the stored values against what we have just read.
 
     def getId(self):
@@ -100,11 +149,37 @@ class Ontology(object):
         """
         The version of the ontology derived from the OBO file.
         """
+        self._checkFileRead()
         return self._sourceVersion
 
     def getDataUrl(self):
         return self._dataUrl
 
+    def getFileSize(self):
+        """
+        Returns the size of the OBO file that the terms of this ontology
+        were read from.
+        """
+        return self._fileSize
+
+    def getFileModificationTime(self):
+        """
+        Returns the modification time of the OBO file that the terms of
+        this ontology were read from.
+        """
+        return self._fileModificationTime
+
+    def getCompiledTerms(self):
+        """
+        Returns the list of (ID, name) pairs for the terms of this ontology,
+        from which the name to ID map can be rebuilt without parsing the
+        OBO file.
+        """
+        self._checkFileRead()
+        return [
+            (termId, name) for name, termIds in self._nameIdMap.items()
+            for termId in termIds]
+
     def getName(self):
         """
         Returns the name of this ontology.
@@ -116,15 +191,21 @@ class Ontology(object):
         Returns the list of ontology IDs scorresponding to the specified term
         name. If the term name is not found, return the empty list.
         """
+        self._checkFileRead()
         return self._nameIdMap[termName]
 
     def getGaTermByName(self, name):
         """
-        Returns a GA4GH OntologyTerm object by name.
+        Returns a GA4GH OntologyTerm object by name. The same object is
+        returned for each call with a given name, and so it must not be
+        modified.
 
         :param name: name of the ontology term, ex. "gene".
         :return: GA4GH OntologyTerm object.
         """
+        term = self._gaTermCache.get(name)
+        if term is not None:
+            return term
         # TODO what is the correct value when we have no mapping??
         termIds = self.getTermIds(name)
         if len(termIds) == 0:
@@ -139,4 +220,5 @@ class Ontology(object):
         term.id = termId
         term.source_name = self._sourceName
         term.source_version = pb.string(self._sourceVersion)
+        self._gaTermCache[name] = term
         return term
@@ -39,6 +39,18 @@ def parseMalformedBamHeader(headerDict):
     return ret
 
 
+def getReadAlignmentStart(gaAlignment):
+    """
+    Returns the start coordinate of the specified GA4GH ReadAlignment,
+    which is the mate position for unmapped reads with a mapped mate
+    (see SAM standard 2.4.1).
+    """
+    if gaAlignment.alignment.position.position == 0:
+        return gaAlignment.next_mate_position.position
+    else:
+        return gaAlignment.alignment.position.position
+
+
 class SamCigar(object):
     """
     Utility class for working with SAM CIGAR strings
@@ -94,114 +106,237 @@ class SamFlags(object):
         return flagAttr | flag
 
 
+def _decodeSamFlag(flag):
+    """
+    Returns the tuple of GA4GH ReadAlignment values given by the specified
+    SAM flag; see ReadAlignmentConverter.
+    """
+    readNumber = -1
+    if SamFlags.isFlagSet(flag, SamFlags.FIRST_IN_PAIR):
+        if SamFlags.isFlagSet(flag, SamFlags.SECOND_IN_PAIR):
+            readNumber = 2
+        else:
+            readNumber = 0
+    elif SamFlags.isFlagSet(flag, SamFlags.SECOND_IN_PAIR):
+        readNumber = 1
+    strand = protocol.POS_STRAND
+    if SamFlags.isFlagSet(flag, SamFlags.READ_REVERSE_STRAND):
+        strand = protocol.NEG_STRAND
+    mateStrand = protocol.POS_STRAND
+    if SamFlags.isFlagSet(flag, SamFlags.MATE_REVERSE_STRAND):
+        mateStrand = protocol.NEG_STRAND
+    numberReads = 1
+    if SamFlags.isFlagSet(flag, SamFlags.READ_PAIRED):
+        numberReads = 2
+    return (
+        SamFlags.isFlagSet(flag, SamFlags.READ_UNMAPPED), strand,
+        SamFlags.isFlagSet(flag, SamFlags.MATE_UNMAPPED), mateStrand,
+        SamFlags.isFlagSet(flag, SamFlags.DUPLICATE_READ),
+        SamFlags.isFlagSet(flag, SamFlags.FAILED_QUALITY_CHECK),
+        numberReads, readNumber,
+        not SamFlags.isFlagSet(flag, SamFlags.READ_PROPER_PAIR),
+        SamFlags.isFlagSet(flag, SamFlags.SECONDARY_ALIGNMENT),
+        SamFlags.isFlagSet(flag, SamFlags.SUPPLEMENTARY_ALIGNMENT))
+
+
+class ReadAlignmentConverter(object):
+    """
+    Converts the pysam reads fetched from an open alignment file into
+    GA4GH ReadAlignments in the specified read group set. The reference
+    names of the file and the compound ID of the read group set are
+    looked up once, when the converter is created, and the values given
+    by each SAM flag are taken from a table rather than decoded bit by
+    bit for every read. The repeated and message fields outside the
+    FieldMask used are never filled in.
+    """
+    # The decoded values of every SAM flag, indexed by flag.
+    _flagValues = [_decodeSamFlag(flag) for flag in range(0x1000)]
+
+    def __init__(self, samFile, readGroupSet):
+        self._referenceNames = samFile.references
+        self._readGroupSetCompoundId = readGroupSet.getCompoundId()
+
+    def convert(self, read, readGroupId, fieldMask=protocol.ALL_FIELDS):
+        """
+        Returns the GA4GH ReadAlignment for the specified pysam read in
+        the read group with the specified ID, with the fields in the
+        specified FieldMask.
+        """
+        (unmapped, strand, mateUnmapped, mateStrand, duplicate,
+            failedQualityCheck, numberReads, readNumber, improperPlacement,
+            secondary, supplementary) = self._flagValues[read.flag & 0xfff]
+        # TODO fill out remaining fields
+        ret = protocol.ReadAlignment()
+        if fieldMask.includes("aligned_quality"):
+            ret.aligned_quality.extend(read.query_qualities)
+        if fieldMask.includes("aligned_sequence"):
+            ret.aligned_sequence = read.query_sequence
+        if not unmapped and fieldMask.includes("alignment"):
+            alignment = ret.alignment
+            alignment.mapping_quality = read.mapping_quality
+            position = alignment.position
+            position.reference_name = self._referenceNames[read.reference_id]
+            position.position = read.reference_start
+            position.strand = strand
+            cigar = alignment.cigar
+            cigarStrings = SamCigar.cigarStrings
+            for operation, length in read.cigar:
+                # TODO fill in the reference sequence
+                cigar.add(
+                    operation=cigarStrings[operation],
+                    operation_length=length)
+        ret.duplicate_fragment = duplicate
+        ret.failed_vendor_quality_checks = failedQualityCheck
+        ret.fragment_length = read.template_length
+        ret.fragment_name = read.query_name
+        if fieldMask.includes("info"):
+            info = ret.info
+            for key, value in read.tags:
+                info[key].values.add().string_value = str(value)
+        if fieldMask.includes("next_mate_position"):
+            nextMatePosition = ret.next_mate_position
+            if mateUnmapped:
+                nextMatePosition.SetInParent()
+            else:
+                if read.next_reference_id != -1:
+                    nextMatePosition.reference_name = self._referenceNames[
+                        read.next_reference_id]
+                nextMatePosition.position = read.next_reference_start
+                nextMatePosition.strand = mateStrand
+        ret.number_reads = numberReads
+        ret.read_number = readNumber
+        ret.improper_placement = improperPlacement
+        ret.read_group_id = readGroupId
+        ret.secondary_alignment = secondary
+        ret.supplementary_alignment = supplementary
+        if fieldMask.includes("id"):
+            ret.id = str(datamodel.ReadAlignmentCompoundId(
+                self._readGroupSetCompoundId, read.query_name))
+        return fieldMask.apply(ret)
+
+
 class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
     """
     Mixin class that provides methods for getting read alignments
     from bam files
     """
+    # The converter for reads from the file, which is created when the
+    # file is first read.
+    _readAlignmentConverter = None
+
     def _getReadAlignments(
             self, reference, start, end, readGroupSet, readGroup):
         """
         Returns an iterator over the specified reads
         """
+        for _, record in self._getReadAlignmentRecords(
+                reference, start, end, readGroupSet, readGroup):
+            yield self.convertReadAlignmentRecord(record)
+
+    def _getReadAlignmentRecords(
+            self, reference, start, end, readGroupSet, readGroup):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        reads, where record is a (pysam read, readGroupId, converter)
+        tuple that can be converted to a GA4GH ReadAlignment using
+        convertReadAlignmentRecord. The start coordinate is the same as
+        that of the converted ReadAlignment, so that callers can position
+        themselves within the iteration without converting every read.
+        """
         # TODO If reference is None, return against all references,
         # including unmapped reads.
-        samFile = self.getFileHandle(self._dataUrl)
         referenceName = reference.getLocalId().encode()
         # TODO deal with errors from htslib
         start, end = self.sanitizeAlignmentFileFetch(start, end)
+        # The handle is checked out for as long as the caller holds this
+        # iterator, so that no other search moves it or closes it.
+        samFile = self.checkOutFileHandle(self._dataUrl)
+        records = self.prefetchRecords(self._getSamFileRecords(
+            samFile, readGroupSet, readGroup, referenceName, start, end))
+        try:
+            for record in records:
+                yield record
+        finally:
+            records.close()
+            self.checkInFileHandle(samFile)
+
+    def _getSamFileRecords(
+            self, samFile, readGroupSet, readGroup, referenceName,
+            start, end):
+        """
+        Returns an iterator over (start, record) pairs for the reads in
+        the specified region of the open samFile.
+        """
+        converter = self._getReadAlignmentConverter(samFile, readGroupSet)
+        if readGroup is not None:
+            readGroupId = str(readGroup.getCompoundId())
+        # pysam 0.9 only accepts tag names as byte strings.
+        readGroupTag = str("RG")
         readAlignments = samFile.fetch(referenceName, start, end)
         for readAlignment in readAlignments:
-            tags = dict(readAlignment.tags)
             if readGroup is None:
-                if 'RG' in tags:
-                    alignmentReadGroupLocalId = tags['RG']
-                    readGroupCompoundId = datamodel.ReadGroupCompoundId(
+                if readAlignment.has_tag(readGroupTag):
+                    readGroupId = str(datamodel.ReadGroupCompoundId(
                         readGroupSet.getCompoundId(),
-                        str(alignmentReadGroupLocalId))
-                yield self.convertReadAlignment(
-                    readAlignment, readGroupSet, str(readGroupCompoundId))
-            else:
-                if self._filterReads:
-                    if 'RG' in tags and tags['RG'] == self._localId:
-                        yield self.convertReadAlignment(
-                            readAlignment, readGroupSet,
-                            str(readGroup.getCompoundId()))
-                else:
-                    yield self.convertReadAlignment(
-                        readAlignment, readGroupSet,
-                        str(readGroup.getCompoundId()))
-
-    def convertReadAlignment(self, read, readGroupSet, readGroupId):
-        """
-        Convert a pysam ReadAlignment to a GA4GH ReadAlignment
-        """
-        samFile = self.getFileHandle(self._dataUrl)
-        # TODO fill out remaining fields
-        # TODO refine in tandem with code in converters module
-        ret = protocol.ReadAlignment()
-        # ret.fragmentId = 'TODO'
-        ret.aligned_quality.extend(read.query_qualities)
-        ret.aligned_sequence = read.query_sequence
-        if SamFlags.isFlagSet(read.flag, SamFlags.READ_UNMAPPED):
-            ret.ClearField("alignment")
-        else:
-            ret.alignment.CopyFrom(protocol.LinearAlignment())
-            ret.alignment.mapping_quality = read.mapping_quality
-            ret.alignment.position.CopyFrom(protocol.Position())
-            ret.alignment.position.reference_name = samFile.getrname(
-                read.reference_id)
-            ret.alignment.position.position = read.reference_start
-            ret.alignment.position.strand = protocol.POS_STRAND
-            if SamFlags.isFlagSet(read.flag, SamFlags.READ_REVERSE_STRAND):
-                ret.alignment.position.strand = protocol.NEG_STRAND
-            for operation, length in read.cigar:
-                gaCigarUnit = ret.alignment.cigar.add()
-                gaCigarUnit.operation = SamCigar.int2ga(operation)
-                gaCigarUnit.operation_length = length
-                gaCigarUnit.reference_sequence = ""  # TODO fix this!
-        ret.duplicate_fragment = SamFlags.isFlagSet(
-            read.flag, SamFlags.DUPLICATE_READ)
-        ret.failed_vendor_quality_checks = SamFlags.isFlagSet(
-            read.flag, SamFlags.FAILED_QUALITY_CHECK)
-        ret.fragment_length = read.template_length
-        ret.fragment_name = read.query_name
-        for key, value in read.tags:
-            ret.info[key].values.add().string_value = str(value)
-        if SamFlags.isFlagSet(read.flag, SamFlags.MATE_UNMAPPED):
-            ret.next_mate_position.Clear()
-        else:
-            ret.next_mate_position.Clear()
-            if read.next_reference_id != -1:
-                ret.next_mate_position.reference_name = samFile.getrname(
-                    read.next_reference_id)
-            else:
-                ret.next_mate_position.reference_name = ""
-            ret.next_mate_position.position = read.next_reference_start
-            ret.next_mate_position.strand = protocol.POS_STRAND
-            if SamFlags.isFlagSet(read.flag, SamFlags.MATE_REVERSE_STRAND):
-                ret.next_mate_position.strand = protocol.NEG_STRAND
-        if SamFlags.isFlagSet(read.flag, SamFlags.READ_PAIRED):
-            ret.number_reads = 2
-        else:
-            ret.number_reads = 1
-        ret.read_number = -1
-        if SamFlags.isFlagSet(read.flag, SamFlags.FIRST_IN_PAIR):
-            if SamFlags.isFlagSet(read.flag, SamFlags.SECOND_IN_PAIR):
-                ret.read_number = 2
-            else:
-                ret.read_number = 0
-        elif SamFlags.isFlagSet(read.flag, SamFlags.SECOND_IN_PAIR):
-            ret.read_number = 1
-        ret.improper_placement = not SamFlags.isFlagSet(
-            read.flag, SamFlags.READ_PROPER_PAIR)
-        ret.read_group_id = readGroupId
-        ret.secondary_alignment = SamFlags.isFlagSet(
-            read.flag, SamFlags.SECONDARY_ALIGNMENT)
-        ret.supplementary_alignment = SamFlags.isFlagSet(
-            read.flag, SamFlags.SUPPLEMENTARY_ALIGNMENT)
-        ret.id = readGroupSet.getReadAlignmentId(ret)
-        return ret
+                        str(readAlignment.get_tag(readGroupTag))))
+                yield self._getPysamReadStart(readAlignment), (
+                    readAlignment, readGroupId, converter)
+            elif not self._filterReads or (
+                    readAlignment.has_tag(readGroupTag) and
+                    readAlignment.get_tag(readGroupTag) == self._localId):
+                yield self._getPysamReadStart(readAlignment), (
+                    readAlignment, readGroupId, converter)
+
+    def _getPysamReadStart(self, read):
+        """
+        Returns the start coordinate that the GA4GH ReadAlignment
+        converted from the specified pysam read will have: the alignment
+        position, or the mate position for unmapped reads with a mapped
+        mate (see SAM standard 2.4.1).
+        """
+        unmapped, _, mateUnmapped = ReadAlignmentConverter._flagValues[
+            read.flag & 0xfff][:3]
+        position = 0
+        if not unmapped:
+            position = read.reference_start
+        if position == 0 and not mateUnmapped:
+            position = read.next_reference_start
+        return position
+
+    def _getReadAlignmentConverter(self, samFile, readGroupSet):
+        """
+        Returns the ReadAlignmentConverter for reads from the specified
+        open samFile in the specified read group set, which is created
+        on the first call and then reused.
+        """
+        if self._readAlignmentConverter is None:
+            self._readAlignmentConverter = ReadAlignmentConverter(
+                samFile, readGroupSet)
+        return self._readAlignmentConverter
+
+    def convertReadAlignment(
+            self, read, readGroupSet, readGroupId,
+            fieldMask=protocol.ALL_FIELDS):
+        """
+        Convert a pysam ReadAlignment to a GA4GH ReadAlignment with the
+        fields in the specified FieldMask.
+        """
+        converter = self._readAlignmentConverter
+        if converter is None:
+            with self.fileHandle(self._dataUrl) as samFile:
+                converter = self._getReadAlignmentConverter(
+                    samFile, readGroupSet)
+        return converter.convert(read, readGroupId, fieldMask)
+
+    def convertReadAlignmentRecord(
+            self, record, fieldMask=protocol.ALL_FIELDS):
+        """
+        Converts the specified record returned by getReadAlignmentRecords
+        into a GA4GH ReadAlignment with the fields in the specified
+        FieldMask.
+        """
+        read, readGroupId, converter = record
+        return converter.convert(read, readGroupId, fieldMask)
 
     def openFile(self, dataFile):
         # We need to check to see if the path exists here as pysam does
@@ -210,7 +345,8 @@ class AlignmentDataMixin(datamodel.PysamDatamodelMixin):
             raise exceptions.FileOpenFailedException(self._indexFile)
         try:
             return pysam.AlignmentFile(
-                self._dataUrl, filepath_index=self._indexFile)
+                self._dataUrl, filepath_index=self._indexFile,
+                **self.getPysamOpenOptions())
         except IOError as exception:
             # IOError thrown when the index file passed in is not actually
             # an index file... may also happen in other cases?
@@ -312,6 +448,25 @@ class AbstractReadGroupSet(datamodel.DatamodelObject):
             self.getCompoundId(), gaAlignment.fragment_name)
         return str(compoundId)
 
+    def getReadAlignmentRecords(self, reference, start=None, end=None):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        reads. Records are converted to GA4GH ReadAlignments using
+        convertReadAlignmentRecord; by default, records are already
+        converted.
+        """
+        for alignment in self.getReadAlignments(reference, start, end):
+            yield getReadAlignmentStart(alignment), alignment
+
+    def convertReadAlignmentRecord(
+            self, record, fieldMask=protocol.ALL_FIELDS):
+        """
+        Returns the GA4GH ReadAlignment for the specified record returned
+        by getReadAlignmentRecords, with the fields in the specified
+        FieldMask.
+        """
+        return fieldMask.apply(record)
+
     def getStats(self):
         """
         Returns the GA4GH protocol representation of this read group set's
@@ -373,6 +528,14 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         """
         return self._getReadAlignments(reference, start, end, self, None)
 
+    def getReadAlignmentRecords(self, reference, start=None, end=None):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        reads, without converting them to GA4GH ReadAlignments.
+        """
+        return self._getReadAlignmentRecords(
+            reference, start, end, self, None)
+
     def getBamHeaderReferenceSetName(self):
         """
         Returns the ReferenceSet name using in the BAM header.
@@ -405,30 +568,30 @@ class HtslibReadGroupSet(AlignmentDataMixin, AbstractReadGroupSet):
         self._indexFile = indexFile
         if indexFile is None:
             self._indexFile = dataUrl + ".bai"
-        samFile = self.getFileHandle(self._dataUrl)
-        self._setHeaderFields(samFile)
-        if 'RG' not in samFile.header or len(samFile.header['RG']) == 0:
-            readGroup = HtslibReadGroup(self, self.defaultReadGroupName)
-            self.addReadGroup(readGroup)
-        else:
-            for readGroupHeader in samFile.header['RG']:
-                readGroup = HtslibReadGroup(self, readGroupHeader['ID'])
-                readGroup.populateFromHeader(readGroupHeader)
+        with self.fileHandle(self._dataUrl) as samFile:
+            self._setHeaderFields(samFile)
+            if 'RG' not in samFile.header or len(samFile.header['RG']) == 0:
+                readGroup = HtslibReadGroup(self, self.defaultReadGroupName)
                 self.addReadGroup(readGroup)
-        self._bamHeaderReferenceSetName = None
-        for referenceInfo in samFile.header['SQ']:
-            if 'AS' not in referenceInfo:
-                infoDict = parseMalformedBamHeader(referenceInfo)
             else:
-                infoDict = referenceInfo
-            name = infoDict.get('AS', references.DEFAULT_REFERENCESET_NAME)
-            if self._bamHeaderReferenceSetName is None:
-                self._bamHeaderReferenceSetName = name
-            elif self._bamHeaderReferenceSetName != name:
-                raise exceptions.MultipleReferenceSetsInReadGroupSet(
-                    self._dataUrl, name, self._bamFileReferenceName)
-        self._numAlignedReads = samFile.mapped
-        self._numUnalignedReads = samFile.unmapped
+                for readGroupHeader in samFile.header['RG']:
+                    readGroup = HtslibReadGroup(self, readGroupHeader['ID'])
+                    readGroup.populateFromHeader(readGroupHeader)
+                    self.addReadGroup(readGroup)
+            self._bamHeaderReferenceSetName = None
+            for referenceInfo in samFile.header['SQ']:
+                if 'AS' not in referenceInfo:
+                    infoDict = parseMalformedBamHeader(referenceInfo)
+                else:
+                    infoDict = referenceInfo
+                name = infoDict.get('AS', references.DEFAULT_REFERENCESET_NAME)
+                if self._bamHeaderReferenceSetName is None:
+                    self._bamHeaderReferenceSetName = name
+                elif self._bamHeaderReferenceSetName != name:
+                    raise exceptions.MultipleReferenceSetsInReadGroupSet(
+                        self._dataUrl, name, self._bamFileReferenceName)
+            self._numAlignedReads = samFile.mapped
+            self._numUnalignedReads = samFile.unmapped
 
     def checkConsistency(self, dataRepository):
         pass
@@ -485,6 +648,25 @@ class AbstractReadGroup(datamodel.DatamodelObject):
         self._updateTime = now
         self._bioSampleId = None
 
+    def getReadAlignmentRecords(self, reference, start=None, end=None):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        reads. Records are converted to GA4GH ReadAlignments using
+        convertReadAlignmentRecord; by default, records are already
+        converted.
+        """
+        for alignment in self.getReadAlignments(reference, start, end):
+            yield getReadAlignmentStart(alignment), alignment
+
+    def convertReadAlignmentRecord(
+            self, record, fieldMask=protocol.ALL_FIELDS):
+        """
+        Returns the GA4GH ReadAlignment for the specified record returned
+        by getReadAlignmentRecords, with the fields in the specified
+        FieldMask.
+        """
+        return fieldMask.apply(record)
+
     def toProtocolElement(self):
         """
         Returns the GA4GH protocol representation of this ReadGroup.
@@ -770,6 +952,14 @@ class HtslibReadGroup(AlignmentDataMixin, AbstractReadGroup):
         return self._getReadAlignments(
             reference, start, end, self._parentContainer, self)
 
+    def getReadAlignmentRecords(self, reference, start=None, end=None):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        reads, without converting them to GA4GH ReadAlignments.
+        """
+        return self._getReadAlignmentRecords(
+            reference, start, end, self._parentContainer, self)
+
     def getPrograms(self):
         return self._parentContainer.getPrograms()
 
@@ -8,6 +8,9 @@ from __future__ import unicode_literals
 
 import hashlib
 import json
+import mmap
+import multiprocessing
+import os
 import random
 
 import pysam
@@ -38,6 +41,12 @@ class AbstractReferenceSet(datamodel.DatamodelObject):
         self._referenceIdMap = {}
         self._referenceNameMap = {}
         self._referenceIds = []
+        self._referenceIndex = datamodel.DatamodelObjectIndex(
+            self.getReferences, {
+                "md5checksum": lambda reference: [
+                    reference.getMd5Checksum()],
+                "accession": lambda reference: (
+                    reference.getSourceAccessions())})
         self._assemblyId = None
         self._description = None
         self._isDerived = False
@@ -53,6 +62,7 @@ class AbstractReferenceSet(datamodel.DatamodelObject):
         self._referenceIdMap[id_] = reference
         self._referenceNameMap[reference.getLocalId()] = reference
         self._referenceIds.append(id_)
+        self._referenceIndex.invalidate()
 
     def setDescription(self, description):
         """
@@ -97,6 +107,15 @@ class AbstractReferenceSet(datamodel.DatamodelObject):
         """
         return [self._referenceIdMap[id_] for id_ in self._referenceIds]
 
+    def searchReferences(self, md5checksum=None, accession=None):
+        """
+        Returns the list of References in this ReferenceSet with the
+        specified MD5 checksum and source accession; empty values match
+        any Reference.
+        """
+        return self._referenceIndex.search(
+            md5checksum=md5checksum, accession=accession)
+
     def getNumReferences(self):
         """
         Returns the number of references in this ReferenceSet.
@@ -350,6 +369,16 @@ class AbstractReference(datamodel.DatamodelObject):
         """
         raise NotImplemented()
 
+    def getBasesChunks(self, start, end, chunkSize):
+        """
+        Returns an iterator over the bases of this reference from start
+        (inclusive) to end (exclusive), as strings of at most chunkSize
+        bases.
+        """
+        self.checkQueryRange(start, end)
+        for chunkStart in range(start, end, chunkSize):
+            yield self.getBases(chunkStart, min(chunkStart + chunkSize, end))
+
 ##################################################################
 #
 # Simulated references
@@ -419,6 +448,120 @@ class SimulatedReference(AbstractReference):
 ##################################################################
 
 
+class MmapFastaFile(object):
+    """
+    Read-only access to an uncompressed FASTA file with a faidx index,
+    through a memory map. Slices of a reference are read straight from
+    the page cache, rather than through pysam.
+    """
+    def __init__(self, dataFile):
+        self._index = {}
+        with open(dataFile + ".fai") as indexFile:
+            for line in indexFile:
+                fields = line.split("\t")
+                # length, offset, bases per line, bytes per line
+                self._index[fields[0]] = tuple(map(int, fields[1:5]))
+        with open(dataFile, "rb") as fastaFile:
+            self._mmap = mmap.mmap(
+                fastaFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def isSupported(dataFile):
+        """
+        Returns True if the specified FASTA file is uncompressed and has a
+        faidx index, and so can be memory mapped.
+        """
+        if not os.path.exists(dataFile + ".fai"):
+            return False
+        with open(dataFile, "rb") as fastaFile:
+            return fastaFile.read(2) != b"\x1f\x8b"
+
+    def _getFileOffset(self, referenceName, position):
+        _, offset, lineBases, lineWidth = self._index[referenceName]
+        return (
+            offset + (position // lineBases) * lineWidth +
+            position % lineBases)
+
+    def fetch(self, referenceName, start, end):
+        """
+        Returns the bases of the specified reference from start (inclusive)
+        to end (exclusive).
+        """
+        data = self._mmap[
+            self._getFileOffset(referenceName, start):
+            self._getFileOffset(referenceName, end)]
+        return data.replace(b"\n", b"").replace(b"\r", b"")
+
+    def close(self):
+        self._mmap.close()
+
+
+MD5_CHUNK_SIZE = 2**20
+"""
+The number of bases read at a time when computing reference MD5 checksums.
+"""
+
+CHECKSUM_FILE_SUFFIX = ".md5"
+"""
+Suffix of the sidecar file, next to a FASTA file and its .fai index, in
+which the length and MD5 checksum of each reference are cached. The
+first line holds the size and modification time of the FASTA file from
+which the checksums were computed.
+"""
+
+
+def _computeReferenceChecksum(task):
+    """
+    Returns a (referenceName, md5checksum, length) tuple for the specified
+    (dataUrl, referenceName, length) task, reading the bases in chunks of
+    MD5_CHUNK_SIZE. This is a module level function so that it can be
+    run in a multiprocessing pool.
+    """
+    dataUrl, referenceName, length = task
+    fastaFile = pysam.FastaFile(dataUrl)
+    try:
+        md5 = hashlib.md5()
+        for start in range(0, length, MD5_CHUNK_SIZE):
+            md5.update(fastaFile.fetch(
+                referenceName, start, min(start + MD5_CHUNK_SIZE, length)))
+    finally:
+        fastaFile.close()
+    return referenceName, md5.hexdigest(), length
+
+
+def readChecksumFile(checksumFile, fastaFileStat):
+    """
+    Returns a dictionary mapping reference names to (md5checksum, length)
+    tuples, read from the specified checksum sidecar file. This is empty
+    if the sidecar file was not written for a FASTA file with the size
+    and modification time in the specified os.stat result.
+    """
+    checksums = {}
+    with open(checksumFile) as checksumFileHandle:
+        header = checksumFileHandle.readline().rstrip("\n").split("\t")
+        if header != ["#", str(fastaFileStat.st_size),
+                      repr(fastaFileStat.st_mtime)]:
+            return checksums
+        for line in checksumFileHandle:
+            referenceName, length, md5checksum = line.rstrip("\n").split("\t")
+            checksums[referenceName] = md5checksum, int(length)
+    return checksums
+
+
+def writeChecksumFile(checksumFile, fastaFileStat, checksums):
+    """
+    Writes the specified list of (referenceName, md5checksum, length)
+    tuples to the specified checksum sidecar file, for the FASTA file
+    with the size and modification time in the specified os.stat result.
+    """
+    with open(checksumFile, "w") as checksumFileHandle:
+        checksumFileHandle.write("#\t{}\t{!r}\n".format(
+            fastaFileStat.st_size, fastaFileStat.st_mtime))
+        for referenceName, md5checksum, length in checksums:
+            checksumFileHandle.write("{}\t{}\t{}\n".format(
+                referenceName, length, md5checksum))
+
+
 class HtslibReferenceSet(datamodel.PysamDatamodelMixin, AbstractReferenceSet):
     """
     A referenceSet based on data on a file system
@@ -426,23 +569,58 @@ class HtslibReferenceSet(datamodel.PysamDatamodelMixin, AbstractReferenceSet):
     def __init__(self, localId):
         super(HtslibReferenceSet, self).__init__(localId)
         self._dataUrl = None
+        self._mmapFastaFile = None
+        self._mmapChecked = False
 
-    def populateFromFile(self, dataUrl):
+    def populateFromFile(
+            self, dataUrl, numProcesses=1, useChecksumFile=False):
         """
         Populates the instance variables of this ReferencSet from the
-        data URL.
+        data URL. The MD5 checksums of the references are computed using
+        the specified number of processes. If useChecksumFile is True,
+        checksums are reused from the sidecar file next to the FASTA file
+        where they are present, the reference lengths agree and the FASTA
+        file has not changed since the sidecar file was written, which is
+        rewritten if any checksums are computed.
         """
         self._dataUrl = dataUrl
-        fastaFile = self.getFastaFile()
-        for referenceName in fastaFile.references:
+        with self.getFastaFile() as fastaFile:
+            referenceNames = fastaFile.references
+            referenceLengths = dict(zip(referenceNames, fastaFile.lengths))
+        checksumFile = dataUrl + CHECKSUM_FILE_SUFFIX
+        fastaFileStat = os.stat(dataUrl)
+        knownChecksums = {}
+        if useChecksumFile and os.path.exists(checksumFile):
+            knownChecksums = readChecksumFile(checksumFile, fastaFileStat)
+        checksums = {}
+        tasks = []
+        for referenceName in referenceNames:
+            known = knownChecksums.get(referenceName)
+            length = referenceLengths[referenceName]
+            if known is not None and known[1] == length:
+                checksums[referenceName] = known
+            else:
+                tasks.append((dataUrl, referenceName, length))
+        if numProcesses > 1 and len(tasks) > 1:
+            pool = multiprocessing.Pool(numProcesses)
+            try:
+                results = pool.map(_computeReferenceChecksum, tasks)
+            finally:
+                pool.terminate()
+        else:
+            results = map(_computeReferenceChecksum, tasks)
+        for referenceName, md5checksum, length in results:
+            checksums[referenceName] = md5checksum, length
+        for referenceName in referenceNames:
+            md5checksum, length = checksums[referenceName]
             reference = HtslibReference(self, referenceName)
-            # TODO break this up into chunks and calculate the MD5
-            # in bits (say, 64K chunks?)
-            bases = fastaFile.fetch(referenceName)
-            md5checksum = hashlib.md5(bases).hexdigest()
             reference.setMd5checksum(md5checksum)
-            reference.setLength(len(bases))
+            reference.setLength(length)
             self.addReference(reference)
+        if useChecksumFile and len(tasks) > 0:
+            writeChecksumFile(checksumFile, fastaFileStat, [
+                (referenceName,) + checksums[referenceName]
+                for referenceName in referenceNames])
 
     def populateFromRow(self, row):
         """
@@ -469,10 +647,22 @@ class HtslibReferenceSet(datamodel.PysamDatamodelMixin, AbstractReferenceSet):
 
     def getFastaFile(self):
         """
-        Returns a reference to the Fasta file instance used to read the
-        data in this reference set.
+        Returns a context manager for the Fasta file instance used to
+        read the data in this reference set, which is checked out of the
+        file handle cache for the duration of the with block.
+        """
+        return self.fileHandle(self._dataUrl)
+
+    def getMmapFastaFile(self):
+        """
+        Returns a MmapFastaFile for the data in this reference set, or
+        None if the FASTA file is compressed or not indexed.
         """
-        return self.getFileHandle(self._dataUrl)
+        if not self._mmapChecked:
+            if MmapFastaFile.isSupported(self._dataUrl):
+                self._mmapFastaFile = MmapFastaFile(self._dataUrl)
+            self._mmapChecked = True
+        return self._mmapFastaFile
 
 
 class HtslibReference(datamodel.PysamDatamodelMixin, AbstractReference):
@@ -496,8 +686,11 @@ class HtslibReference(datamodel.PysamDatamodelMixin, AbstractReference):
 
     def getBases(self, start, end):
         self.checkQueryRange(start, end)
-        fastaFile = self._parentContainer.getFastaFile()
         localId = self.getLocalId().encode()
-        # TODO we should have some error checking here...
-        bases = fastaFile.fetch(localId, start, end)
+        mmapFastaFile = self._parentContainer.getMmapFastaFile()
+        if mmapFastaFile is not None:
+            return mmapFastaFile.fetch(localId, start, end)
+        with self._parentContainer.getFastaFile() as fastaFile:
+            # TODO we should have some error checking here...
+            bases = fastaFile.fetch(localId, start, end)
         return bases
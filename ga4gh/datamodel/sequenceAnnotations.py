@@ -55,7 +55,36 @@ _featureColumns = [
     ('name', 'TEXT'),  # the "ID" as found in GFF3, or '' if none
     ('gene_name', 'TEXT'),  # as found in GFF3 attributes
     ('transcript_name', 'TEXT'),  # as found in GFF3 attributes
-    ('attributes', 'TEXT')]  # JSON encoding of attributes dict
+    ('attributes', 'TEXT'),  # JSON encoding of attributes dict
+    ('bin', 'INT')]  # UCSC bin of [start, end); absent in older DBs
+
+
+def getFeaturePageToken(feature):
+    """
+    Returns the page token that resumes a features search immediately
+    after the specified feature DB record.
+    """
+    # The reference name goes last as it may itself contain colons.
+    return "{}:{}:{}:{}".format(
+        feature['start'], feature['end'], feature['id'],
+        feature['reference_name'])
+
+
+def parseFeaturePageToken(pageToken):
+    """
+    Parses a page token returned by getFeaturePageToken into a
+    (referenceName, start, end, featureId) tuple.
+    """
+    tokens = pageToken.split(":", 3)
+    if len(tokens) != 4:
+        msg = "Invalid number of values in page token"
+        raise exceptions.BadPageTokenException(msg)
+    try:
+        start, end, featureId = map(int, tokens[:3])
+    except ValueError:
+        msg = "Malformed integers in page token"
+        raise exceptions.BadPageTokenException(msg)
+    return tokens[3], start, end, featureId
 
 
 class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
@@ -70,37 +99,37 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
     requests one on each side of the join (position 0)
     """
 
+    # Regions longer than this are read in position order rather than
+    # gathered from their bins and sorted.
+    binnedQueryMaxLength = 2**23
+
     def __init__(self, dbFile):
         super(Gff3DbBackend, self).__init__(dbFile)
         self.featureColumnNames = [f[0] for f in _featureColumns]
         self.featureColumnTypes = [f[1] for f in _featureColumns]
+        self._binned = None
 
-    def countFeaturesSearchInDb(
-            self, referenceName=None, start=None, end=None,
-            parentId=None, featureTypes=None,
-            name=None, geneSymbol=None):
+    def isBinned(self):
         """
-        Same parameters as searchFeaturesInDb,
-        except without the pagetoken/size.
+        Returns True if the FEATURE table has a bin column, so that range
+        queries can be answered through the bin index.
         """
-        _, sql, sql_args = self.featuresQuery(
-            pageToken=None, pageSize=None,
-            referenceName=referenceName, start=start, end=end,
-            parentId=parentId, featureTypes=featureTypes,
-            name=name, geneSymbol=geneSymbol)
-        query = self._dbconn.execute(sql, sql_args)
-        return (query.fetchone())[0]
+        if self._binned is None:
+            columns = self._dbconn.execute(
+                "PRAGMA table_info(FEATURE)").fetchall()
+            self._binned = any(column[1] == 'bin' for column in columns)
+        return self._binned
 
     def featuresQuery(self, **kwargs):
         """
         Converts a dictionary of keyword arguments into a tuple
-        of SQL select statements, the list of SQL arguments, and
-        a SQL count statement.
+        of a SQL select statement and the list of SQL arguments.
+        Rows are returned in (reference_name, start, end, id) order; if
+        a pageToken is given, only rows following the feature it was
+        issued for are selected.
         """
         # TODO: Optimize by refactoring out string concatenation
-        sql = ""
-        sql_rows = "SELECT * FROM FEATURE WHERE id > 1 "
-        sql_count = "SELECT COUNT(*) FROM FEATURE WHERE id > 1 "
+        sql = "SELECT * FROM FEATURE WHERE id > 1 "
         sql_args = ()
         if 'name' in kwargs and kwargs['name']:
             sql += "AND name = ? "  # compare this to query start
@@ -108,14 +137,36 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
         if 'geneSymbol' in kwargs and kwargs['geneSymbol']:
             sql += "AND gene_name = ? "  # compare this to query start
             sql_args += (kwargs.get('geneSymbol'),)
+        useBins = (
+            kwargs.get('referenceName') and
+            kwargs.get('start') is not None and
+            kwargs.get('end') is not None and
+            int(kwargs['end']) - int(kwargs['start']) <=
+            self.binnedQueryMaxLength and
+            self.isBinned())
         if 'start' in kwargs and kwargs['start'] is not None:
             sql += "AND end > ? "  # compare this to query start
             sql_args += (kwargs.get('start'),)
         if 'end' in kwargs and kwargs['end'] is not None:
-            sql += "AND start < ? "  # and this to query end
+            # The unary + stops the planner from answering a bin query
+            # by scanning the position index up to the query end.
+            if useBins:
+                sql += "AND +start < ? "
+            else:
+                sql += "AND start < ? "  # and this to query end
             sql_args += (kwargs.get('end'),)
+        if useBins:
+            # Restrict to the bins that can overlap the query region,
+            # so the (reference_name, bin) index can be used.
+            binRanges = sqliteBackend.getBinRanges(
+                int(kwargs['start']), int(kwargs['end']))
+            sql += "AND ("
+            sql += " OR ".join(["bin BETWEEN ? AND ?", ] * len(binRanges))
+            sql += ") "
+            for binRange in binRanges:
+                sql_args += binRange
         if 'referenceName' in kwargs and kwargs['referenceName']:
-            sql += "AND reference_name = ?"
+            sql += "AND reference_name = ? "
             sql_args += (kwargs.get('referenceName'),)
         if 'parentId' in kwargs and kwargs['parentId']:
             sql += "AND parent_id = ? "
@@ -126,20 +177,42 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
             sql += ", ".join(["?", ] * len(kwargs.get('featureTypes')))
             sql += ") "
             sql_args += tuple(kwargs.get('featureTypes'))
-        sql_rows += sql
-        sql_rows += "ORDER BY reference_name, start, end ASC "
-        sql_count += sql
-        return sql_rows, sql_count, sql_args
+        if kwargs.get('pageToken'):
+            referenceName, start, end, featureId = parseFeaturePageToken(
+                kwargs['pageToken'])
+            # Expanded form of the row value comparison
+            # (reference_name, start, end, id) > (?, ?, ?, ?), led by
+            # a redundant bound that the position index can seek to.
+            if referenceName == kwargs.get('referenceName'):
+                sql += (
+                    "AND start >= ? AND (start > ? OR (start = ? AND "
+                    "(end > ? OR (end = ? AND id > ?)))) ")
+                sql_args += (start, start, start, end, end, featureId)
+            else:
+                sql += (
+                    "AND reference_name >= ? AND "
+                    "(reference_name > ? OR (reference_name = ? AND "
+                    "(start > ? OR (start = ? AND "
+                    "(end > ? OR (end = ? AND id > ?)))))) ")
+                sql_args += (
+                    referenceName, referenceName, referenceName,
+                    start, start, end, end, featureId)
+        sql += "ORDER BY reference_name, start, end, id ASC "
+        if kwargs.get('pageSize') is not None:
+            sql += "LIMIT ? "
+            sql_args += (int(kwargs['pageSize']),)
+        return sql, sql_args
 
     def searchFeaturesInDb(
-            self, pageToken=0, pageSize=None,
+            self, pageToken=None, pageSize=None,
             referenceName=None, start=None, end=None,
             parentId=None, featureTypes=None,
             name=None, geneSymbol=None):
         """
         Perform a full features query in database.
 
-        :param pageToken: int representing first record to return
+        :param pageToken: None, or a token from getFeaturePageToken for
+            the feature that the returned records follow
         :param pageSize: int representing number of records to return
         :param referenceName: string representing reference name, ex 'chr1'
         :param start: int position on reference to start search
@@ -149,13 +222,11 @@ class Gff3DbBackend(sqliteBackend.SqliteBackedDataSource):
         :param geneSymbol: match features by gene symbol
         :return an array of dictionaries, representing the returned data.
         """
-        # TODO: Refactor out common bits of this and the above count query.
-        sql, _, sql_args = self.featuresQuery(
+        sql, sql_args = self.featuresQuery(
             pageToken=pageToken, pageSize=pageSize,
             referenceName=referenceName, start=start, end=end,
             parentId=parentId, featureTypes=featureTypes,
             name=name, geneSymbol=geneSymbol)
-        sql += sqliteBackend.limitsSql(pageToken, pageSize)
         query = self._dbconn.execute(sql, sql_args)
         return sqliteBackend.sqliteRows2dicts(query.fetchall())
 
@@ -292,7 +363,8 @@ class SimulatedFeatureSet(AbstractFeatureSet):
     def getFeatures(self, referenceName=None, start=None, end=None,
                     pageToken=None, pageSize=None,
                     featureTypes=None, parentId=None,
-                    name=None, geneSymbol=None, numFeatures=10):
+                    name=None, geneSymbol=None, numFeatures=10,
+                    fieldMask=protocol.ALL_FIELDS):
         """
         Returns a set number of simulated features.
 
@@ -307,6 +379,7 @@ class SimulatedFeatureSet(AbstractFeatureSet):
         :param geneSymbol: the symbol for the gene the features are on
         :param numFeatures: number of features to generate in the return.
             10 is a reasonable (if arbitrary) default.
+        :param fieldMask: the FieldMask of the fields to return
         :return: Yields feature, nextPageToken pairs.
             nextPageToken is None if last feature was yielded.
         """
@@ -331,7 +404,7 @@ class SimulatedFeatureSet(AbstractFeatureSet):
                     nextPageToken += 1
                 else:
                     nextPageToken = None
-                yield gaFeature, (
+                yield fieldMask.apply(gaFeature), (
                     str(nextPageToken)
                     if nextPageToken is not None else None)
 
@@ -401,14 +474,17 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
             gaFeature = self._gaFeatureForFeatureDbRecord(featureReturned)
             return gaFeature
 
-    def _gaFeatureForFeatureDbRecord(self, feature):
+    def _gaFeatureForFeatureDbRecord(
+            self, feature, fieldMask=protocol.ALL_FIELDS):
         """
         :param feature: The DB Row representing a feature
+        :param fieldMask: the FieldMask of the fields to fill in
         :return: the corresponding GA4GH protocol.Feature object
         """
         gaFeature = protocol.Feature()
-        gaFeature.id = self.getCompoundIdForFeatureId(feature['id'])
-        if feature.get('parent_id'):
+        if fieldMask.includes("id"):
+            gaFeature.id = self.getCompoundIdForFeatureId(feature['id'])
+        if feature.get('parent_id') and fieldMask.includes("parent_id"):
             gaFeature.parent_id = self.getCompoundIdForFeatureId(
                     feature['parent_id'])
         else:
@@ -423,68 +499,70 @@ class Gff3DbFeatureSet(AbstractFeatureSet):
         else:
             # default to positive strand
             gaFeature.strand = protocol.POS_STRAND
-        gaFeature.child_ids.extend(map(
-                self.getCompoundIdForFeatureId,
-                json.loads(feature['child_ids'])))
-        gaFeature.feature_type.CopyFrom(
-            self._ontology.getGaTermByName(feature['type']))
-        attributes = json.loads(feature['attributes'])
-        # TODO: Identify which values are ExternalIdentifiers and OntologyTerms
-        for key in attributes:
-            for v in attributes[key]:
-                gaFeature.attributes.vals[key].values.add().string_value = v
-        if 'gene_name' in attributes and len(attributes['gene_name']) > 0:
-            gaFeature.gene_symbol = pb.string(attributes['gene_name'][0])
-        return gaFeature
+        if fieldMask.includes("child_ids"):
+            gaFeature.child_ids.extend(map(
+                    self.getCompoundIdForFeatureId,
+                    json.loads(feature['child_ids'])))
+        if fieldMask.includes("feature_type"):
+            gaFeature.feature_type.CopyFrom(
+                self._ontology.getGaTermByName(feature['type']))
+        if fieldMask.includes("attributes") or fieldMask.includes(
+                "gene_symbol"):
+            attributes = json.loads(feature['attributes'])
+            # TODO: Identify which values are ExternalIdentifiers and
+            # OntologyTerms
+            if fieldMask.includes("attributes"):
+                for key in attributes:
+                    for v in attributes[key]:
+                        value = gaFeature.attributes.vals[key].values.add()
+                        value.string_value = v
+            if 'gene_name' in attributes and len(attributes['gene_name']) > 0:
+                gaFeature.gene_symbol = pb.string(attributes['gene_name'][0])
+        return fieldMask.apply(gaFeature)
 
     def getFeatures(self, referenceName=None, start=None, end=None,
                     pageToken=None, pageSize=None,
                     featureTypes=None, parentId=None,
-                    name=None, geneSymbol=None):
+                    name=None, geneSymbol=None,
+                    fieldMask=protocol.ALL_FIELDS):
         """
         method passed to runSearchRequest to fulfill the request
         :param str referenceName: name of reference (ex: "chr1")
         :param start: castable to int, start position on reference
         :param end: castable to int, end position on reference
-        :param pageToken: none or castable to int
+        :param pageToken: none or a token from a previous page
         :param pageSize: none or castable to int
         :param featureTypes: array of str
         :param parentId: none or featureID of parent
         :param name: the name of the feature
         :param geneSymbol: the symbol for the gene the features are on
+        :param fieldMask: the FieldMask of the fields to return
         :return: yields a protocol.Feature at a time, together with
             the corresponding nextPageToken (which is null for the last
             feature served out).
         """
 
+        # One more feature than was asked for is fetched so that
+        # we know whether the last feature on the page is the last overall.
+        limit = None if pageSize is None else int(pageSize) + 1
         with self._db as dataSource:
-            # featuresCount is needed to ensure that once the
-            # request is fulfilled, no nextPageTokens past the
-            # end of the actual dataset range are returned.
-            featuresCount = dataSource.countFeaturesSearchInDb(
-                referenceName=referenceName,
-                start=start, end=end,
-                parentId=parentId, featureTypes=featureTypes,
-                name=name, geneSymbol=geneSymbol)
             featuresReturned = dataSource.searchFeaturesInDb(
-                pageToken, pageSize,
+                pageToken, limit,
                 referenceName=referenceName,
                 start=start, end=end,
                 parentId=parentId, featureTypes=featureTypes,
                 name=name, geneSymbol=geneSymbol)
 
         # pagination logic: None if last feature was returned,
-        # else 1 + row number being returned (starting at row 0).
-        if pageToken:
-            nextPageToken = pb.int(pageToken)
-        else:
-            nextPageToken = 0
-        for featureRecord in featuresReturned:
-            gaFeature = self._gaFeatureForFeatureDbRecord(featureRecord)
-            if nextPageToken < featuresCount - 1:
-                nextPageToken += 1
+        # else a token for the position just after this feature.
+        numFeatures = len(featuresReturned)
+        if limit is not None and numFeatures == limit:
+            featuresReturned = featuresReturned[:-1]
+        for index, featureRecord in enumerate(featuresReturned):
+            gaFeature = self._gaFeatureForFeatureDbRecord(
+                featureRecord, fieldMask)
+            if index < numFeatures - 1:
+                nextPageToken = getFeaturePageToken(featureRecord)
             else:
                 nextPageToken = None
-            yield gaFeature, (
-                str(nextPageToken)
-                if nextPageToken is not None else None)
+            yield gaFeature, nextPageToken
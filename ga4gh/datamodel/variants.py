@@ -6,6 +6,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import array
 import datetime
 import glob
 import hashlib
@@ -20,7 +21,6 @@ import google.protobuf.struct_pb2 as struct_pb2
 import ga4gh.protocol as protocol
 import ga4gh.exceptions as exceptions
 import ga4gh.datamodel as datamodel
-import ga4gh.pb as pb
 
 ANNOTATIONS_VEP_V82 = "VEP_v82"
 ANNOTATIONS_VEP_V77 = "VEP_v77"
@@ -98,6 +98,115 @@ class CallSet(datamodel.DatamodelObject):
         return self._info
 
 
+class GenotypeMatrix(object):
+    """
+    The genotypes of the variants in a region for a list of call sets,
+    held in flat arrays with one row per variant rather than as GA4GH
+    Call objects. The genotypes are an int8 array (widened to int16 if
+    there are more than 127 alleles) of shape variants x call sets x
+    ploidy, with -1 for missing alleles, and the likelihoods a float32
+    array of shape variants x call sets x likelihoods, with NaN for
+    missing values. If maxCells is not None, adding more than maxCells
+    variants x call sets raises a GenotypeMatrixTooLargeException.
+    """
+    def __init__(self, callSetIds, includeLikelihoods=False, maxCells=None):
+        self._callSetIds = callSetIds
+        self._maxCells = maxCells
+        self._starts = []
+        self._ends = []
+        self._ploidy = 0
+        self._genotypes = array.array(str("b"))
+        self._numLikelihoods = 0
+        self._genotypeLikelihoods = None
+        if includeLikelihoods:
+            self._genotypeLikelihoods = array.array(str("f"))
+
+    def addVariant(self, start, end, genotypes, genotypeLikelihoods=None):
+        """
+        Adds a row for the variant with the specified coordinates. The
+        genotypes are a list holding a sequence of allele indexes (None
+        for missing alleles) for each call set, and genotypeLikelihoods a
+        similar list of sequences of likelihoods (or None if missing).
+        """
+        numCallSets = len(self._callSetIds)
+        numCells = len(self._starts) * numCallSets
+        if (self._maxCells is not None and
+                numCells + numCallSets > self._maxCells):
+            raise exceptions.GenotypeMatrixTooLargeException(self._maxCells)
+        self._genotypes, self._ploidy = self._addRow(
+            self._genotypes, self._ploidy, numCells, genotypes, -1)
+        if self._genotypeLikelihoods is not None:
+            if genotypeLikelihoods is None:
+                genotypeLikelihoods = [None] * numCallSets
+            self._genotypeLikelihoods, self._numLikelihoods = self._addRow(
+                self._genotypeLikelihoods, self._numLikelihoods, numCells,
+                genotypeLikelihoods, float("nan"))
+        self._starts.append(start)
+        self._ends.append(end)
+
+    def _addRow(self, values, width, numCells, row, padding):
+        """
+        Appends the specified row of sequences to the specified array,
+        which holds numCells cells of the specified width, each sequence
+        padded to that width. Returns the array and the width, which are
+        both replaced if the row does not fit.
+        """
+        row = [() if sequence is None else sequence for sequence in row]
+        rowWidth = max([width] + [len(sequence) for sequence in row])
+        if rowWidth > width:
+            values = self._widen(values, width, numCells, rowWidth, padding)
+        rowValues = []
+        for sequence in row:
+            rowValues.extend(
+                padding if value is None else value for value in sequence)
+            rowValues.extend([padding] * (rowWidth - len(sequence)))
+        try:
+            # fromlist leaves the array unchanged if a value overflows
+            values.fromlist(rowValues)
+        except OverflowError:
+            values = array.array(str("h"), values)
+            values.fromlist(rowValues)
+        return values, rowWidth
+
+    @staticmethod
+    def _widen(values, width, numCells, newWidth, padding):
+        """
+        Returns a copy of the specified array of numCells cells of the
+        specified width, with each cell padded to newWidth.
+        """
+        cellPadding = array.array(
+            values.typecode, [padding] * (newWidth - width))
+        widened = array.array(values.typecode)
+        for cell in range(numCells):
+            widened.extend(values[cell * width:(cell + 1) * width])
+            widened.extend(cellPadding)
+        return widened
+
+    def getCallSetIds(self):
+        return self._callSetIds
+
+    def getStarts(self):
+        return self._starts
+
+    def getEnds(self):
+        return self._ends
+
+    def getPloidy(self):
+        return self._ploidy
+
+    def getGenotypes(self):
+        return self._genotypes
+
+    def hasGenotypeLikelihoods(self):
+        return self._genotypeLikelihoods is not None
+
+    def getNumLikelihoods(self):
+        return self._numLikelihoods
+
+    def getGenotypeLikelihoods(self):
+        return self._genotypeLikelihoods
+
+
 class AbstractVariantSet(datamodel.DatamodelObject):
     """
     An abstract base class of a variant set
@@ -110,6 +219,10 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         self._callSetNameMap = {}
         self._callSetIds = []
         self._callSetIdToIndex = {}
+        self._callSetIndex = datamodel.DatamodelObjectIndex(
+            self.getCallSets, {
+                "name": lambda callSet: [callSet.getLocalId()],
+                "bioSampleId": lambda callSet: [callSet.getBioSampleId()]})
         self._creationTime = None
         self._updatedTime = None
         self._referenceSet = None
@@ -188,6 +301,7 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         self._callSetNameMap[callSet.getLocalId()] = callSet
         self._callSetIds.append(callSetId)
         self._callSetIdToIndex[callSet.getId()] = len(self._callSetIds) - 1
+        self._callSetIndex.invalidate()
 
     def addCallSetFromName(self, sampleName):
         """
@@ -202,6 +316,13 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         """
         return [self._callSetIdMap[id_] for id_ in self._callSetIds]
 
+    def searchCallSets(self, name=None, bioSampleId=None):
+        """
+        Returns the list of CallSets in this VariantSet with the specified
+        name and biosample ID; empty values match any CallSet.
+        """
+        return self._callSetIndex.search(name=name, bioSampleId=bioSampleId)
+
     def getNumCallSets(self):
         """
         Returns the number of CallSets in this variant set.
@@ -258,6 +379,72 @@ class AbstractVariantSet(datamodel.DatamodelObject):
         """
         raise NotImplementedError()
 
+    def getVariantRecords(self, referenceName, startPosition, endPosition,
+                          callSetIds=None):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        variants. Records are converted to GA4GH Variants using
+        convertVariantRecord; by default, records are already converted.
+        """
+        for variant in self.getVariants(
+                referenceName, startPosition, endPosition, callSetIds):
+            yield variant.start, variant
+
+    def convertVariantRecord(
+            self, record, callSetIds=None, fieldMask=protocol.ALL_FIELDS):
+        """
+        Returns the GA4GH Variant for the specified record returned by
+        getVariantRecords, with the fields in the specified FieldMask.
+        """
+        return fieldMask.apply(record)
+
+    def getGenotypeMatrix(
+            self, referenceName, startPosition, endPosition,
+            callSetIds=None, includeLikelihoods=False, maxCells=None):
+        """
+        Returns a GenotypeMatrix holding the genotypes of the variants in
+        the specified region for the specified call sets (or all call
+        sets in this VariantSet if callSetIds is empty or None). Raises
+        a GenotypeMatrixTooLargeException if the matrix would hold more
+        than maxCells variants x call sets.
+        """
+        if not callSetIds:
+            callSetIds = self._callSetIds
+        for callSetId in callSetIds:
+            if callSetId not in self._callSetIdMap:
+                raise exceptions.CallSetNotInVariantSetException(
+                    callSetId, self.getId())
+        matrix = GenotypeMatrix(
+            list(callSetIds), includeLikelihoods, maxCells)
+        self._fillGenotypeMatrix(
+            matrix, referenceName, startPosition, endPosition)
+        return matrix
+
+    def _fillGenotypeMatrix(
+            self, matrix, referenceName, startPosition, endPosition):
+        """
+        Adds the variants in the specified region to the specified
+        GenotypeMatrix. By default, these are taken from the calls of
+        the GA4GH Variants returned by getVariants.
+        """
+        callSetIds = matrix.getCallSetIds()
+        for variant in self.getVariants(
+                referenceName, startPosition, endPosition, callSetIds):
+            calls = dict((call.call_set_id, call) for call in variant.calls)
+            genotypes = []
+            genotypeLikelihoods = []
+            for callSetId in callSetIds:
+                call = calls.get(callSetId)
+                if call is None:
+                    genotypes.append(())
+                    genotypeLikelihoods.append(None)
+                else:
+                    genotypes.append(tuple(call.genotype))
+                    genotypeLikelihoods.append(
+                        tuple(call.genotype_likelihood))
+            matrix.addVariant(
+                variant.start, variant.end, genotypes, genotypeLikelihoods)
+
     def _createGaVariant(self):
         """
         Convenience method to set the common fields in a GA Variant
@@ -437,6 +624,7 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         super(HtslibVariantSet, self).__init__(parentContainer, localId)
         self._chromFileMap = {}
         self._metadata = None
+        self._callSetConstants = {}
 
     def isAnnotated(self):
         """
@@ -632,34 +820,59 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
 
     def openFile(self, dataUrlIndexFilePair):
         dataUrl, indexFile = dataUrlIndexFilePair
-        return pysam.VariantFile(dataUrl, index_filename=indexFile)
-
-    def _convertGaCall(self, callSet, pysamCall):
-        phaseset = None
-        if pysamCall.phased:
-            phaseset = str(pysamCall.phased)
-        genotypeLikelihood = []
-        info = {}
-        for key, value in pysamCall.iteritems():
-            if key == 'GL' and value is not None:
-                genotypeLikelihood = list(value)
-            elif key != 'GT':
-                info[key] = _encodeValue(value)
-        call = protocol.Call()
-        call.call_set_name = callSet.getSampleName()
-        call.call_set_id = callSet.getId()
-        call.genotype.extend(list(pysamCall.allele_indices))
-        call.phaseset = pb.string(phaseset)
-        call.genotype_likelihood.extend(genotypeLikelihood)
-        for key in info:
-            call.info[key].values.extend(info[key])
-        return call
-
-    def convertVariant(self, record, callSetIds):
+        return pysam.VariantFile(
+            dataUrl, index_filename=indexFile, **self.getPysamOpenOptions())
+
+    def _getCallSetConstants(self, callSetIds):
+        """
+        Returns a list of (callSetId, callSetName, sampleName) tuples for
+        the specified callSetIds, where sampleName is the key of the call
+        set's column in pysam records. These are computed once per call
+        set rather than for every record converted.
+        """
+        constants = self._callSetConstants
+        ret = []
+        for callSetId in callSetIds:
+            if callSetId not in constants:
+                callSet = self.getCallSet(callSetId)
+                constants[callSetId] = (
+                    callSetId, callSet.getSampleName(),
+                    str(callSet.getSampleName()))
+            ret.append(constants[callSetId])
+        return ret
+
+    def _convertGaCalls(self, variant, record, callSetConstants):
+        """
+        Adds the calls of the specified pysam record for the call sets
+        described by callSetConstants to the specified GA4GH Variant.
+        The FORMAT keys of the record are looked up once and the calls
+        are built in place in the variant's repeated calls field.
+        """
+        samples = record.samples
+        formatKeys = [key for key in record.format.keys() if key != 'GT']
+        for callSetId, callSetName, sampleName in callSetConstants:
+            pysamCall = samples[sampleName]
+            call = variant.calls.add()
+            call.call_set_name = callSetName
+            call.call_set_id = callSetId
+            call.genotype.extend(pysamCall.allele_indices)
+            if pysamCall.phased:
+                call.phaseset = str(pysamCall.phased)
+            for key in formatKeys:
+                value = pysamCall[key]
+                if key == 'GL' and value is not None:
+                    call.genotype_likelihood.extend(value)
+                else:
+                    call.info[key].values.extend(_encodeValue(value))
+
+    def convertVariant(
+            self, record, callSetIds, fieldMask=protocol.ALL_FIELDS):
         """
         Converts the specified pysam variant record into a GA4GH Variant
         object. Only calls for the specified list of callSetIds will
-        be included.
+        be included, and only the fields in the specified FieldMask are
+        returned; the info and calls are not converted if they are not
+        in the mask.
         """
         variant = self._createGaVariant()
         variant.reference_name = record.contig
@@ -672,18 +885,42 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             variant.alternate_bases.extend(list(record.alts))
         # record.filter and record.qual are also available, when supported
         # by GAVariant.
-        for key, value in record.info.iteritems():
-            if value is not None:
-                if isinstance(value, str):
-                    value = value.split(',')
-                variant.info[key].values.extend(_encodeValue(value))
-        for callSetId in callSetIds:
-            callSet = self.getCallSet(callSetId)
-            pysamCall = record.samples[str(callSet.getSampleName())]
-            variant.calls.add().CopyFrom(
-                self._convertGaCall(callSet, pysamCall))
-        variant.id = self.getVariantId(variant)
-        return variant
+        if fieldMask.includes("info"):
+            for key, value in record.info.iteritems():
+                if value is not None:
+                    if isinstance(value, str):
+                        value = value.split(',')
+                    variant.info[key].values.extend(_encodeValue(value))
+        if len(callSetIds) > 0 and fieldMask.includes("calls"):
+            self._convertGaCalls(
+                variant, record, self._getCallSetConstants(callSetIds))
+        if fieldMask.includes("id"):
+            variant.id = self.getVariantId(variant)
+        return fieldMask.apply(variant)
+
+    def _fillGenotypeMatrix(
+            self, matrix, referenceName, startPosition, endPosition):
+        """
+        Adds the variants in the specified region to the specified
+        GenotypeMatrix directly from the pysam records, without creating
+        GA4GH Variants.
+        """
+        sampleNames = [
+            sampleName for _, _, sampleName in
+            self._getCallSetConstants(matrix.getCallSetIds())]
+        includeLikelihoods = matrix.hasGenotypeLikelihoods()
+        for record in self.getPysamVariants(
+                referenceName, startPosition, endPosition):
+            samples = record.samples
+            pysamCalls = [samples[sampleName] for sampleName in sampleNames]
+            genotypeLikelihoods = None
+            if includeLikelihoods and 'GL' in record.format:
+                genotypeLikelihoods = [
+                    pysamCall['GL'] for pysamCall in pysamCalls]
+            matrix.addVariant(
+                record.start, record.stop,
+                [pysamCall.allele_indices for pysamCall in pysamCalls],
+                genotypeLikelihoods)
 
     def getVariant(self, compoundId):
         if compoundId.reference_name in self._chromFileMap:
@@ -694,15 +931,15 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         referenceName, startPosition, endPosition = \
             self.sanitizeVariantFileFetch(
                 compoundId.reference_name, start, start + 1)
-        cursor = self.getFileHandle(varFileName).fetch(
-            referenceName, startPosition, endPosition)
-        for record in cursor:
-            variant = self.convertVariant(record, self._callSetIds)
-            if (record.start == start and
-                    compoundId.md5 == self.hashVariant(variant)):
-                return variant
-            elif record.start > start:
-                raise exceptions.ObjectNotFoundException()
+        with self.fileHandle(varFileName) as varFile:
+            cursor = varFile.fetch(referenceName, startPosition, endPosition)
+            for record in cursor:
+                variant = self.convertVariant(record, self._callSetIds)
+                if (record.start == start and
+                        compoundId.md5 == self.hashVariant(variant)):
+                    return variant
+                elif record.start > start:
+                    raise exceptions.ObjectNotFoundException()
         raise exceptions.ObjectNotFoundException(compoundId)
 
     def getPysamVariants(self, referenceName, startPosition, endPosition):
@@ -715,10 +952,19 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
             referenceName, startPosition, endPosition = \
                 self.sanitizeVariantFileFetch(
                     referenceName, startPosition, endPosition)
-            cursor = self.getFileHandle(varFileName).fetch(
-                referenceName, startPosition, endPosition)
-            for record in cursor:
-                yield record
+            # The handle is checked out for as long as the caller holds
+            # this iterator, so that no other search moves it or closes it.
+            varFile = self.checkOutFileHandle(varFileName)
+            try:
+                records = self.prefetchRecords(varFile.fetch(
+                    referenceName, startPosition, endPosition))
+                try:
+                    for record in records:
+                        yield record
+                finally:
+                    records.close()
+            finally:
+                self.checkInFileHandle(varFile)
 
     def getVariants(self, referenceName, startPosition, endPosition,
                     callSetIds=[]):
@@ -726,16 +972,42 @@ class HtslibVariantSet(datamodel.PysamDatamodelMixin, AbstractVariantSet):
         Returns an iterator over the specified variants. The parameters
         correspond to the attributes of a GASearchVariantsRequest object.
         """
+        records = self.getVariantRecords(
+            referenceName, startPosition, endPosition, callSetIds)
         if callSetIds is None:
             callSetIds = self._callSetIds
-        else:
+        for _, record in records:
+            yield self.convertVariant(record, callSetIds)
+
+    def getVariantRecords(self, referenceName, startPosition, endPosition,
+                          callSetIds=None):
+        """
+        Returns an iterator over (start, record) pairs for the specified
+        variants, where record is the pysam VCF record. Conversion to
+        GA4GH Variants is left to convertVariantRecord, so that callers
+        can position themselves within the iteration without converting
+        every record.
+        """
+        if callSetIds is not None:
             for callSetId in callSetIds:
-                if callSetId not in self._callSetIds:
+                if callSetId not in self._callSetIdMap:
                     raise exceptions.CallSetNotInVariantSetException(
                         callSetId, self.getId())
         for record in self.getPysamVariants(
                 referenceName, startPosition, endPosition):
-            yield self.convertVariant(record, callSetIds)
+            yield record.start, record
+
+    def convertVariantRecord(
+            self, record, callSetIds=None, fieldMask=protocol.ALL_FIELDS):
+        """
+        Converts the specified record returned by getVariantRecords into
+        a GA4GH Variant, including calls for the specified callSetIds (or
+        all call sets if callSetIds is None), with the fields in the
+        specified FieldMask.
+        """
+        if callSetIds is None:
+            callSetIds = self._callSetIds
+        return self.convertVariant(record, callSetIds, fieldMask)
 
     def getMetadataId(self, metadata):
         """
@@ -919,6 +1191,27 @@ class AbstractVariantAnnotationSet(datamodel.DatamodelObject):
             str(gaVariant.start), md5)
         return str(compoundId)
 
+    def getVariantAnnotationRecords(self, referenceName, start, end):
+        """
+        Returns an iterator over (start, record) pairs for the variant
+        annotations in the specified region. Records are converted to
+        (variant, annotation) pairs using convertVariantAnnotationRecord;
+        by default, records are already converted.
+        """
+        for variant, annotation in self.getVariantAnnotations(
+                referenceName, start, end):
+            yield variant.start, (variant, annotation)
+
+    def convertVariantAnnotationRecord(
+            self, record, fieldMask=protocol.ALL_FIELDS):
+        """
+        Returns the (variant, annotation) pair for the specified record
+        returned by getVariantAnnotationRecords, where the annotation has
+        the fields in the specified FieldMask.
+        """
+        variant, annotation = record
+        return variant, fieldMask.apply(annotation)
+
 
 class SimulatedVariantAnnotationSet(AbstractVariantAnnotationSet):
     """
@@ -1042,6 +1335,12 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
     Class representing a single variant annotation derived from an
     annotated variant set.
     """
+    # The fields of the variants converted for partial responses, which
+    # are those needed to identify and position the annotations.
+    _variantFieldMask = protocol.FieldMask([
+        "id", "reference_name", "start", "end", "reference_bases",
+        "alternate_bases"])
+
     def __init__(self, variantSet, localId):
         super(HtslibVariantAnnotationSet, self).__init__(variantSet, localId)
 
@@ -1125,19 +1424,45 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
         :param endPosition:
         :return: generator of protocol.VariantAnnotation
         """
+        for _, record in self.getVariantAnnotationRecords(
+                referenceName, startPosition, endPosition):
+            yield self.convertVariantAnnotationRecord(record)
+
+    def getVariantAnnotationRecords(
+            self, referenceName, startPosition, endPosition):
+        """
+        Returns an iterator over (start, record) pairs for the variant
+        annotations in the specified region, where record is the pysam
+        VCF record. Conversion is left to convertVariantAnnotationRecord.
+        """
+        for record in self._variantSet.getPysamVariants(
+                referenceName, startPosition, endPosition):
+            yield record.start, record
+
+    def convertVariantAnnotationRecord(
+            self, record, fieldMask=protocol.ALL_FIELDS):
+        """
+        Converts the specified record returned by
+        getVariantAnnotationRecords into a (variant, annotation) pair,
+        where the annotation has the fields in the specified FieldMask.
+        """
+        return self.convertVariantAnnotation(
+            record, self._getTranscriptConverter(), fieldMask)
+
+    def _getTranscriptConverter(self):
+        """
+        Returns the function used to convert transcript effects for the
+        annotation type of this set.
+        """
         # TODO Refactor this so that we use the annotationType information
         # where it makes most sense, and rename the various methods so that
         # it's clear what program/version combination they operate on.
-        variantIter = self._variantSet.getPysamVariants(
-            referenceName, startPosition, endPosition)
         if self._annotationType == ANNOTATIONS_SNPEFF:
-            transcriptConverter = self.convertTranscriptEffectSnpEff
+            return self.convertTranscriptEffectSnpEff
         elif self._annotationType == ANNOTATIONS_VEP_V82:
-            transcriptConverter = self.convertTranscriptEffectVEP
+            return self.convertTranscriptEffectVEP
         else:
-            transcriptConverter = self.convertTranscriptEffectCSQ
-        for record in variantIter:
-            yield self.convertVariantAnnotation(record, transcriptConverter)
+            return self.convertTranscriptEffectCSQ
 
     def convertLocation(self, pos):
         """
@@ -1340,15 +1665,25 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
             self._ontology.getGaTermByName(soName)
             for soName in seqOntStr.split('&')]
 
-    def convertVariantAnnotation(self, record, transcriptConverter):
+    def convertVariantAnnotation(
+            self, record, transcriptConverter, fieldMask=protocol.ALL_FIELDS):
         """
         Converts the specfied pysam variant record into a GA4GH variant
         annotation object using the specified function to convert the
-        transcripts.
-        """
-        variant = self._variantSet.convertVariant(record, [])
+        transcripts. The annotation has the fields in the specified
+        FieldMask; the transcript effects, from which the ID is computed,
+        are only converted if one of the two is in the mask.
+        """
+        variantFieldMask = protocol.ALL_FIELDS
+        if fieldMask is not protocol.ALL_FIELDS:
+            variantFieldMask = self._variantFieldMask
+        variant = self._variantSet.convertVariant(
+            record, [], variantFieldMask)
         annotation = self._createGaVariantAnnotation()
         annotation.variant_id = variant.id
+        if not (fieldMask.includes("transcript_effects") or
+                fieldMask.includes("id")):
+            return variant, fieldMask.apply(annotation)
         # Convert annotations from INFO field into TranscriptEffect
         transcriptEffects = []
         hgvsG = record.info.get(b'HGVS.g')
@@ -1364,7 +1699,7 @@ class HtslibVariantAnnotationSet(AbstractVariantAnnotationSet):
                     self.convertTranscriptEffectCSQ(ann, hgvsG))
         annotation.transcript_effects.extend(transcriptEffects)
         annotation.id = self.getVariantAnnotationId(variant, annotation)
-        return variant, annotation
+        return variant, fieldMask.apply(annotation)
 
     def _convertAnnotations(
             self, annotations, variant, hgvsG, transcriptConverter):
@@ -5,9 +5,11 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import json
 import os
 import sqlite3
+import threading
 
 import ga4gh.datamodel as datamodel
 import ga4gh.datamodel.datasets as datasets
@@ -35,6 +37,14 @@ class AbstractDataRepository(object):
         self._referenceSetIdMap = {}
         self._referenceSetNameMap = {}
         self._referenceSetIds = []
+        self._referenceSetIndex = datamodel.DatamodelObjectIndex(
+            self.getReferenceSets, {
+                "md5checksum": lambda referenceSet: [
+                    referenceSet.getMd5Checksum()],
+                "accession": lambda referenceSet: (
+                    referenceSet.getSourceAccessions()),
+                "assemblyId": lambda referenceSet: [
+                    referenceSet.getAssemblyId()]})
         self._ontologyNameMap = {}
         self._ontologyIdMap = {}
         self._ontologyIds = []
@@ -56,6 +66,7 @@ class AbstractDataRepository(object):
         self._referenceSetIdMap[id_] = referenceSet
         self._referenceSetNameMap[referenceSet.getLocalId()] = referenceSet
         self._referenceSetIds.append(id_)
+        self._referenceSetIndex.invalidate()
 
     def addOntology(self, ontology):
         """
@@ -92,6 +103,47 @@ class AbstractDataRepository(object):
         """
         return self._datasetIdMap[self._datasetIds[index]]
 
+    def getDatasetSummaryByIndex(self, index):
+        """
+        Returns a dataset at the specified index holding at least its name
+        and description, which is enough to list it. Repositories that
+        read datasets on demand return this without reading its contents.
+        """
+        return self.getDatasetByIndex(index)
+
+    def getVariantSetSummaries(self, datasetId):
+        """
+        Returns the variant sets in the specified dataset, or summaries of
+        them holding their IDs and names, which is enough to list them.
+        """
+        return self.getDataset(datasetId).getVariantSets()
+
+    def getVariantAnnotationSetSummaries(self, datasetId):
+        """
+        Returns the variant annotation sets of the variant sets in the
+        specified dataset, or summaries of them.
+        """
+        variantAnnotationSets = []
+        for variantSet in self.getDataset(datasetId).getVariantSets():
+            variantAnnotationSets.extend(
+                variantSet.getVariantAnnotationSets())
+        return variantAnnotationSets
+
+    def getFeatureSetSummaries(self, datasetId):
+        """
+        Returns the feature sets in the specified dataset, or summaries
+        of them.
+        """
+        return self.getDataset(datasetId).getFeatureSets()
+
+    def getReadGroupSetSummaries(self, datasetId):
+        """
+        Returns the read group sets in the specified dataset, or summaries
+        of them, which return their read groups or summaries of them from
+        getReadGroups().
+        """
+        return self.getDataset(datasetId).getReadGroupSets()
+
     def getDatasetByName(self, name):
         """
         Returns the dataset with the specified name.
@@ -106,6 +158,17 @@ class AbstractDataRepository(object):
         """
         return [self._referenceSetIdMap[id_] for id_ in self._referenceSetIds]
 
+    def searchReferenceSets(
+            self, md5checksum=None, accession=None, assemblyId=None):
+        """
+        Returns the list of ReferenceSets in this data repository with the
+        specified MD5 checksum, source accession and assembly ID; empty
+        values match any ReferenceSet.
+        """
+        return self._referenceSetIndex.search(
+            md5checksum=md5checksum, accession=accession,
+            assemblyId=assemblyId)
+
     def getNumReferenceSets(self):
         """
         Returns the number of reference sets in this data repository.
@@ -363,6 +426,49 @@ class SimulatedDataRepository(AbstractDataRepository):
             self.addDataset(dataset)
 
 
+class ObjectSummary(object):
+    """
+    The ID and name of an object in a data repository, which is enough to
+    list it without reading it.
+    """
+    def __init__(self, id_, localId):
+        self._id = id_
+        self._localId = localId
+
+    def getId(self):
+        return self._id
+
+    def getLocalId(self):
+        return self._localId
+
+
+class ReadGroupSetSummary(ObjectSummary):
+    """
+    The ID and name of a read group set, along with summaries of its read
+    groups.
+    """
+    def __init__(self, id_, localId):
+        super(ReadGroupSetSummary, self).__init__(id_, localId)
+        self._readGroups = []
+
+    def addReadGroup(self, readGroup):
+        self._readGroups.append(readGroup)
+
+    def getReadGroups(self):
+        return self._readGroups
+
+
+class _DatasetLoad(object):
+    """
+    A dataset being read from the DB by a thread in lazy mode.
+    """
+    def __init__(self, id_):
+        self.id = id_
+        self.thread = threading.current_thread()
+        self.dataset = None
+        self.finished = threading.Event()
+
+
 class SqlDataRepository(AbstractDataRepository):
     """
     A data repository based on a SQL database.
@@ -384,9 +490,23 @@ class SqlDataRepository(AbstractDataRepository):
     systemKeySchemaVersion = "schemaVersion"
     systemKeyCreationTimeStamp = "creationTimeStamp"
 
-    def __init__(self, fileName):
+    def __init__(self, fileName, lazyLoading=False, maxCachedDatasets=16):
         super(SqlDataRepository, self).__init__()
         self._dbFilename = fileName
+        # In lazy mode, load() reads only the ontologies, reference sets
+        # and the Dataset table, which is enough to list the datasets.
+        # Each dataset is then read from the DB along with all of its
+        # contents when it is first accessed, and the most recently used
+        # datasets are held in a bounded cache.
+        self._lazyLoading = lazyLoading
+        self._maxCachedDatasets = maxCachedDatasets
+        self._datasetNameIdMap = {}
+        self._datasetSummaryMap = {}
+        self._datasetCache = collections.OrderedDict()
+        # The datasets being read from the DB, which other threads wait
+        # for rather than reading them again.
+        self._datasetLoads = {}
+        self._datasetCacheLock = threading.Lock()
         # We open the repo in either read or write mode. When we want to
         # update the repo we open it in write mode. For normal online
         # server use, we open it in read mode.
@@ -541,6 +661,26 @@ class SqlDataRepository(AbstractDataRepository):
             # raised e.g. when directory passed as dbFilename
             raise exceptions.RepoInvalidDatabaseException(self._dbFilename)
 
+    def _selectRows(self, cursor, table, datasetId=None, parentTable=None):
+        """
+        Selects all rows of the specified table, or only those within the
+        specified dataset. Rows of tables that do not refer to their
+        dataset directly are selected through the specified parent table.
+        """
+        cursor.row_factory = sqlite3.Row
+        if datasetId is None:
+            cursor.execute("SELECT * FROM {};".format(table))
+        elif parentTable is None:
+            sql = "SELECT * FROM {} WHERE datasetId=? ORDER BY rowid;"
+            cursor.execute(sql.format(table), (datasetId,))
+        else:
+            parentIdColumn = parentTable[0].lower() + parentTable[1:] + "Id"
+            sql = (
+                "SELECT * FROM {} WHERE {} IN "
+                "(SELECT id FROM {} WHERE datasetId=?) ORDER BY rowid;")
+            cursor.execute(
+                sql.format(table, parentIdColumn, parentTable), (datasetId,))
+
     def _createSystemTable(self, cursor):
         sql = """
             CREATE TABLE System (
@@ -602,13 +742,61 @@ class SqlDataRepository(AbstractDataRepository):
                 ontology.getOntologyPrefix()))
         except sqlite3.IntegrityError:
             raise exceptions.DuplicateNameException(ontology.getName())
+        self.insertCompiledOntology(ontology)
+
+    def _createCompiledOntologyTable(self, cursor):
+        # Repositories created before ontologies were compiled do not have
+        # this table, so it is also created when an ontology is inserted.
+        sql = """
+            CREATE TABLE IF NOT EXISTS CompiledOntology(
+                ontologyId TEXT NOT NULL PRIMARY KEY,
+                sourceVersion TEXT,
+                fileSize INTEGER NOT NULL,
+                fileModificationTime REAL NOT NULL,
+                terms TEXT NOT NULL,
+                FOREIGN KEY(ontologyId) REFERENCES Ontology(id)
+                    ON DELETE CASCADE
+            );
+        """
+        cursor.execute(sql)
+
+    def insertCompiledOntology(self, ontology):
+        """
+        Inserts the terms of the specified ontology into this repository,
+        so that they can be loaded without parsing its OBO file.
+        """
+        sql = """
+            INSERT OR REPLACE INTO CompiledOntology(
+                ontologyId, sourceVersion, fileSize, fileModificationTime,
+                terms)
+            VALUES (?, ?, ?, ?, ?);
+        """
+        cursor = self._dbConnection.cursor()
+        self._createCompiledOntologyTable(cursor)
+        cursor.execute(sql, (
+            ontology.getName(),
+            ontology.getSourceVersion(),
+            ontology.getFileSize(),
+            ontology.getFileModificationTime(),
+            json.dumps(ontology.getCompiledTerms())))
+
+    def _readCompiledOntologyTable(self, cursor):
+        cursor.row_factory = sqlite3.Row
+        try:
+            cursor.execute("SELECT * FROM CompiledOntology;")
+        except sqlite3.OperationalError:
+            return {}
+        return dict((row[b'ontologyId'], row) for row in cursor)
 
     def _readOntologyTable(self, cursor):
+        compiledRows = self._readCompiledOntologyTable(cursor)
         cursor.row_factory = sqlite3.Row
         cursor.execute("SELECT * FROM Ontology;")
-        for row in cursor:
+        for row in cursor.fetchall():
             ontology = ontologies.Ontology(row[b'name'])
-            ontology.populateFromRow(row)
+            ontology.populateFromRow(
+                row, compiledRows.get(row[b'id']),
+                readFile=not self._lazyLoading)
             self.addOntology(ontology)
 
     def removeOntology(self, ontology):
@@ -778,6 +966,40 @@ class SqlDataRepository(AbstractDataRepository):
             # Insert the dataset into the memory-based object model.
             self.addDataset(dataset)
 
+    def _readDatasetSummaries(self, cursor):
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT * FROM Dataset;")
+        for row in cursor:
+            dataset = datasets.Dataset(row[b'name'])
+            dataset.populateFromRow(row)
+            id_ = dataset.getId()
+            assert id_ == row[b"id"]
+            self._datasetNameIdMap[dataset.getLocalId()] = id_
+            self._datasetSummaryMap[id_] = dataset
+            self._datasetIds.append(id_)
+
+    def _readDataset(self, cursor, load):
+        cursor.row_factory = sqlite3.Row
+        cursor.execute("SELECT * FROM Dataset WHERE id=?;", (load.id,))
+        row = cursor.fetchone()
+        if row is None:
+            raise exceptions.DatasetNotFoundException(load.id)
+        dataset = datasets.Dataset(row[b'name'])
+        dataset.populateFromRow(row)
+        assert dataset.getId() == load.id
+        # The contents of the dataset are attached to it by looking it up
+        # by ID, which returns load.dataset in the reading thread.
+        load.dataset = dataset
+        self._readReadGroupSetTable(cursor, load.id)
+        self._readReadGroupTable(cursor, load.id)
+        self._readVariantSetTable(cursor, load.id)
+        self._readCallSetTable(cursor, load.id)
+        self._readVariantAnnotationSetTable(cursor, load.id)
+        self._readFeatureSetTable(cursor, load.id)
+        self._readBioSampleTable(cursor, load.id)
+        self._readIndividualTable(cursor, load.id)
+        return dataset
+
     def _createReadGroupTable(self, cursor):
         sql = """
             CREATE TABLE ReadGroup (
@@ -855,9 +1077,8 @@ class SqlDataRepository(AbstractDataRepository):
         cursor = self._dbConnection.cursor()
         cursor.execute(sql, (individual.getId(),))
 
-    def _readReadGroupTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM ReadGroup;")
+    def _readReadGroupTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "ReadGroup", datasetId, "ReadGroupSet")
         for row in cursor:
             readGroupSet = self.getReadGroupSet(row[b'readGroupSetId'])
             readGroup = reads.HtslibReadGroup(readGroupSet, row[b'name'])
@@ -928,9 +1149,8 @@ class SqlDataRepository(AbstractDataRepository):
         cursor = self._dbConnection.cursor()
         cursor.execute(sql, (referenceSet.getId(),))
 
-    def _readReadGroupSetTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM ReadGroupSet;")
+    def _readReadGroupSetTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "ReadGroupSet", datasetId)
         for row in cursor:
             dataset = self.getDataset(row[b'datasetId'])
             readGroupSet = reads.HtslibReadGroupSet(dataset, row[b'name'])
@@ -983,9 +1203,9 @@ class SqlDataRepository(AbstractDataRepository):
             variantAnnotationSet.getCreationTime(),
             variantAnnotationSet.getUpdatedTime()))
 
-    def _readVariantAnnotationSetTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM VariantAnnotationSet;")
+    def _readVariantAnnotationSetTable(self, cursor, datasetId=None):
+        self._selectRows(
+            cursor, "VariantAnnotationSet", datasetId, "VariantSet")
         for row in cursor:
             variantSet = self.getVariantSet(row[b'variantSetId'])
             ontology = self.getOntology(row[b'ontologyId'])
@@ -1027,9 +1247,8 @@ class SqlDataRepository(AbstractDataRepository):
             callSet.getParentContainer().getId(),
             callSet.getBioSampleId()))
 
-    def _readCallSetTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM CallSet;")
+    def _readCallSetTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "CallSet", datasetId, "VariantSet")
         for row in cursor:
             variantSet = self.getVariantSet(row[b'variantSetId'])
             callSet = variants.CallSet(variantSet, row[b'name'])
@@ -1087,9 +1306,8 @@ class SqlDataRepository(AbstractDataRepository):
         for callSet in variantSet.getCallSets():
             self.insertCallSet(callSet)
 
-    def _readVariantSetTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM VariantSet;")
+    def _readVariantSetTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "VariantSet", datasetId)
         for row in cursor:
             dataset = self.getDataset(row[b'datasetId'])
             referenceSet = self.getReferenceSet(row[b'referenceSetId'])
@@ -1139,9 +1357,8 @@ class SqlDataRepository(AbstractDataRepository):
             featureSet.getLocalId(),
             featureSet.getDataUrl()))
 
-    def _readFeatureSetTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM FeatureSet;")
+    def _readFeatureSetTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "FeatureSet", datasetId)
         for row in cursor:
             dataset = self.getDataset(row[b'datasetId'])
             featureSet = sequenceAnnotations.Gff3DbFeatureSet(
@@ -1194,9 +1411,8 @@ class SqlDataRepository(AbstractDataRepository):
             bioSample.getIndividualId(),
             json.dumps(bioSample.getInfo())))
 
-    def _readBioSampleTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM BioSample;")
+    def _readBioSampleTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "BioSample", datasetId)
         for row in cursor:
             dataset = self.getDataset(row[b'datasetId'])
             bioSample = biodata.BioSample(
@@ -1247,9 +1463,8 @@ class SqlDataRepository(AbstractDataRepository):
             json.dumps(individual.getSex()),
             json.dumps(individual.getInfo())))
 
-    def _readIndividualTable(self, cursor):
-        cursor.row_factory = sqlite3.Row
-        cursor.execute("SELECT * FROM Individual;")
+    def _readIndividualTable(self, cursor, datasetId=None):
+        self._selectRows(cursor, "Individual", datasetId)
         for row in cursor:
             dataset = self.getDataset(row[b'datasetId'])
             individual = biodata.Individual(
@@ -1267,6 +1482,7 @@ class SqlDataRepository(AbstractDataRepository):
         cursor = self._dbConnection
         self._createSystemTable(cursor)
         self._createOntologyTable(cursor)
+        self._createCompiledOntologyTable(cursor)
         self._createReferenceSetTable(cursor)
         self._createReferenceTable(cursor)
         self._createDatasetTable(cursor)
@@ -1313,6 +1529,9 @@ class SqlDataRepository(AbstractDataRepository):
             self._readOntologyTable(cursor)
             self._readReferenceSetTable(cursor)
             self._readReferenceTable(cursor)
+            if self._lazyLoading:
+                self._readDatasetSummaries(cursor)
+                return
             self._readDatasetTable(cursor)
             self._readReadGroupSetTable(cursor)
             self._readReadGroupTable(cursor)
@@ -1322,3 +1541,125 @@ class SqlDataRepository(AbstractDataRepository):
             self._readFeatureSetTable(cursor)
             self._readBioSampleTable(cursor)
             self._readIndividualTable(cursor)
+
+    def _getCachedDataset(self, id_):
+        # Returns the dataset with the specified ID from the cache of
+        # datasets read in lazy mode, reading it from the DB on a miss.
+        # The DB is read outside the lock, so that only the threads that
+        # want the same dataset wait for it.
+        while True:
+            with self._datasetCacheLock:
+                if id_ in self._datasetCache:
+                    dataset = self._datasetCache.pop(id_)
+                    self._datasetCache[id_] = dataset
+                    return dataset
+                load = self._datasetLoads.get(id_)
+                if load is None:
+                    load = _DatasetLoad(id_)
+                    self._datasetLoads[id_] = load
+                    break
+                if load.thread is threading.current_thread():
+                    return load.dataset
+            # If the read fails, the next waiting thread tries again.
+            load.finished.wait()
+        dataset = None
+        try:
+            with sqlite3.connect(self._dbFilename) as db:
+                dataset = self._readDataset(db.cursor(), load)
+        finally:
+            with self._datasetCacheLock:
+                del self._datasetLoads[id_]
+                if dataset is not None:
+                    self._datasetCache[id_] = dataset
+                    while len(self._datasetCache) > self._maxCachedDatasets:
+                        self._datasetCache.popitem(last=False)
+            load.finished.set()
+        return dataset
+
+    def getDatasets(self):
+        # In lazy mode, this reads every dataset that is not cached; lists
+        # of datasets should use getDatasetSummaryByIndex instead.
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getDatasets()
+        return [self._getCachedDataset(id_) for id_ in self._datasetIds]
+
+    def getDataset(self, id_):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getDataset(id_)
+        if id_ not in self._datasetSummaryMap:
+            raise exceptions.DatasetNotFoundException(id_)
+        return self._getCachedDataset(id_)
+
+    def getDatasetByIndex(self, index):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getDatasetByIndex(index)
+        return self._getCachedDataset(self._datasetIds[index])
+
+    def getDatasetSummaryByIndex(self, index):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getDatasetSummaryByIndex(
+                index)
+        return self._datasetSummaryMap[self._datasetIds[index]]
+
+    def getDatasetByName(self, name):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getDatasetByName(name)
+        if name not in self._datasetNameIdMap:
+            raise exceptions.DatasetNameNotFoundException(name)
+        return self._getCachedDataset(self._datasetNameIdMap[name])
+
+    def _selectDatasetRows(self, table, datasetId, parentTable=None):
+        # Returns the rows of the specified table within the specified
+        # dataset in lazy mode, without reading the dataset.
+        if datasetId not in self._datasetSummaryMap:
+            raise exceptions.DatasetNotFoundException(datasetId)
+        with sqlite3.connect(self._dbFilename) as db:
+            cursor = db.cursor()
+            self._selectRows(cursor, table, datasetId, parentTable)
+            return cursor.fetchall()
+
+    def _selectObjectSummaries(self, table, datasetId, parentTable=None):
+        return [
+            ObjectSummary(row[b'id'], row[b'name'])
+            for row in self._selectDatasetRows(table, datasetId, parentTable)]
+
+    def getVariantSetSummaries(self, datasetId):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getVariantSetSummaries(
+                datasetId)
+        return self._selectObjectSummaries("VariantSet", datasetId)
+
+    def getVariantAnnotationSetSummaries(self, datasetId):
+        if not self._lazyLoading:
+            return super(
+                SqlDataRepository, self).getVariantAnnotationSetSummaries(
+                datasetId)
+        return self._selectObjectSummaries(
+            "VariantAnnotationSet", datasetId, "VariantSet")
+
+    def getFeatureSetSummaries(self, datasetId):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getFeatureSetSummaries(
+                datasetId)
+        return self._selectObjectSummaries("FeatureSet", datasetId)
+
+    def getReadGroupSetSummaries(self, datasetId):
+        if not self._lazyLoading:
+            return super(SqlDataRepository, self).getReadGroupSetSummaries(
+                datasetId)
+        readGroupSets = collections.OrderedDict()
+        for row in self._selectDatasetRows("ReadGroupSet", datasetId):
+            readGroupSets[row[b'id']] = ReadGroupSetSummary(
+                row[b'id'], row[b'name'])
+        rows = self._selectDatasetRows("ReadGroup", datasetId, "ReadGroupSet")
+        for row in rows:
+            readGroupSets[row[b'readGroupSetId']].addReadGroup(
+                ObjectSummary(row[b'id'], row[b'name']))
+        return list(readGroupSets.values())
+
+    def getNumCachedDatasets(self):
+        """
+        Returns the number of datasets currently held in memory in lazy
+        mode.
+        """
+        return len(self._datasetCache)
@@ -126,6 +126,30 @@ class BadPageTokenException(BadRequestException):
     message = "Request page token invalid"
 
 
+class BatchTooLargeException(BadRequestException):
+    def __init__(self, numRequests, maxRequests):
+        self.message = (
+            "Batch of {} requests exceeds the maximum of {}".format(
+                numRequests, maxRequests))
+
+
+class GenotypeMatrixTooLargeException(BadRequestException):
+    def __init__(self, maxCells):
+        self.message = (
+            "Genotype matrix exceeds the maximum of {} variants x call "
+            "sets; request a smaller region".format(maxCells))
+
+
+class BadFieldMaskException(BadRequestException):
+    def __init__(self, fieldName):
+        self.message = "Requested field '{}' does not exist".format(
+            fieldName)
+
+
+class FieldMaskNotSupportedException(BadRequestException):
+    message = "Partial responses are not supported for this request"
+
+
 class BadIdentifierException(BadRequestException):
     def __init__(self, id_, msg=None):
         self.message = "The identifier provided is invalid: '{}' ".format(id_)
@@ -145,6 +169,10 @@ class InvalidJsonException(BadRequestException):
         self.message = "Cannot parse JSON: '{}'".format(jsonString)
 
 
+class InvalidProtobufException(BadRequestException):
+    message = "Cannot parse protobuf message"
+
+
 class Validator(object):
     """
     Check that a JSON dictionary is a valid representation of a protocol
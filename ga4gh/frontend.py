@@ -30,12 +30,16 @@ import ga4gh.datamodel as datamodel
 import ga4gh.protocol as protocol
 import ga4gh.exceptions as exceptions
 import ga4gh.datarepo as datarepo
+import ga4gh.npy as npy
+import ga4gh.sqliteBackend as sqliteBackend
 import logging
 from logging import StreamHandler
 
 
 
-MIMETYPE = "application/json"
+MIMETYPE = protocol.MIMETYPE
+# Mimetypes for which reference bases are sent as an unpaged stream.
+RAW_BASES_MIMETYPES = ["text/plain", "application/octet-stream"]
 SEARCH_ENDPOINT_METHODS = ['POST', 'OPTIONS']
 SECRET_KEY_LENGTH = 24
 
@@ -138,28 +142,31 @@ class ServerStatus(object):
         """
         Returns the list of datasetIds for this backend
         """
-        return app.backend.getDataRepository().getDatasets()
+        dataRepository = app.backend.getDataRepository()
+        return [
+            dataRepository.getDatasetSummaryByIndex(index)
+            for index in range(dataRepository.getNumDatasets())]
 
     def getVariantSets(self, datasetId):
         """
         Returns the list of variant sets for the dataset
         """
-        return app.backend.getDataRepository().getDataset(
-            datasetId).getVariantSets()
+        return app.backend.getDataRepository().getVariantSetSummaries(
+            datasetId)
 
     def getFeatureSets(self, datasetId):
         """
         Returns the list of feature sets for the dataset
         """
-        return app.backend.getDataRepository().getDataset(
-            datasetId).getFeatureSets()
+        return app.backend.getDataRepository().getFeatureSetSummaries(
+            datasetId)
 
     def getReadGroupSets(self, datasetId):
         """
         Returns the list of ReadGroupSets for the dataset
         """
-        return app.backend.getDataRepository().getDataset(
-            datasetId).getReadGroupSets()
+        return app.backend.getDataRepository().getReadGroupSetSummaries(
+            datasetId)
 
     def getReferenceSets(self):
         """
@@ -172,12 +179,8 @@ class ServerStatus(object):
         Returns the list of ReferenceSets for this server.
         """
         # TODO this should be displayed per-variant set, not per dataset.
-        variantAnnotationSets = []
-        dataset = app.backend.getDataRepository().getDataset(datasetId)
-        for variantSet in dataset.getVariantSets():
-            variantAnnotationSets.extend(
-                variantSet.getVariantAnnotationSets())
-        return variantAnnotationSets
+        dataRepository = app.backend.getDataRepository()
+        return dataRepository.getVariantAnnotationSetSummaries(datasetId)
 
 
 def reset():
@@ -189,6 +192,26 @@ def reset():
     app.config.from_object(configStr)
 
 
+def _releaseInheritedResources():
+    """
+    Releases the file handles and SQLite connections that a forked
+    process inherits, so that it opens its own rather than sharing them
+    with its parent.
+    """
+    datamodel.fileHandleCache.clear()
+    sqliteBackend.connectionPool.closeAll()
+
+
+def reinitialiseAfterFork():
+    """
+    Reinitialises a process forked after configure(), so that it opens
+    its own file handles and SQLite connections and starts its own pool
+    of conversion processes rather than sharing them with its parent.
+    """
+    _releaseInheritedResources()
+    app.backend.startConversionPool()
+
+
 def configure(configFile=None, baseConfig="ProductionConfig",
               port=8000, extraConfig={}):
     """
@@ -208,6 +231,15 @@ def configure(configFile=None, baseConfig="ProductionConfig",
     # Setup file handle cache max size
     datamodel.fileHandleCache.setMaxCacheSize(
         app.config["FILE_HANDLE_CACHE_MAX_SIZE"])
+    datamodel.compoundIdCache.setMaxCacheSize(
+        app.config["COMPOUND_ID_CACHE_MAX_SIZE"])
+    datamodel.PysamDatamodelMixin.setPrefetchSize(
+        app.config["PYSAM_PREFETCH_SIZE"])
+    datamodel.PysamDatamodelMixin.setHtslibThreads(
+        app.config["HTSLIB_THREADS"])
+    # Setup SQLite connection pool max size
+    sqliteBackend.connectionPool.setMaxPoolSize(
+        app.config["SQLITE_CONNECTION_POOL_MAX_SIZE"])
     # Setup CORS
     cors.CORS(app, allow_headers='Content-Type')
     app.serverStatus = ServerStatus()
@@ -242,7 +274,10 @@ def configure(configFile=None, baseConfig="ProductionConfig",
         dataRepository = datarepo.EmptyDataRepository()
     elif dataSource.scheme == "file":
         path = os.path.join(dataSource.netloc, dataSource.path)
-        dataRepository = datarepo.SqlDataRepository(path)
+        dataRepository = datarepo.SqlDataRepository(
+            path, lazyLoading=app.config["LAZY_REPOSITORY_LOADING"],
+            maxCachedDatasets=app.config[
+                "REPOSITORY_DATASET_CACHE_MAX_SIZE"])
         dataRepository.open(datarepo.MODE_READ)
     else:
         raise exceptions.ConfigurationException(
@@ -252,6 +287,19 @@ def configure(configFile=None, baseConfig="ProductionConfig",
     theBackend.setResponseValidation(app.config["RESPONSE_VALIDATION"])
     theBackend.setDefaultPageSize(app.config["DEFAULT_PAGE_SIZE"])
     theBackend.setMaxResponseLength(app.config["MAX_RESPONSE_LENGTH"])
+    theBackend.setMaxBatchSearchRequests(
+        app.config["MAX_BATCH_SEARCH_REQUESTS"])
+    theBackend.setMaxGenotypeMatrixCells(
+        app.config["MAX_GENOTYPE_MATRIX_CELLS"])
+    theBackend.setStreamSearchResponses(
+        app.config["STREAM_SEARCH_RESPONSES"])
+    theBackend.setIntervalCursorCacheMaxSize(
+        app.config["INTERVAL_CURSOR_CACHE_MAX_SIZE"])
+    theBackend.setIntervalCursorTimeToLive(
+        app.config["INTERVAL_CURSOR_TIME_TO_LIVE"])
+    theBackend.setConversionProcesses(
+        app.config["CONVERSION_PROCESSES"], _releaseInheritedResources)
+    theBackend.startConversionPool()
     app.backend = theBackend
     app.secret_key = os.urandom(SECRET_KEY_LENGTH)
     app.oidcClient = None
@@ -313,39 +361,114 @@ def configure(configFile=None, baseConfig="ProductionConfig",
             base_url=app.config['OAuth2_PROVIDER_URL'])
 
 
-def getFlaskResponse(responseString, httpStatus=200):
+def getFlaskResponse(responseString, httpStatus=200, mimetype=MIMETYPE):
+    """
+    Returns a Flask response object for the specified data, HTTP status
+    and mimetype. The data may be a string or an iterator over strings,
+    in which case the response is sent using chunked transfer encoding.
+    """
+    return flask.Response(
+        responseString, status=httpStatus, mimetype=mimetype)
+
+
+def getResponseMimetype(request, default=MIMETYPE):
     """
-    Returns a Flask response object for the specified data and HTTP status.
+    Returns the mimetype (JSON or binary protobuf) to use for the response
+    to the specified request, as negotiated using the Accept header.
+    The specified default is used if the client expresses no preference.
     """
-    return flask.Response(responseString, status=httpStatus, mimetype=MIMETYPE)
+    mimetypes = [default] + [
+        mimetype for mimetype in protocol.MIMETYPES if mimetype != default]
+    return request.accept_mimetypes.best_match(mimetypes, default)
 
 
-def handleHttpPost(request, endpoint):
+def handleHttpPost(request, endpoint, partialResponses=False):
     """
     Handles the specified HTTP POST request, which maps to the specified
-    protocol handler endpoint and protocol request class.
+    protocol handler endpoint and protocol request class. If
+    partialResponses is True, the fields query parameter, a comma
+    separated list of the fields to return for each object, is passed
+    to the endpoint.
     """
-    if request.mimetype != MIMETYPE:
+    if request.mimetype not in protocol.MIMETYPES:
         raise exceptions.UnsupportedMediaTypeException()
-    responseStr = endpoint(request.get_data())
-    return getFlaskResponse(responseStr)
+    mimetype = getResponseMimetype(request, request.mimetype)
+    if "fields" not in request.args:
+        responseStr = endpoint(request.get_data(), request.mimetype, mimetype)
+    elif partialResponses:
+        responseStr = endpoint(
+            request.get_data(), request.mimetype, mimetype,
+            fields=request.args["fields"])
+    else:
+        raise exceptions.FieldMaskNotSupportedException()
+    return getFlaskResponse(responseStr, mimetype=mimetype)
 
 
 def handleList(id_, endpoint, request):
     """
     Handles the specified HTTP GET request, mapping to a list request
     """
-    responseStr = endpoint(id_, request.args)
-    return getFlaskResponse(responseStr)
+    mimetype = getResponseMimetype(request)
+    responseStr = endpoint(id_, request.args, mimetype)
+    return getFlaskResponse(responseStr, mimetype=mimetype)
+
+
+def handleListReferenceBases(id_, request):
+    """
+    Handles the specified HTTP GET request for the bases of a reference.
+    Clients asking for one of the RAW_BASES_MIMETYPES, or sending a Range
+    header, receive the bases unpaged as a stream; otherwise this is
+    handled as a regular list request.
+    """
+    mimetypes = protocol.MIMETYPES + RAW_BASES_MIMETYPES
+    mimetype = request.accept_mimetypes.best_match(mimetypes, MIMETYPE)
+    if mimetype not in RAW_BASES_MIMETYPES:
+        if request.range is None:
+            return handleList(
+                id_, app.backend.runListReferenceBases, request)
+        mimetype = RAW_BASES_MIMETYPES[0]
+    # Only a single byte range is supported; any other Range header is
+    # ignored, as permitted by RFC 7233.
+    byteRange = None
+    if request.range is not None and request.range.units == "bytes" and \
+            len(request.range.ranges) == 1:
+        byteRange = request.range.ranges[0]
+    start, end, length, chunks = app.backend.runListReferenceBasesRaw(
+        id_, request.args, byteRange)
+    response = getFlaskResponse(chunks, mimetype=mimetype)
+    response.content_length = end - start
+    response.headers["Accept-Ranges"] = "bytes"
+    if byteRange is not None:
+        response.status_code = 206
+        response.headers["Content-Range"] = "bytes {}-{}/{}".format(
+            start, end - 1, length)
+    return response
 
 
-def handleHttpGet(id_, endpoint):
+def handleGenotypeMatrix(request):
+    """
+    Handles the specified HTTP POST request for a genotype matrix. The
+    request body is a SearchVariantsRequest, and the likelihoods are
+    included in the response if the includeLikelihoods query parameter
+    is true.
+    """
+    if request.mimetype not in protocol.MIMETYPES:
+        raise exceptions.UnsupportedMediaTypeException()
+    includeLikelihoods = request.args.get(
+        "includeLikelihoods", "false").lower() == "true"
+    responseStr = app.backend.runGetGenotypeMatrix(
+        request.get_data(), request.mimetype, includeLikelihoods)
+    return getFlaskResponse(responseStr, mimetype=npy.MIMETYPE)
+
+
+def handleHttpGet(id_, endpoint, request):
     """
     Handles the specified HTTP GET request, which maps to the specified
     protocol handler endpoint and protocol request class
     """
-    responseStr = endpoint(id_)
-    return getFlaskResponse(responseStr)
+    mimetype = getResponseMimetype(request)
+    responseStr = endpoint(id_, mimetype)
+    return getFlaskResponse(responseStr, mimetype=mimetype)
 
 
 def handleHttpOptions():
@@ -448,7 +571,7 @@ def handleFlaskGetRequest(id_, flaskRequest, endpoint):
     Invokes the specified endpoint to generate a response.
     """
     if flaskRequest.method == "GET":
-        return handleHttpGet(id_, endpoint)
+        return handleHttpGet(id_, endpoint, flaskRequest)
     else:
         raise exceptions.MethodNotAllowedException()
 
@@ -464,13 +587,36 @@ def handleFlaskListRequest(id_, flaskRequest, endpoint):
         raise exceptions.MethodNotAllowedException()
 
 
-def handleFlaskPostRequest(flaskRequest, endpoint):
+def handleFlaskListReferenceBasesRequest(id_, flaskRequest):
+    """
+    Handles the specified flask request for the bases of a reference.
+    """
+    if flaskRequest.method == "GET":
+        return handleListReferenceBases(id_, flaskRequest)
+    else:
+        raise exceptions.MethodNotAllowedException()
+
+
+def handleFlaskPostRequest(flaskRequest, endpoint, partialResponses=False):
     """
     Handles the specified flask request for one of the POST URLS
-    Invokes the specified endpoint to generate a response.
+    Invokes the specified endpoint to generate a response, which may be
+    a partial response if partialResponses is True (see handleHttpPost).
+    """
+    if flaskRequest.method == "POST":
+        return handleHttpPost(flaskRequest, endpoint, partialResponses)
+    elif flaskRequest.method == "OPTIONS":
+        return handleHttpOptions()
+    else:
+        raise exceptions.MethodNotAllowedException()
+
+
+def handleFlaskGenotypeMatrixRequest(flaskRequest):
+    """
+    Handles the specified flask request for a genotype matrix.
     """
     if flaskRequest.method == "POST":
-        return handleHttpPost(flaskRequest, endpoint)
+        return handleGenotypeMatrix(flaskRequest)
     elif flaskRequest.method == "OPTIONS":
         return handleHttpOptions()
     else:
@@ -534,8 +680,7 @@ def getReferenceSet(id):
 
 @DisplayedRoute('/references/<id>/bases')
 def listReferenceBases(id):
-    return handleFlaskListRequest(
-        id, flask.request, app.backend.runListReferenceBases)
+    return handleFlaskListReferenceBasesRequest(id, flask.request)
 
 
 @DisplayedRoute('/callsets/search', postMethod=True)
@@ -553,7 +698,13 @@ def searchReadGroupSets():
 @DisplayedRoute('/reads/search', postMethod=True)
 def searchReads():
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchReads)
+        flask.request, app.backend.runSearchReads, partialResponses=True)
+
+
+@DisplayedRoute('/reads/batchsearch', postMethod=True)
+def batchSearchReads():
+    return handleFlaskPostRequest(
+        flask.request, app.backend.runBatchSearchReads, partialResponses=True)
 
 
 @DisplayedRoute('/referencesets/search', postMethod=True)
@@ -577,7 +728,19 @@ def searchVariantSets():
 @DisplayedRoute('/variants/search', postMethod=True)
 def searchVariants():
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchVariants)
+        flask.request, app.backend.runSearchVariants, partialResponses=True)
+
+
+@DisplayedRoute('/variants/batchsearch', postMethod=True)
+def batchSearchVariants():
+    return handleFlaskPostRequest(
+        flask.request, app.backend.runBatchSearchVariants,
+        partialResponses=True)
+
+
+@DisplayedRoute('/variants/genotypematrix', postMethod=True)
+def getGenotypeMatrix():
+    return handleFlaskGenotypeMatrixRequest(flask.request)
 
 
 @DisplayedRoute('/variantannotationsets/search', postMethod=True)
@@ -589,7 +752,8 @@ def searchVariantAnnotationSets():
 @DisplayedRoute('/variantannotations/search', postMethod=True)
 def searchVariantAnnotations():
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchVariantAnnotations)
+        flask.request, app.backend.runSearchVariantAnnotations,
+        partialResponses=True)
 
 
 @DisplayedRoute('/datasets/search', postMethod=True)
@@ -607,7 +771,7 @@ def searchFeatureSets():
 @DisplayedRoute('/features/search', postMethod=True)
 def searchFeatures():
     return handleFlaskPostRequest(
-        flask.request, app.backend.runSearchFeatures)
+        flask.request, app.backend.runSearchFeatures, partialResponses=True)
 
 
 @DisplayedRoute('/biosamples/search', postMethod=True)
@@ -0,0 +1,100 @@
+"""
+Encoding of arrays in the NumPy .npy and .npz formats, so that dense
+numeric data can be served without the server depending on NumPy.
+See https://docs.scipy.org/doc/numpy/neps/npy-format.html
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import array
+import io
+import struct
+import sys
+import zipfile
+
+
+MIMETYPE = "application/x-npz"
+
+NPY_MAGIC = b"\x93NUMPY\x01\x00"
+
+# The struct format characters for the numeric dtypes we can encode.
+_structFormats = {
+    "<i1": "b",
+    "<i2": "h",
+    "<i4": "i",
+    "<i8": "q",
+    "<f4": "f",
+    "<f8": "d",
+}
+
+
+def _getNumElements(shape):
+    numElements = 1
+    for size in shape:
+        numElements *= size
+    return numElements
+
+
+def _encodeHeader(dtype, shape):
+    if len(shape) == 1:
+        shapeStr = "({},)".format(shape[0])
+    else:
+        shapeStr = "({})".format(", ".join(str(size) for size in shape))
+    header = "{{'descr': '{}', 'fortran_order': False, 'shape': {}, }}".format(
+        dtype, shapeStr)
+    # The header is padded with spaces and terminated with a newline so
+    # that the data starts at a multiple of 16 bytes.
+    prefixLength = len(NPY_MAGIC) + 2
+    padding = 16 - (prefixLength + len(header) + 1) % 16
+    header = (header + " " * (padding % 16) + "\n").encode("ascii")
+    return NPY_MAGIC + struct.pack(str("<H"), len(header)) + header
+
+
+def encodeArray(dtype, shape, values):
+    """
+    Returns the .npy encoding of the array with the specified dtype and
+    shape, whose elements are listed in C (row-major) order in the
+    specified values. The dtype is either one of the little-endian
+    numeric types <i1, <i2, <i4, <i8, <f4 and <f8, or a fixed length
+    byte string type |Sn, in which case the values are byte strings of
+    length at most n. Numeric values may also be given as an
+    array.array of the matching type, which is copied without
+    packing each element.
+    """
+    if len(values) != _getNumElements(shape):
+        raise ValueError(
+            "Number of values does not match shape {}".format(shape))
+    if dtype.startswith("|S"):
+        length = int(dtype[2:])
+        data = b"".join(value.ljust(length, b"\0") for value in values)
+    elif (isinstance(values, array.array) and
+            values.typecode == _structFormats[dtype]):
+        if sys.byteorder != "little":
+            values = array.array(values.typecode, values)
+            values.byteswap()
+        data = values.tostring()
+    else:
+        data = struct.pack(
+            str("<{}{}".format(len(values), _structFormats[dtype])),
+            *values)
+    return _encodeHeader(dtype, shape) + data
+
+
+def encodeArchive(arrays):
+    """
+    Returns the .npz encoding of the specified list of (name, dtype,
+    shape, values) tuples, each of which is encoded as for encodeArray.
+    Such an archive is read by numpy.load as a mapping of the names to
+    the arrays.
+    """
+    output = io.BytesIO()
+    archive = zipfile.ZipFile(output, "w", zipfile.ZIP_STORED)
+    try:
+        for name, dtype, shape, values in arrays:
+            archive.writestr(
+                str(name + ".npy"), encodeArray(dtype, shape, values))
+    finally:
+        archive.close()
+    return output.getvalue()
@@ -0,0 +1,493 @@
+"""
+A pre-forking WSGI server. The application is set up once in a master
+process, which then forks the worker processes that serve requests from
+a shared listening socket. The workers therefore share everything loaded
+before the fork copy-on-write, rather than each loading it themselves.
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import io
+import logging
+import os
+import Queue
+import select
+import signal
+import socket
+import threading
+import time
+
+import werkzeug.serving
+
+
+class _ResponseBuffer(io.BytesIO):
+    """
+    A file for the response written by a request handler, which keeps
+    its contents when the handler closes it.
+    """
+    def close(self):
+        pass
+
+
+class _BufferedConnection(object):
+    """
+    A request socket for which the response written by a request handler
+    is buffered rather than sent.
+    """
+    def __init__(self, connection):
+        self._connection = connection
+        self._responseBuffer = _ResponseBuffer()
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def makefile(self, mode="r", bufsize=-1):
+        if "w" in mode:
+            return self._responseBuffer
+        return self._connection.makefile(mode, bufsize)
+
+    def getResponse(self):
+        """
+        Returns the response written to this connection.
+        """
+        return self._responseBuffer.getvalue()
+
+
+class _ResponseBody(object):
+    """
+    An iterator over the chunks of a WSGI application's response, which
+    closes the application's iterator when it is closed.
+    """
+    def __init__(self, appIter):
+        self._appIter = appIter
+        self._iterator = iter(appIter)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self._iterator)
+
+    def close(self):
+        if hasattr(self._appIter, "close"):
+            self._appIter.close()
+
+
+class _PendingResponse(object):
+    """
+    A response that is being sent by a ResponseWriter: the part of it
+    held in memory, and the iterator over the rest of its body.
+    """
+    def __init__(self, request, chunk, body):
+        self.request = request
+        self.chunk = memoryview(chunk)
+        self.offset = 0
+        self.body = body
+        self.sendTime = time.time()
+
+    def nextChunk(self):
+        """
+        Replaces the chunk being sent with the next non-empty chunk of
+        the body, returning False if the body has been sent in full.
+        """
+        self.chunk = None
+        self.offset = 0
+        if self.body is None:
+            return False
+        for chunk in self.body:
+            if len(chunk) > 0:
+                self.chunk = memoryview(chunk)
+                return True
+        return False
+
+    def close(self):
+        """
+        Closes the iterator over the body of this response.
+        """
+        if self.body is not None and hasattr(self.body, "close"):
+            self.body.close()
+        self.body = None
+
+
+class ResponseWriter(object):
+    """
+    Sends responses to their clients from a single thread that polls
+    the client sockets, so that slow clients do not hold the threads
+    that handle requests. Responses to clients that accept no data for
+    sendTimeout seconds are abandoned.
+
+    Each response is written as its start, held in memory, followed by
+    an optional iterator over the rest of its body. The body is read a
+    chunk at a time, only once the previous chunk has been sent, so
+    streamed responses are never held in memory in full. Writing a
+    response waits while the responses held in memory exceed
+    maxPendingBytes.
+    """
+    _chunkSize = 65536
+
+    def __init__(
+            self, server, sendTimeout=60, maxPendingBytes=64 * 1024 * 1024):
+        self._server = server
+        self._sendTimeout = sendTimeout
+        self._maxPendingBytes = maxPendingBytes
+        self._newResponses = Queue.Queue()
+        self._wakeupReader, self._wakeupWriter = os.pipe()
+        self._thread = None
+        # PendingResponses keyed by the request's file descriptor
+        self._pending = {}
+        # The number of bytes of the chunks being sent, which is guarded
+        # by _pendingBytesCondition.
+        self._pendingBytes = 0
+        self._pendingBytesCondition = threading.Condition()
+
+    def start(self):
+        """
+        Starts the thread sending responses.
+        """
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the thread once all responses have been sent or abandoned.
+        """
+        self._newResponses.put(None)
+        os.write(self._wakeupWriter, b"x")
+        self._thread.join()
+
+    def write(self, request, response, body=None):
+        """
+        Sends the specified response, followed by the chunks of the
+        specified body iterator if it is not None, to the client of the
+        specified request, and then shuts the request down.
+        """
+        with self._pendingBytesCondition:
+            # A response larger than the limit is sent on its own.
+            while self._pendingBytes > 0 and \
+                    self._pendingBytes + len(response) > \
+                    self._maxPendingBytes:
+                self._pendingBytesCondition.wait()
+            self._pendingBytes += len(response)
+        self._newResponses.put(_PendingResponse(request, response, body))
+        os.write(self._wakeupWriter, b"x")
+
+    def _updatePendingBytes(self, change):
+        with self._pendingBytesCondition:
+            self._pendingBytes += change
+            self._pendingBytesCondition.notify_all()
+
+    def _addResponses(self, poller):
+        # Returns True if the writer has been stopped.
+        stopped = False
+        os.read(self._wakeupReader, 4096)
+        while not self._newResponses.empty():
+            response = self._newResponses.get()
+            if response is None:
+                stopped = True
+            else:
+                response.request.setblocking(False)
+                self._pending[response.request.fileno()] = response
+                poller.register(response.request, select.POLLOUT)
+        return stopped
+
+    def _send(self, fd):
+        # Returns True if the response has been sent in full.
+        response = self._pending[fd]
+        try:
+            response.offset += response.request.send(
+                response.chunk[
+                    response.offset:response.offset + self._chunkSize])
+        except socket.error as error:
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            # The client has gone away.
+            return True
+        response.sendTime = time.time()
+        if response.offset < len(response.chunk):
+            return False
+        self._updatePendingBytes(-len(response.chunk))
+        try:
+            sent = not response.nextChunk()
+        except Exception:
+            logging.exception("Failed to read the body of a response")
+            return True
+        if not sent:
+            self._updatePendingBytes(len(response.chunk))
+        return sent
+
+    def _finish(self, poller, fd):
+        response = self._pending.pop(fd)
+        poller.unregister(fd)
+        if response.chunk is not None:
+            self._updatePendingBytes(-len(response.chunk))
+        try:
+            response.close()
+        except Exception:
+            logging.exception("Failed to close the body of a response")
+        self._server.shutdown_request(response.request)
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._wakeupReader, select.POLLIN)
+        stopped = False
+        while not stopped or len(self._pending) > 0:
+            try:
+                events = poller.poll(1000)
+            except select.error as error:
+                if error.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, _ in events:
+                if fd == self._wakeupReader:
+                    stopped = self._addResponses(poller) or stopped
+                elif self._send(fd):
+                    self._finish(poller, fd)
+            timeoutTime = time.time() - self._sendTimeout
+            for fd, response in list(self._pending.items()):
+                if response.sendTime < timeoutTime:
+                    self._finish(poller, fd)
+
+
+class ThreadPoolMixIn(object):
+    """
+    Mix-in for a werkzeug WSGI server class that handles requests in a
+    fixed pool of threads. At most one accepted request waits for a free
+    thread, so that a busy worker leaves new connections to the other
+    workers.
+
+    If responses are buffered, the thread handling a request writes the
+    start of its response to memory, and a ResponseWriter sends it and
+    then reads the rest of the body from the application as the client
+    accepts it.
+    """
+    def startThreads(
+            self, numThreads, bufferResponses=False, sendTimeout=60,
+            maxPendingBytes=64 * 1024 * 1024):
+        """
+        Starts the specified number of threads for handling requests. If
+        bufferResponses is True, responses to clients that accept no data
+        for sendTimeout seconds are abandoned, and request threads wait
+        while more than maxPendingBytes of responses are held in memory.
+        """
+        self._requestQueue = Queue.Queue(1)
+        self._numRequests = 0
+        self._responseWriter = None
+        if bufferResponses:
+            self._responseWriter = ResponseWriter(
+                self, sendTimeout, maxPendingBytes)
+            self._responseWriter.start()
+            self._deferredBodies = threading.local()
+            self._application = self.app
+            self.app = self._deferBody
+        self._threads = []
+        for _ in range(numThreads):
+            thread = threading.Thread(target=self._processRequests)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stopThreads(self):
+        """
+        Stops the threads once they have handled all queued requests.
+        """
+        for _ in self._threads:
+            self._requestQueue.put(None)
+        for thread in self._threads:
+            thread.join()
+        if self._responseWriter is not None:
+            self._responseWriter.stop()
+            self.app = self._application
+
+    def _processRequests(self):
+        while True:
+            item = self._requestQueue.get()
+            if item is None:
+                break
+            request, clientAddress = item
+            if self._responseWriter is None:
+                self._processRequest(request, clientAddress)
+            else:
+                self._processBufferedRequest(request, clientAddress)
+
+    def _processRequest(self, request, clientAddress):
+        try:
+            self.finish_request(request, clientAddress)
+        except Exception:
+            self.handle_error(request, clientAddress)
+        finally:
+            self.shutdown_request(request)
+
+    def _deferBody(self, environ, startResponse):
+        # The application run by the request handlers when responses are
+        # buffered. The handler is given the first chunk of the body,
+        # which also makes the application start the response, and the
+        # rest is left to the ResponseWriter.
+        appIter = self._application(environ, startResponse)
+        body = _ResponseBody(appIter)
+        try:
+            firstChunk = next(body, b"")
+        except Exception:
+            body.close()
+            raise
+        self._deferredBodies.body = body
+        return [firstChunk]
+
+    def _processBufferedRequest(self, request, clientAddress):
+        connection = _BufferedConnection(request)
+        self._deferredBodies.body = None
+        try:
+            self.finish_request(connection, clientAddress)
+        except Exception:
+            if self._deferredBodies.body is not None:
+                self._deferredBodies.body.close()
+            self.handle_error(request, clientAddress)
+            self.shutdown_request(request)
+        else:
+            self._responseWriter.write(
+                request, connection.getResponse(), self._deferredBodies.body)
+        finally:
+            self._deferredBodies.body = None
+
+    def process_request(self, request, clientAddress):
+        self._numRequests += 1
+        self._requestQueue.put((request, clientAddress))
+
+    def getNumRequests(self):
+        """
+        Returns the number of requests accepted by this server.
+        """
+        return self._numRequests
+
+
+class ThreadPoolWSGIServer(ThreadPoolMixIn, werkzeug.serving.BaseWSGIServer):
+    """
+    A werkzeug WSGI server that handles requests in a fixed thread pool.
+    """
+
+
+class PreforkServer(object):
+    """
+    Serves a WSGI application from a number of forked worker processes,
+    each handling requests in its own pool of threads.
+
+    The master process restarts workers that exit. A worker exits
+    gracefully, finishing the requests it has accepted, when it has
+    handled maxRequests requests (if this is not None) or on SIGTERM.
+    SIGHUP to the master gracefully restarts all workers, and SIGTERM or
+    SIGINT stops the server.
+
+    If bufferResponses is True, responses are sent by a ResponseWriter in
+    each worker, so that the number of threads only limits the number of
+    requests being computed at once rather than the number of clients
+    being sent to. This is not supported with TLS.
+    """
+    def __init__(
+            self, app, host, port, numWorkers, numThreads=1,
+            maxRequests=None, postFork=None, sslContext=None,
+            bufferResponses=False):
+        if bufferResponses and sslContext is not None:
+            raise ValueError("Responses cannot be buffered with TLS")
+        self._app = app
+        self._numWorkers = numWorkers
+        self._numThreads = numThreads
+        self._bufferResponses = bufferResponses
+        self._maxRequests = maxRequests
+        self._postFork = postFork
+        self._server = ThreadPoolWSGIServer(
+            host, port, app, ssl_context=sslContext)
+        self._workerPids = set()
+        self._stopping = False
+
+    def getServerAddress(self):
+        """
+        Returns the (host, port) address that this server listens on.
+        """
+        return self._server.server_address
+
+    def getNumWorkers(self):
+        """
+        Returns the number of worker processes that are currently running.
+        """
+        return len(self._workerPids)
+
+    def _startWorker(self):
+        pid = os.fork()
+        if pid == 0:
+            exitCode = 0
+            try:
+                self._runWorker()
+            except Exception:
+                logging.exception("Worker {} failed".format(os.getpid()))
+                exitCode = 1
+            finally:
+                os._exit(exitCode)
+        self._workerPids.add(pid)
+
+    def _runWorker(self):
+        # Workers leave SIGINT and SIGHUP, which are also sent to them from
+        # a terminal, to the master, and stop once their accepted requests
+        # have been handled on SIGTERM.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self._stopWorker)
+        self._stopping = False
+        if self._postFork is not None:
+            self._postFork()
+        # The timeout lets the worker notice that it has been stopped.
+        self._server.timeout = 1
+        self._server.startThreads(self._numThreads, self._bufferResponses)
+        numRequests = 0
+        while not self._stopping and (
+                self._maxRequests is None or
+                numRequests < self._maxRequests):
+            try:
+                self._server.handle_request()
+            except (OSError, IOError) as error:
+                if error.errno != errno.EINTR:
+                    raise
+            numRequests = self._server.getNumRequests()
+        self._server.stopThreads()
+
+    def _stopWorker(self, signum, frame):
+        self._stopping = True
+
+    def _stopWorkers(self):
+        for pid in list(self._workerPids):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        self._stopWorkers()
+
+    def _restartWorkers(self, signum, frame):
+        # Stopped workers are replaced by serveForever.
+        self._stopWorkers()
+
+    def serveForever(self):
+        """
+        Forks the workers and restarts any that exit, until the server is
+        stopped by SIGTERM or SIGINT.
+        """
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, self._restartWorkers)
+        for _ in range(self._numWorkers):
+            self._startWorker()
+        while len(self._workerPids) > 0:
+            try:
+                pid, _ = os.wait()
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            self._workerPids.discard(pid)
+            if not self._stopping:
+                self._startWorker()
+        self._server.server_close()
@@ -54,6 +54,12 @@ _valueListNameMap = {
 }
 
 
+# The media types that messages can be exchanged in.
+MIMETYPE = "application/json"
+PROTOBUF_MIMETYPE = "application/x-protobuf"
+MIMETYPES = [MIMETYPE, PROTOBUF_MIMETYPE]
+
+
 def getValueListName(protocolResponseClass):
     """
     Returns the name of the attribute in the specified protocol class
@@ -108,6 +114,133 @@ def fromJson(json, protoClass):
     return json_format.Parse(json, protoClass())
 
 
+def serialize(protoObject, mimetype=MIMETYPE):
+    """
+    Serialises a protobuf object in the specified media type; either
+    JSON or the binary protobuf wire format.
+    """
+    if mimetype == PROTOBUF_MIMETYPE:
+        return protoObject.SerializeToString()
+    return toJson(protoObject)
+
+
+def deserialize(data, protoClass, mimetype=MIMETYPE):
+    """
+    Deserialises data in the specified media type into an instance of
+    the specified protobuf class.
+    """
+    if mimetype == PROTOBUF_MIMETYPE:
+        protoObject = protoClass()
+        protoObject.ParseFromString(data)
+        return protoObject
+    return fromJson(data, protoClass)
+
+
+def encodeVarint(value):
+    """
+    Returns the protobuf wire format varint encoding of the specified
+    non-negative integer.
+    """
+    ret = bytearray()
+    while True:
+        bits = value & 0x7f
+        value >>= 7
+        if value:
+            ret.append(bits | 0x80)
+        else:
+            ret.append(bits)
+            return bytes(ret)
+
+
+def encodeLengthDelimitedField(fieldNumber, data):
+    """
+    Returns the protobuf wire format encoding of a length delimited
+    field (a string, bytes or embedded message) with the specified
+    field number and serialised value.
+    """
+    key = encodeVarint((fieldNumber << 3) | 2)
+    return key + encodeVarint(len(data)) + data
+
+
+def decodeVarint(data, position=0):
+    """
+    Decodes the protobuf wire format varint starting at the specified
+    position in the specified bytes, returning a (value, newPosition)
+    tuple. Raises a DecodeError if the varint is truncated.
+    """
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise message.DecodeError("Truncated varint")
+        byte = ord(data[position:position + 1])
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, position
+        shift += 7
+
+
+def deserializeBatchRequest(data, requestClass, mimetype=MIMETYPE):
+    """
+    Deserialises a batch of requests of the specified class. In JSON, a
+    batch is an object with a "requests" list; in the protobuf wire
+    format, it is a message whose field 1 is the repeated requests.
+    Returns the list of requests. Raises a DecodeError for malformed
+    protobuf data, and a ValueError for malformed JSON.
+    """
+    if mimetype == PROTOBUF_MIMETYPE:
+        requests = []
+        position = 0
+        while position < len(data):
+            key, position = decodeVarint(data, position)
+            if key != (1 << 3) | 2:
+                raise message.DecodeError("Unexpected field in batch")
+            length, position = decodeVarint(data, position)
+            if position + length > len(data):
+                raise message.DecodeError("Truncated batch request")
+            request = requestClass()
+            request.ParseFromString(data[position:position + length])
+            requests.append(request)
+            position += length
+        return requests
+    batch = json.loads(data)
+    if not isinstance(batch, dict) or \
+            not isinstance(batch.get("requests"), list):
+        raise ValueError("Batch requests must be a list named 'requests'")
+    if not all(isinstance(requestDict, dict)
+               for requestDict in batch["requests"]):
+        raise ValueError("Batched requests must be objects")
+    try:
+        return [
+            fromJson(json.dumps(requestDict), requestClass)
+            for requestDict in batch["requests"]]
+    except json_format.ParseError as error:
+        raise ValueError(str(error))
+
+
+def getSerializedBatchResponseChunks(responseBuilders, mimetype=MIMETYPE):
+    """
+    Returns an iterator over the pieces of the serialised batch of
+    responses built by the specified SearchResponseBuilders. The batch is
+    the counterpart of the batch of requests read by
+    deserializeBatchRequest, with a "responses" list in JSON and the
+    responses as field 1 in the protobuf wire format.
+    """
+    if mimetype == PROTOBUF_MIMETYPE:
+        for responseBuilder in responseBuilders:
+            yield encodeLengthDelimitedField(
+                1, responseBuilder.getSerializedResponse())
+        return
+    yield '{"responses": ['
+    for index, responseBuilder in enumerate(responseBuilders):
+        if index > 0:
+            yield ', '
+        for chunk in responseBuilder.getSerializedResponseChunks():
+            yield chunk
+    yield ']}'
+
+
 def validate(json, protoClass):
     """
     Check that json represents data that could be used to make
@@ -124,23 +257,53 @@ def validate(json, protoClass):
 class SearchResponseBuilder(object):
     """
     A class to allow sequential building of SearchResponse objects.
+    Values are serialised (to JSON or the protobuf wire format) as they
+    are added, and the response is written out by wrapping the serialised
+    values in the envelope for the response class, so that we never hold
+    a complete copy of the response as a protobuf object or as a
+    dictionary.
     """
-    def __init__(self, responseClass, pageSize, maxBufferSize):
+    def __init__(
+            self, responseClass, pageSize, maxBufferSize,
+            mimetype=MIMETYPE):
         """
         Allocates a new SearchResponseBuilder for the specified
         responseClass, user-requested pageSize and the system mandated
         maxBufferSize (in bytes). The maxBufferSize is an
         approximate limit on the overall length of the serialised
-        response.
+        response. The response is serialised in the specified mimetype.
         """
         self._responseClass = responseClass
         self._pageSize = pageSize
         self._maxBufferSize = maxBufferSize
+        self._mimetype = mimetype
         self._numElements = 0
         self._nextPageToken = None
-        self._protoObject = responseClass()
         self._valueListName = getValueListName(responseClass)
-        self._bufferSize = self._protoObject.ByteSize()
+        fields = responseClass.DESCRIPTOR.fields_by_name
+        self._valueListFieldNumber = fields[self._valueListName].number
+        self._nextPageTokenFieldNumber = fields["next_page_token"].number
+        if mimetype == PROTOBUF_MIMETYPE:
+            self._emptyString = b""
+            self._separator = b""
+        else:
+            self._emptyString = ""
+            self._separator = ", "
+            self._valueListJsonName = self._getValueListJsonName()
+        self._values = []
+        self._bufferSize = 0
+
+    def _getValueListJsonName(self):
+        """
+        Returns the name used for the value list in the JSON form of
+        the response class.
+        """
+        js = json_format._MessageToJsonObject(self._responseClass(), True)
+        for key, value in js.items():
+            if isinstance(value, list):
+                return key
+        raise ValueError(
+            "No value list in {}".format(self._responseClass.__name__))
 
     def getPageSize(self):
         """
@@ -153,8 +316,8 @@ class SearchResponseBuilder(object):
     def getMaxBufferSize(self):
         """
         Returns the maximum internal buffer size for responses, which
-        corresponds to total length (in bytes) of the serialised protobuf
-        objects. This will always be less than the size of JSON output.
+        corresponds to total length (in bytes) of the serialised values
+        in the value list.
         """
         return self._maxBufferSize
 
@@ -176,11 +339,22 @@ class SearchResponseBuilder(object):
         Appends the specified protocolElement to the value list for this
         response.
         """
+        self.addSerializedValue(serialize(protocolElement, self._mimetype))
+
+    def addSerializedValue(self, serializedElement):
+        """
+        Appends the specified protocol element, already serialised in the
+        mimetype of this response, to the value list for this response.
+        """
+        value = serializedElement
+        if self._mimetype == PROTOBUF_MIMETYPE:
+            value = encodeLengthDelimitedField(
+                self._valueListFieldNumber, serializedElement)
+        if self._numElements > 0:
+            self._bufferSize += len(self._separator)
         self._numElements += 1
-        self._bufferSize += protocolElement.ByteSize()
-        attr = getattr(self._protoObject, self._valueListName)
-        obj = attr.add()
-        obj.CopyFrom(protocolElement)
+        self._bufferSize += len(value)
+        self._values.append(value)
 
     def isFull(self):
         """
@@ -197,14 +371,123 @@ class SearchResponseBuilder(object):
             (self._bufferSize >= self._maxBufferSize)
         )
 
+    def _getPrefix(self):
+        """
+        Returns the serialised form of the response preceding the values.
+        """
+        if self._mimetype == PROTOBUF_MIMETYPE:
+            return b""
+        return '{{{}: ['.format(json.dumps(self._valueListJsonName))
+
+    def _getSuffix(self):
+        """
+        Returns the serialised form of the response following the values.
+        """
+        nextPageToken = pb.string(self._nextPageToken)
+        if self._mimetype == PROTOBUF_MIMETYPE:
+            if nextPageToken == "":
+                return b""
+            return encodeLengthDelimitedField(
+                self._nextPageTokenFieldNumber, nextPageToken.encode("utf-8"))
+        return '], "nextPageToken": {}}}'.format(json.dumps(nextPageToken))
+
+    def getSerializedResponseChunks(self, chunkSize=2**16):
+        """
+        Returns an iterator over the pieces of the serialised version
+        of the SearchResponse that has been built by this
+        SearchResponseBuilder, each of which is approximately chunkSize
+        bytes long. Concatenated, these are the value returned by
+        getSerializedResponse.
+        """
+        chunk = [self._getPrefix()]
+        length = len(chunk[0])
+        for index, value in enumerate(self._values):
+            if index > 0:
+                chunk.append(self._separator)
+                length += len(self._separator)
+            chunk.append(value)
+            length += len(value)
+            if length >= chunkSize:
+                yield self._emptyString.join(chunk)
+                chunk = []
+                length = 0
+        chunk.append(self._getSuffix())
+        yield self._emptyString.join(chunk)
+
     def getSerializedResponse(self):
         """
         Returns a string version of the SearchResponse that has
         been built by this SearchResponseBuilder.
         """
-        self._protoObject.next_page_token = pb.string(self._nextPageToken)
-        s = toJson(self._protoObject)
-        return s
+        return self._emptyString.join(self.getSerializedResponseChunks())
+
+
+class FieldMask(object):
+    """
+    The top-level fields of the objects in a search response that have
+    been requested by the client, for partial responses. A FieldMask
+    created without field names includes every field.
+
+    Objects are converted with the fields outside the mask that are
+    expensive to build left unset, and apply then clears any remaining
+    fields outside the mask.
+    """
+    def __init__(self, fieldNames=None):
+        self._fieldNames = None
+        if fieldNames is not None:
+            self._fieldNames = frozenset(fieldNames)
+
+    @classmethod
+    def parse(cls, descriptor, fields):
+        """
+        Returns the FieldMask for the specified comma separated list of
+        field names of the protocol message with the specified descriptor.
+        Fields may be named in the protobuf (snake_case) or the JSON
+        (camelCase) form. Raises a ValueError for unknown field names.
+        """
+        names = {}
+        for name in descriptor.fields_by_name:
+            words = name.split("_")
+            names[name] = name
+            names[words[0] + "".join(
+                word[:1].upper() + word[1:] for word in words[1:])] = name
+        fieldNames = []
+        for field in fields.split(","):
+            field = field.strip()
+            if field not in names:
+                raise ValueError(field)
+            fieldNames.append(names[field])
+        return cls(fieldNames)
+
+    def includes(self, fieldName):
+        """
+        Returns True if the specified field is in this mask.
+        """
+        return self._fieldNames is None or fieldName in self._fieldNames
+
+    def union(self, fieldNames):
+        """
+        Returns a FieldMask including the fields in this mask and the
+        specified fields.
+        """
+        if self._fieldNames is None:
+            return self
+        return FieldMask(self._fieldNames.union(fieldNames))
+
+    def apply(self, protocolElement):
+        """
+        Clears the fields of the specified protocol element that are not
+        in this mask, and returns it.
+        """
+        if self._fieldNames is not None:
+            for field, _ in protocolElement.ListFields():
+                if field.name not in self._fieldNames:
+                    protocolElement.ClearField(field.name)
+        return protocolElement
+
+
+# The FieldMask used when the client has not requested a partial response
+ALL_FIELDS = FieldMask()
 
 
 def getProtocolClasses(superclass=message.Message):
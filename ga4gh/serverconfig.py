@@ -20,6 +20,13 @@ class BaseConfig(object):
     REQUEST_VALIDATION = True
     RESPONSE_VALIDATION = False
     DEFAULT_PAGE_SIZE = 100
+    # Each request in a batch search can build a response of up to
+    # MAX_RESPONSE_LENGTH, so this bounds the size of batch responses.
+    MAX_BATCH_SEARCH_REQUESTS = 100
+    # The maximum number of variants x call sets in a genotype matrix,
+    # which is built in memory before being sent.
+    MAX_GENOTYPE_MATRIX_CELLS = 1024 * 1024
+    STREAM_SEARCH_RESPONSES = True
     DATA_SOURCE = "empty://"
 
     # Options for the simulated backend.
@@ -34,6 +41,34 @@ class BaseConfig(object):
 
     FILE_HANDLE_CACHE_MAX_SIZE = 50
 
+    # Parsed IDs retained so that repeated IDs are only decoded once.
+    COMPOUND_ID_CACHE_MAX_SIZE = 10000
+
+    # Reads and variants read ahead of their conversion by a separate
+    # thread for each search; 0 disables this. Searches that read ahead
+    # are not stored in the interval cursor cache between pages.
+    PYSAM_PREFETCH_SIZE = 0
+    # Decompression threads for each open BAM or VCF file. Values greater
+    # than 1 need pysam 0.10 or later.
+    HTSLIB_THREADS = 1
+    # Processes converting the reads and variants of each page in
+    # parallel; 0 converts them in the thread handling the request.
+    CONVERSION_PROCESSES = 0
+
+    # Idle read-only connections retained for SQLite-backed feature sets.
+    SQLITE_CONNECTION_POOL_MAX_SIZE = 20
+
+    # Suspended interval searches (reads, variants, annotations) retained
+    # so that the next page can continue them without re-seeking.
+    INTERVAL_CURSOR_CACHE_MAX_SIZE = 100
+    INTERVAL_CURSOR_TIME_TO_LIVE = 60  # seconds
+
+    # Read datasets from a SQL data repository when they are first used
+    # rather than at startup, holding at most the specified number of them
+    # in memory.
+    LAZY_REPOSITORY_LOADING = False
+    REPOSITORY_DATASET_CACHE_MAX_SIZE = 16
+
     LANDING_MESSAGE_HTML = "landing_message.html"
 
 
@@ -7,7 +7,9 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import sqlite3
+import threading
 
 
 def sqliteRows2dicts(sqliteRows):
@@ -74,6 +76,165 @@ def _whereClauseSql(**whereClauses):
         return ""
 
 
+# The UCSC genome browser binning scheme: five levels of bins of
+# 128Kb, 1Mb, 8Mb, 64Mb and 512Mb, finest level first.
+_binOffsets = [512 + 64 + 8 + 1, 64 + 8 + 1, 8 + 1, 1, 0]
+_binFirstShift = 17
+_binNextShift = 3
+_binMaxPosition = 2**29
+
+
+def getBin(start, end):
+    """
+    Returns the smallest bin that wholly contains the half-open interval
+    [start, end). Intervals beyond the binned range are assigned to the
+    top level bin, 0.
+    """
+    end = max(end, start + 1)
+    if start < 0 or end > _binMaxPosition:
+        return 0
+    startBin = start >> _binFirstShift
+    endBin = (end - 1) >> _binFirstShift
+    for offset in _binOffsets:
+        if startBin == endBin:
+            return offset + startBin
+        startBin >>= _binNextShift
+        endBin >>= _binNextShift
+    return 0
+
+
+def getBinRanges(start, end):
+    """
+    Returns a list of (firstBin, lastBin) pairs, one per level, such that
+    any interval overlapping [start, end) has a bin within one of the
+    inclusive ranges.
+    """
+    start = max(start, 0)
+    end = min(max(end, start + 1), _binMaxPosition)
+    if start >= _binMaxPosition:
+        return [(0, 0)]
+    startBin = start >> _binFirstShift
+    endBin = (end - 1) >> _binFirstShift
+    ranges = []
+    for offset in _binOffsets:
+        ranges.append((offset + startBin, offset + endBin))
+        startBin >>= _binNextShift
+        endBin >>= _binNextShift
+    return ranges
+
+
+class SqliteConnectionPool(object):
+    """
+    A bounded pool of idle read-only SQLite connections, keyed by database
+    file. Connections are handed out exclusively by acquire() and returned
+    by release(); once more than maxPoolSize connections are idle, those
+    belonging to the least recently used database files are closed.
+    """
+    # Negative cache_size is in KiB rather than pages.
+    cacheSizeKib = 16384
+    mmapSize = 256 * 1024 * 1024
+    # Size of each connection's prepared statement cache.
+    cachedStatements = 128
+
+    def __init__(self, maxPoolSize=20):
+        self._maxPoolSize = maxPoolSize
+        self._idleConnections = collections.OrderedDict()
+        self._numIdleConnections = 0
+        self._lock = threading.Lock()
+
+    def setMaxPoolSize(self, maxPoolSize):
+        """
+        Sets the maximum number of idle connections retained by the pool.
+        A value of 0 disables pooling, so that connections are closed as
+        soon as they are released.
+        """
+        if maxPoolSize < 0:
+            raise ValueError("The pool size must be non-negative")
+        with self._lock:
+            self._maxPoolSize = maxPoolSize
+            self._removeLru()
+
+    def getNumIdleConnections(self):
+        """
+        Returns the number of idle connections currently held in the pool.
+        """
+        return self._numIdleConnections
+
+    def _connect(self, dbFile):
+        """
+        Opens a new connection to the specified database file, configured
+        for read-only queries.
+        """
+        # Connections may be released by one thread and then acquired by
+        # another; the pool guarantees that they are never shared.
+        dbconn = sqlite3.connect(
+            dbFile, check_same_thread=False,
+            cached_statements=self.cachedStatements)
+        # row_factory setting is magic pixie dust to retrieve rows
+        # as dictionaries. sqliteRows2dict relies on this.
+        dbconn.row_factory = sqlite3.Row
+        dbconn.execute("PRAGMA query_only = ON")
+        dbconn.execute("PRAGMA cache_size = -{}".format(self.cacheSizeKib))
+        dbconn.execute("PRAGMA mmap_size = {}".format(self.mmapSize))
+        return dbconn
+
+    def _removeLru(self):
+        """
+        Closes idle connections, least recently used database file first,
+        until the pool is within its maximum size.
+        """
+        while self._numIdleConnections > self._maxPoolSize:
+            dbFile, connections = next(iter(self._idleConnections.items()))
+            connections.pop(0).close()
+            self._numIdleConnections -= 1
+            if len(connections) == 0:
+                del self._idleConnections[dbFile]
+
+    def acquire(self, dbFile):
+        """
+        Returns a connection to the specified database file for the
+        exclusive use of the caller, opening a new one if no idle
+        connection is available.
+        """
+        dbconn = None
+        with self._lock:
+            connections = self._idleConnections.pop(dbFile, None)
+            if connections is not None:
+                dbconn = connections.pop()
+                self._numIdleConnections -= 1
+                if len(connections) > 0:
+                    self._idleConnections[dbFile] = connections
+        if dbconn is None:
+            dbconn = self._connect(dbFile)
+        return dbconn
+
+    def release(self, dbFile, dbconn):
+        """
+        Returns the specified connection, previously obtained from acquire,
+        to the pool.
+        """
+        with self._lock:
+            connections = self._idleConnections.pop(dbFile, [])
+            connections.append(dbconn)
+            self._idleConnections[dbFile] = connections
+            self._numIdleConnections += 1
+            self._removeLru()
+
+    def closeAll(self):
+        """
+        Closes all idle connections held in the pool.
+        """
+        with self._lock:
+            for connections in self._idleConnections.values():
+                for dbconn in connections:
+                    dbconn.close()
+            self._idleConnections.clear()
+            self._numIdleConnections = 0
+
+
+connectionPool = SqliteConnectionPool()
+
+
 class SqliteBackedDataSource(object):
     """
     Abstract class that sets up a SQLite database source
@@ -94,19 +255,36 @@ class SqliteBackedDataSource(object):
             outDataItem.<somethingElse> = dict['<somethingElse_columnName>']
             outData.append(outDataItem)
         return count, outData
+
+    Connections are taken from the read-only connectionPool and returned
+    to it on exit. A data source may be entered concurrently by several
+    threads; each sees its own connection.
     """
-    def __init__(self, dbFile):
+    def __init__(self, dbFile, pool=None):
         """
         :param dbFile: string holding the full path to the database file.
+        :param pool: the SqliteConnectionPool to take connections from;
+            defaults to the module-level connectionPool.
         """
         self._dbFile = dbFile
+        self._pool = connectionPool if pool is None else pool
+        self._local = threading.local()
+
+    def _getConnectionStack(self):
+        stack = getattr(self._local, "connections", None)
+        if stack is None:
+            stack = []
+            self._local.connections = stack
+        return stack
+
+    @property
+    def _dbconn(self):
+        return self._getConnectionStack()[-1]
 
     def __enter__(self):
-        self._dbconn = sqlite3.connect(self._dbFile)
-        # row_factory setting is magic pixie dust to retrieve rows
-        # as dictionaries. sqliteRows2dict relies on this.
-        self._dbconn.row_factory = sqlite3.Row
+        self._getConnectionStack().append(self._pool.acquire(self._dbFile))
         return self
 
     def __exit__(self, type, value, traceback):
-        self._dbconn.close()
+        dbconn = self._getConnectionStack().pop()
+        self._pool.release(self._dbFile, dbconn)
@@ -19,6 +19,7 @@ import sqlite3
 import utils
 utils.ga4ghImportGlue()
 import ga4gh.gff3Parser as gff3  # NOQA
+import ga4gh.sqliteBackend as sqliteBackend  # NOQA
 
 # TODO: Shift this to use the Gff3DbBackend class.
 
@@ -42,7 +43,22 @@ _dbTableSQL = (
     "name TEXT,"
     "gene_name TEXT,"
     "transcript_name TEXT,"
-    "attributes TEXT);")
+    "attributes TEXT,"
+    "bin INT);")
+
+# Indexes created once the FEATURE table has been populated. Range queries
+# go through the UCSC bin index; the others cover the search filters and
+# return rows in the (reference_name, start, end, id) order used for paging.
+_dbIndexSQL = [
+    "CREATE INDEX feature_bin ON feature(reference_name, bin, start, end)",
+    "CREATE INDEX feature_position ON feature(reference_name, start, end)",
+    "CREATE INDEX feature_parent_id "
+    "ON feature(parent_id, reference_name, start, end)",
+    "CREATE INDEX feature_name ON feature(name, reference_name, start, end)",
+    "CREATE INDEX feature_gene_name "
+    "ON feature(gene_name, reference_name, start, end)",
+    "CREATE INDEX feature_type ON feature(type, reference_name, start, end)",
+]
 
 
 def _db_serialize(pyData):
@@ -77,7 +93,9 @@ class Gff32Db(object):
 
     def _insertValues(self, dbcur, dbconn):
         if len(self.valueList) > 0:
-            sql = "INSERT INTO feature VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+            sql = (
+                "INSERT INTO feature VALUES "
+                "(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)")
             dbcur.executemany(sql, self.valueList)
             dbconn.commit()
             self.valueList = []
@@ -114,13 +132,15 @@ class Gff32Db(object):
                     feature.featureName,
                     feature.attributes.get("gene_name", [None])[0],
                     feature.attributes.get("transcript_name", [None])[0],
-                    _db_serialize(feature.attributes))
+                    _db_serialize(feature.attributes),
+                    sqliteBackend.getBin(feature.start, feature.end))
                 self._batchInsertValues(values, dbcur, dbconn)
         self._insertValues(dbcur, dbconn)
-        dbcur.execute((
-            "create INDEX idx1 "
-            "on feature(start, end, reference_name)"))
-        dbcur.execute("PRAGMA INDEX_LIST('feature')")
+        for sql in _dbIndexSQL:
+            dbcur.execute(sql)
+        # Gather statistics so the query planner picks the right index
+        dbcur.execute("ANALYZE")
+        dbconn.commit()
 
         dbcur.close()
         dbconn.close()
@@ -7,6 +7,8 @@ from __future__ import unicode_literals
 
 import hashlib
 import os
+import shutil
+import tempfile
 import unittest
 
 # TODO it may be a bit circular to use pysam as our interface for
@@ -106,6 +108,77 @@ class ReferenceSetTest(datadriven.DataDrivenTest):
         referenceSetMd5 = referenceSet.getMd5Checksum()
         self.assertEqual(md5checksum, referenceSetMd5)
 
+    def _getChecksums(self, referenceSet):
+        return [
+            (reference.getLocalId(), reference.getMd5Checksum(),
+             reference.getLength())
+            for reference in referenceSet.getReferences()]
+
+    def testParallelMd5checksums(self):
+        referenceSet = references.HtslibReferenceSet(
+            self._gaObject.getLocalId())
+        referenceSet.populateFromFile(self._dataPath, numProcesses=2)
+        self.assertEqual(
+            self._getChecksums(referenceSet),
+            self._getChecksums(self._gaObject))
+
+    def testChecksumFile(self):
+        tempdir = tempfile.mkdtemp(prefix="ga4gh_checksums")
+        try:
+            dataPath = os.path.join(
+                tempdir, os.path.basename(self._dataPath))
+            for suffix in ["", ".fai", ".gzi"]:
+                shutil.copy(self._dataPath + suffix, dataPath + suffix)
+            localId = self._gaObject.getLocalId()
+            referenceSet = references.HtslibReferenceSet(localId)
+            referenceSet.populateFromFile(dataPath, useChecksumFile=True)
+            checksums = self._getChecksums(referenceSet)
+            expectedChecksums = dict(
+                (name, (md5, length)) for name, md5, length in checksums)
+            checksumFile = dataPath + references.CHECKSUM_FILE_SUFFIX
+            fastaFileStat = os.stat(dataPath)
+            self.assertEqual(
+                references.readChecksumFile(checksumFile, fastaFileStat),
+                expectedChecksums)
+            # Checksums in the file are reused when the lengths agree
+            name, md5checksum, length = checksums[0]
+            fakeChecksums = [
+                (otherName, "0" * 32, otherLength)
+                for otherName, _, otherLength in checksums]
+            references.writeChecksumFile(
+                checksumFile, fastaFileStat, fakeChecksums)
+            referenceSet = references.HtslibReferenceSet(localId)
+            referenceSet.populateFromFile(dataPath, useChecksumFile=True)
+            self.assertEqual(
+                referenceSet.getReferences()[0].getMd5Checksum(), "0" * 32)
+            # Recomputed checksums are written back to the file
+            references.writeChecksumFile(
+                checksumFile, fastaFileStat,
+                [(name, "0" * 32, length + 1)] + fakeChecksums[1:])
+            referenceSet = references.HtslibReferenceSet(localId)
+            referenceSet.populateFromFile(dataPath, useChecksumFile=True)
+            self.assertEqual(
+                referenceSet.getReferences()[0].getMd5Checksum(), md5checksum)
+            self.assertEqual(
+                references.readChecksumFile(checksumFile, fastaFileStat)[name],
+                expectedChecksums[name])
+            # The file is not used once the FASTA file has changed
+            references.writeChecksumFile(
+                checksumFile, fastaFileStat, fakeChecksums)
+            os.utime(dataPath, (
+                fastaFileStat.st_atime, fastaFileStat.st_mtime + 1))
+            self.assertEqual(
+                references.readChecksumFile(
+                    checksumFile, os.stat(dataPath)), {})
+            referenceSet = references.HtslibReferenceSet(localId)
+            referenceSet.populateFromFile(dataPath, useChecksumFile=True)
+            self.assertEqual(self._getChecksums(referenceSet), checksums)
+            self.assertEqual(
+                references.readChecksumFile(checksumFile, os.stat(dataPath)),
+                expectedChecksums)
+        finally:
+            shutil.rmtree(tempdir)
+
     def doRangeTest(self, start=None, end=None):
         referenceSet = self._gaObject
         for gaReference in referenceSet.getReferences():
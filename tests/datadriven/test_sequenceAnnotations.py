@@ -171,6 +171,29 @@ class FeatureSetTests(datadriven.DataDrivenTest):
         self.assertEqual(len(features), self._testData["totalFeatures"])
         self.assertIsNone(nextPageTokens[-1])
 
+    def testFetchAllFeaturesInRegionPaged(self):
+        args = (
+            self._testData["referenceName"],
+            self._testData["region"][0],
+            self._testData["region"][1])
+        allFeatures = [
+            feature for feature, _ in self._gaObject.getFeatures(
+                *args, pageToken=None, pageSize=1000)]
+        pageSize = 7
+        pagedFeatures = []
+        pageToken = None
+        while True:
+            page = list(self._gaObject.getFeatures(
+                *args, pageToken=pageToken, pageSize=pageSize))
+            self.assertLessEqual(len(page), pageSize)
+            pagedFeatures.extend(feature for feature, _ in page)
+            pageToken = page[-1][1]
+            if pageToken is None:
+                break
+        self.assertEqual(
+            [feature.id for feature in pagedFeatures],
+            [feature.id for feature in allFeatures])
+
     def testFetchFeaturesRestrictedByOntology(self):
         features = []
         for (feature, _) in self._gaObject.getFeatures(
@@ -7,13 +7,18 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import itertools
+import mock
 import unittest
 
 import ga4gh.exceptions as exceptions
 import ga4gh.backend as backend
 import ga4gh.datarepo as datarepo
+import ga4gh.datamodel as datamodel
 import ga4gh.datamodel.datasets as datasets
 import ga4gh.datamodel.references as references
+import ga4gh.datamodel.variants as variants
+import ga4gh.protocol as protocol
 
 import tests.paths as paths
 
@@ -177,6 +182,150 @@ class TestSqlRepoTestData(unittest.TestCase):
             self.assertEqual(self._dataRepo.getReferenceSetByName(name), rs)
 
 
+class TestIntervalCursorsOnFiles(unittest.TestCase):
+    """
+    Tests that iteration resumed from a suspended cursor is not disturbed
+    by other searches on the same file in the meantime.
+    """
+    def setUp(self):
+        dataset = datasets.Dataset("dataset")
+        self._variantSet = variants.HtslibVariantSet(dataset, "variantSet")
+        self._variantSet.populateFromDirectory(paths.vcfDirPath)
+        self._cursorCache = backend.IntervalCursorCache()
+
+    def _getIterator(self, start=0, pageToken=""):
+        request = protocol.SearchVariantsRequest(
+            reference_name="1", start=start, end=2 ** 30,
+            page_token=pageToken)
+        return backend.VariantsIntervalIterator(
+            request, self._variantSet, self._cursorCache)
+
+    def testSearchBetweenPages(self):
+        expected = [variant for variant, _ in self._getIterator()]
+        self.assertGreater(len(expected), 20)
+        iterator = self._getIterator()
+        firstPage = [
+            variant for variant, _ in itertools.islice(iterator, 10)]
+        pageToken = iterator.suspend()
+        self.assertEqual(pageToken.count(":"), 2)
+        # Another search and a GET on the same file, while the cursor is
+        # suspended.
+        otherIterator = self._getIterator(start=expected[15].start)
+        next(otherIterator)
+        compoundId = datamodel.VariantCompoundId.parse(expected[18].id)
+        self.assertEqual(
+            self._variantSet.getVariant(compoundId).id, expected[18].id)
+        rest = [variant for variant, _ in self._getIterator(
+            pageToken=pageToken)]
+        self.assertEqual(self._cursorCache.getNumCursors(), 0)
+        self.assertEqual(firstPage + rest, expected)
+        del otherIterator
+        self.assertEqual(datamodel.fileHandleCache.getNumCheckedOut(), 0)
+
+    def testCursorResumedAfterReload(self):
+        iterator = self._getIterator()
+        firstPage = [
+            variant for variant, _ in itertools.islice(iterator, 10)]
+        searchIterator = iterator._searchIterator
+        pageToken = iterator.suspend()
+        # The variant set is read again, as a lazily loaded dataset is
+        # after it has been evicted from the cache.
+        dataset = datasets.Dataset("dataset")
+        self._variantSet = variants.HtslibVariantSet(dataset, "variantSet")
+        self._variantSet.populateFromDirectory(paths.vcfDirPath)
+        iterator = self._getIterator(pageToken=pageToken)
+        self.assertIs(iterator._searchIterator, searchIterator)
+        rest = [variant for variant, _ in iterator]
+        self.assertEqual(
+            firstPage + rest, [variant for variant, _ in self._getIterator()])
+
+
+class TestParallelConversion(unittest.TestCase):
+    """
+    Tests that pages converted by a pool of processes are the same as
+    those converted serially.
+    """
+    def setUp(self):
+        self._dataRepo = datarepo.SimulatedDataRepository(
+            randomSeed=10, numCalls=2, variantDensity=1.0,
+            numAlignments=20)
+        self._dataset = self._dataRepo.getDatasets()[0]
+        self._serialBackend = backend.Backend(self._dataRepo)
+        self._parallelBackend = backend.Backend(self._dataRepo)
+        self._parallelBackend.setConversionProcesses(2)
+        self._parallelBackend.startConversionPool()
+
+    def tearDown(self):
+        self._parallelBackend.stopConversionPool()
+
+    def _getPages(self, searchBackend, methodName, request, responseClass):
+        pages = []
+        request.page_token = ""
+        while True:
+            response = protocol.fromJson(
+                getattr(searchBackend, methodName)(protocol.toJson(request)),
+                responseClass)
+            if not response.next_page_token:
+                pages.append(response)
+                return pages
+            request.page_token = response.next_page_token
+            # The key of the cursor stored for the next page is random.
+            response.next_page_token = ":".join(
+                response.next_page_token.split(":")[:2])
+            pages.append(response)
+
+    def _verifyPages(self, methodName, request, responseClass):
+        # The second page size is cut short by the maximum response length
+        # part way through a round of conversions.
+        for pageSize, maxResponseLength in [(7, 2 ** 20), (100, 4096)]:
+            request.page_size = pageSize
+            self._serialBackend.setMaxResponseLength(maxResponseLength)
+            self._parallelBackend.setMaxResponseLength(maxResponseLength)
+            serialPages = self._getPages(
+                self._serialBackend, methodName, request, responseClass)
+            parallelPages = self._getPages(
+                self._parallelBackend, methodName, request, responseClass)
+            self.assertGreater(len(serialPages), 1)
+            self.assertEqual(parallelPages, serialPages)
+
+    def testVariants(self):
+        variantSet = self._dataset.getVariantSets()[0]
+        request = protocol.SearchVariantsRequest(
+            variant_set_id=variantSet.getId(), reference_name="1",
+            start=0, end=100,
+            call_set_ids=[
+                callSet.getId() for callSet in variantSet.getCallSets()])
+        self._verifyPages(
+            "runSearchVariants", request, protocol.SearchVariantsResponse)
+
+    def _getReadsRequest(self):
+        readGroupSet = self._dataset.getReadGroupSets()[0]
+        readGroup = readGroupSet.getReadGroups()[0]
+        reference = readGroupSet.getReferenceSet().getReferences()[0]
+        return protocol.SearchReadsRequest(
+            read_group_ids=[readGroup.getId()],
+            reference_id=reference.getId(), start=0, end=2 ** 30)
+
+    def testReads(self):
+        self._verifyPages(
+            "runSearchReads", self._getReadsRequest(),
+            protocol.SearchReadsResponse)
+
+    def testIteratorClosedWithinRound(self):
+        request = self._getReadsRequest()
+        request.page_size = 100
+        self._parallelBackend.setMaxResponseLength(4096)
+        with mock.patch.object(
+                backend.IntervalIterator, "close", autospec=True,
+                side_effect=backend.IntervalIterator.close) as close:
+            pages = self._getPages(
+                self._parallelBackend, "runSearchReads", request,
+                protocol.SearchReadsResponse)
+        # Each page but the last is filled part way through a round.
+        self.assertGreater(len(pages), 1)
+        self.assertEqual(close.call_count, len(pages) - 1)
+
+
 class TestTopLevelObjectGenerator(unittest.TestCase):
     """
     Tests the generator used for top level objects
@@ -32,6 +32,17 @@ class TestServerArguments(unittest.TestCase):
         self.assertTrue(args.tls)
         self.assertTrue(args.dont_use_reloader)
 
+    def testParsePreforkArguments(self):
+        cliInput = (
+            "--workers 4 --threads 8 --max-requests 1000 "
+            "--buffer-responses")
+        parser = cli.getServerParser()
+        args = parser.parse_args(cliInput.split())
+        self.assertEqual(args.workers, 4)
+        self.assertEqual(args.threads, 8)
+        self.assertEqual(args.max_requests, 1000)
+        self.assertTrue(args.buffer_responses)
+
 
 class TestGa2VcfArguments(unittest.TestCase):
     """
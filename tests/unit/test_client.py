@@ -410,11 +410,23 @@ class DummyHttpClient(client.HttpClient):
         self._setup_http_session()
 
 
+def sendOverWire(gaObject, mimetype):
+    """
+    Returns a copy of the specified protocol object as received by a
+    client using the specified wire format. In the protobuf wire format,
+    float fields such as source_divergence lose precision.
+    """
+    return protocol.deserialize(
+        protocol.serialize(gaObject, mimetype), type(gaObject), mimetype)
+
+
 class ExhaustiveListingsMixin(object):
     """
     Tests exhaustive listings using the high-level API with a Simulated
     backend.
     """
+    mimetype = protocol.MIMETYPE
+
     @classmethod
     def setUpClass(cls):
         cls.backend = backend.Backend(datarepo.SimulatedDataRepository(
@@ -435,7 +447,8 @@ class ExhaustiveListingsMixin(object):
         """
         for gaObject, datamodelObject in utils.zipLists(
                 gaObjects, datamodelObjects):
-            self.assertEqual(gaObject, datamodelObject.toProtocolElement())
+            self.assertEqual(gaObject, sendOverWire(
+                datamodelObject.toProtocolElement(), self.mimetype))
             otherGaObject = getMethod(gaObject.id)
             self.assertEqual(gaObject, otherGaObject)
 
@@ -523,7 +536,8 @@ class ExhaustiveListingsMixin(object):
                             start, end))
                         self.assertGreater(len(reads), 0)
                         for dmRead, read in utils.zipLists(dmReads, reads):
-                            self.assertEqual(dmRead, read)
+                            self.assertEqual(
+                                sendOverWire(dmRead, self.mimetype), read)
 
 
 class TestExhaustiveListingsHttp(ExhaustiveListingsMixin, unittest.TestCase):
@@ -544,10 +558,24 @@ class TestExhaustiveListingsLocal(ExhaustiveListingsMixin, unittest.TestCase):
         return client.LocalClient(self.backend)
 
 
+class TestExhaustiveListingsLocalProtobuf(
+        ExhaustiveListingsMixin, unittest.TestCase):
+    """
+    Tests the exhaustive listings using the local client and the binary
+    protobuf wire format.
+    """
+    mimetype = protocol.PROTOBUF_MIMETYPE
+
+    def getClient(self):
+        return client.LocalClient(self.backend, mimetype=self.mimetype)
+
+
 class PagingMixin(object):
     """
     Tests the paging code using a simulated backend.
     """
+    mimetype = protocol.MIMETYPE
+
     @classmethod
     def setUpClass(cls):
         cls.numReferences = 25
@@ -562,7 +590,7 @@ class PagingMixin(object):
         self.datamodelReferenceSet = self.dataRepo.getReferenceSetByIndex(0)
         self.datamodelReferences = self.datamodelReferenceSet.getReferences()
         self.references = [
-            dmReference.toProtocolElement()
+            sendOverWire(dmReference.toProtocolElement(), self.mimetype)
             for dmReference in self.datamodelReferences]
         self.assertEqual(len(self.references), self.numReferences)
 
@@ -607,6 +635,17 @@ class TestPagingLocal(PagingMixin, unittest.TestCase):
         return client.LocalClient(self.backend)
 
 
+class TestPagingLocalProtobuf(PagingMixin, unittest.TestCase):
+    """
+    Tests paging using the local client and the binary protobuf wire
+    format.
+    """
+    mimetype = protocol.PROTOBUF_MIMETYPE
+
+    def getClient(self):
+        return client.LocalClient(self.backend, mimetype=self.mimetype)
+
+
 class TestPagingHttp(PagingMixin, unittest.TestCase):
     """
     Tests paging using the HTTP client.
@@ -170,6 +170,67 @@ class TestCompoundIds(unittest.TestCase):
         self.assertEqual(compoundIdStr, obfuscated)
         self.assertEqual(compoundId.__class__, ExampleCompoundId)
 
+    def testInstantiateWithParent(self):
+        # The ID of a child reuses the encoding of its parent's fields;
+        # check this for every alignment of the parent's fields with the
+        # groups of three bytes that are base64 encoded.
+        for datasetName in ["a", "ab", "abc", "\u00e9"]:
+            datasetId = datamodel.DatasetCompoundId(None, datasetName)
+            variantSetId = datamodel.VariantSetCompoundId(datasetId, "vs1")
+            variantId = datamodel.VariantCompoundId(
+                variantSetId, "chr1", "100", "md5")
+            idStr = '["{}","vs","vs1","chr1","100","md5"]'.format(
+                datasetName)
+            self.assertEqual(
+                str(variantId), datamodel.CompoundId.obfuscate(idStr))
+            self.assertEqual(variantId.dataset_id, str(datasetId))
+            self.assertEqual(variantId.variant_set_id, str(variantSetId))
+            parsedId = datamodel.VariantCompoundId.parse(str(variantId))
+            self.assertEqual(parsedId.start, "100")
+            self.assertEqual(parsedId.variant_set_id, str(variantSetId))
+
+    def testParseCache(self):
+        cache = datamodel.compoundIdCache
+        cache.clear()
+        idStr = str(ExampleCompoundId(None, "a", "b", "c"))
+        numHits = cache.getNumHits()
+        numMisses = cache.getNumMisses()
+        compoundId = ExampleCompoundId.parse(idStr)
+        self.assertIs(ExampleCompoundId.parse(idStr), compoundId)
+        self.assertEqual(cache.getNumHits(), numHits + 1)
+        self.assertEqual(cache.getNumMisses(), numMisses + 1)
+        # The cache is keyed by class as well as by string
+        self.assertNotIsInstance(
+            datamodel.DatasetCompoundId.parse(
+                str(datamodel.DatasetCompoundId(None, "a"))),
+            ExampleCompoundId)
+        self.assertEqual(cache.getCacheSize(), 2)
+
+    def testParseCacheBadIds(self):
+        cache = datamodel.compoundIdCache
+        cache.clear()
+        obfuscated = datamodel.CompoundId.obfuscate('["a","b"]')
+        for _ in range(2):
+            with self.assertRaises(exceptions.ObjectWithIdNotFoundException):
+                ExampleCompoundId.parse(obfuscated)
+        self.assertEqual(cache.getCacheSize(), 0)
+
+    def testParseCacheMaxSize(self):
+        cache = datamodel.CompoundIdCache()
+        self.assertRaises(ValueError, cache.setMaxCacheSize, -1)
+        cache.setMaxCacheSize(2)
+        idStrs = [
+            str(ExampleCompoundId(None, "a", "b", str(i))) for i in range(3)]
+        for idStr in idStrs:
+            cache.getCompoundId(ExampleCompoundId, idStr)
+        self.assertEqual(cache.getCacheSize(), 2)
+        cache.getCompoundId(ExampleCompoundId, idStrs[0])
+        self.assertEqual(cache.getNumHits(), 0)
+        cache.setMaxCacheSize(0)
+        self.assertEqual(cache.getCacheSize(), 0)
+        cache.getCompoundId(ExampleCompoundId, idStrs[0])
+        self.assertEqual(cache.getCacheSize(), 0)
+
     def getDataset(self):
         return datasets.Dataset("dataset")
 
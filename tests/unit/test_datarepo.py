@@ -5,13 +5,20 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import mock
 import os
+import shutil
 import tempfile
+import threading
 import unittest
 
+import ga4gh.datamodel.datasets as datasets
+import ga4gh.datamodel.ontologies as ontologies
 import ga4gh.datarepo as datarepo
 import ga4gh.exceptions as exceptions
 
+import tests.paths as paths
+
 
 prefix = "ga4gh_datarepo_test"
 
@@ -92,3 +99,185 @@ class TestBadDatabaseNoSetup(unittest.TestCase):
         repo = datarepo.SqlDataRepository("aFilePathThatDoesNotExist")
         with self.assertRaises(exceptions.RepoNotFoundException):
             repo.open(datarepo.MODE_READ)
+
+
+class TestLazyLoading(AbstractDataRepoTest):
+    """
+    Tests that datasets are read on first access in lazy mode.
+    """
+    def setUp(self):
+        super(TestLazyLoading, self).setUp()
+        repo = datarepo.SqlDataRepository(self._repoPath)
+        repo.open(datarepo.MODE_WRITE)
+        repo.initialise()
+        self._datasetNames = ["dataset1", "dataset2", "dataset3"]
+        for name in self._datasetNames:
+            repo.insertDataset(datasets.Dataset(name))
+        repo.commit()
+        repo.close()
+
+    def testDatasetsReadOnDemand(self):
+        repo = datarepo.SqlDataRepository(
+            self._repoPath, lazyLoading=True, maxCachedDatasets=2)
+        repo.open(datarepo.MODE_READ)
+        self.assertEqual(repo.getNumDatasets(), len(self._datasetNames))
+        self.assertEqual(repo.getNumCachedDatasets(), 0)
+        for index, name in enumerate(self._datasetNames):
+            dataset = repo.getDatasetByName(name)
+            self.assertEqual(dataset.getLocalId(), name)
+            self.assertEqual(repo.getDataset(dataset.getId()), dataset)
+            self.assertEqual(repo.getDatasetByIndex(index), dataset)
+            self.assertEqual(
+                repo.getNumCachedDatasets(), min(index + 1, 2))
+        self.assertEqual(
+            [loaded.getLocalId() for loaded in repo.getDatasets()],
+            self._datasetNames)
+        self.assertRaises(
+            exceptions.DatasetNotFoundException, repo.getDataset, "xyz")
+        self.assertRaises(
+            exceptions.DatasetNameNotFoundException,
+            repo.getDatasetByName, "xyz")
+
+    def _openLazyRepo(self):
+        repo = datarepo.SqlDataRepository(
+            self._repoPath, lazyLoading=True, maxCachedDatasets=2)
+        repo.open(datarepo.MODE_READ)
+        return repo
+
+    def testListingDoesNotReadDatasets(self):
+        repo = self._openLazyRepo()
+        names = [
+            repo.getDatasetSummaryByIndex(index).getLocalId()
+            for index in range(repo.getNumDatasets())]
+        self.assertEqual(names, self._datasetNames)
+        self.assertEqual(repo.getNumCachedDatasets(), 0)
+
+    def testConcurrentReads(self):
+        repo = self._openLazyRepo()
+        name = self._datasetNames[0]
+        loaded = []
+        with mock.patch.object(
+                repo, "_readDataset", wraps=repo._readDataset) as reader:
+            threads = [
+                threading.Thread(
+                    target=lambda: loaded.append(
+                        repo.getDatasetByName(name)))
+                for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(reader.call_count, 1)
+        self.assertEqual(len(loaded), 4)
+        self.assertTrue(all(dataset is loaded[0] for dataset in loaded))
+
+    def testFailedReadNotCached(self):
+        repo = self._openLazyRepo()
+        name = self._datasetNames[0]
+        with mock.patch.object(
+                repo, "_readIndividualTable", side_effect=IOError):
+            self.assertRaises(IOError, repo.getDatasetByName, name)
+        self.assertEqual(repo.getNumCachedDatasets(), 0)
+        self.assertEqual(repo.getDatasetByName(name).getLocalId(), name)
+        self.assertEqual(repo.getNumCachedDatasets(), 1)
+
+
+class TestLazySummaries(unittest.TestCase):
+    """
+    Tests that the contents of datasets are listed from the DB in lazy
+    mode, without reading the datasets.
+    """
+    summaryMethodNames = [
+        "getVariantSetSummaries", "getVariantAnnotationSetSummaries",
+        "getFeatureSetSummaries", "getReadGroupSetSummaries"]
+
+    def _openRepo(self, lazyLoading):
+        repo = datarepo.SqlDataRepository(
+            paths.testDataRepo, lazyLoading=lazyLoading)
+        repo.open(datarepo.MODE_READ)
+        return repo
+
+    def _getSummaries(self, repo, methodName, datasetId):
+        return sorted(
+            (summary.getId(), summary.getLocalId())
+            for summary in getattr(repo, methodName)(datasetId))
+
+    def _getReadGroupIds(self, repo, datasetId):
+        return {
+            readGroupSet.getId(): sorted(
+                readGroup.getId()
+                for readGroup in readGroupSet.getReadGroups())
+            for readGroupSet in repo.getReadGroupSetSummaries(datasetId)}
+
+    def testSummariesMatchDatasets(self):
+        repo = self._openRepo(False)
+        lazyRepo = self._openRepo(True)
+        for dataset in repo.getDatasets():
+            datasetId = dataset.getId()
+            for methodName in self.summaryMethodNames:
+                expected = self._getSummaries(repo, methodName, datasetId)
+                self.assertGreater(len(expected), 0)
+                self.assertEqual(
+                    self._getSummaries(lazyRepo, methodName, datasetId),
+                    expected)
+            self.assertEqual(
+                self._getReadGroupIds(lazyRepo, datasetId),
+                self._getReadGroupIds(repo, datasetId))
+        self.assertEqual(lazyRepo.getNumCachedDatasets(), 0)
+        for methodName in self.summaryMethodNames:
+            self.assertRaises(
+                exceptions.DatasetNotFoundException,
+                getattr(lazyRepo, methodName), "xyz")
+
+
+class TestCompiledOntologies(AbstractDataRepoTest):
+    """
+    Tests that ontology terms are loaded from the repository unless the
+    OBO file has changed.
+    """
+    def setUp(self):
+        super(TestCompiledOntologies, self).setUp()
+        _, self._oboPath = makeTempFile()
+        shutil.copyfile(paths.ontologyPath, self._oboPath)
+        self._ontology = ontologies.Ontology(paths.ontologyName)
+        self._ontology.populateFromFile(self._oboPath)
+        repo = datarepo.SqlDataRepository(self._repoPath)
+        repo.open(datarepo.MODE_WRITE)
+        repo.initialise()
+        repo.insertOntology(self._ontology)
+        repo.commit()
+        repo.close()
+
+    def tearDown(self):
+        super(TestCompiledOntologies, self).tearDown()
+        os.unlink(self._oboPath)
+
+    def _readOntology(self):
+        repo = datarepo.SqlDataRepository(self._repoPath)
+        repo.open(datarepo.MODE_READ)
+        return repo.getOntologyByName(paths.ontologyName)
+
+    def _assertSameTerms(self, ontology):
+        self.assertEqual(
+            sorted(ontology.getCompiledTerms()),
+            sorted(self._ontology.getCompiledTerms()))
+        self.assertEqual(
+            ontology.getSourceVersion(), self._ontology.getSourceVersion())
+        self.assertEqual(
+            ontology.getOntologyPrefix(), self._ontology.getOntologyPrefix())
+
+    def testCompiledTermsUsed(self):
+        with mock.patch("ga4gh.datamodel.ontologies.OboReader") as reader:
+            ontology = self._readOntology()
+            self._assertSameTerms(ontology)
+            self.assertFalse(reader.called)
+
+    def testChangedFileRead(self):
+        fileStat = os.stat(self._oboPath)
+        os.utime(self._oboPath, (fileStat.st_atime, fileStat.st_mtime + 1))
+        with mock.patch(
+                "ga4gh.datamodel.ontologies.OboReader",
+                wraps=ontologies.OboReader) as reader:
+            ontology = self._readOntology()
+            self._assertSameTerms(ontology)
+            self.assertTrue(reader.called)
@@ -7,7 +7,9 @@ from __future__ import unicode_literals
 
 import unittest
 
+import ga4gh.datamodel.bio_metadata as bio_metadata
 import ga4gh.datamodel.datasets as datasets
+import ga4gh.protocol as protocol
 
 
 class TestDatasets(unittest.TestCase):
@@ -19,3 +21,39 @@ class TestDatasets(unittest.TestCase):
         dataset = datasets.SimulatedDataset(datasetId, 1, 2, 3, 4, 5)
         gaDataset = dataset.toProtocolElement()
         self.assertEqual(dataset.getId(), gaDataset.id)
+
+    def testGetSerializedProtocolElement(self):
+        dataset = datasets.SimulatedDataset('ds1', 1, 2, 3, 4, 5)
+        for mimetype in protocol.MIMETYPES:
+            serialized = dataset.getSerializedProtocolElement(mimetype)
+            self.assertEqual(
+                serialized,
+                protocol.serialize(dataset.toProtocolElement(), mimetype))
+            self.assertIs(
+                dataset.getSerializedProtocolElement(mimetype), serialized)
+
+    def testSearchBioSamples(self):
+        dataset = datasets.Dataset('ds1')
+        for name, individualId in [
+                ("a", "i1"), ("b", "i2"), ("c", "i1"), ("d", None)]:
+            bioSample = bio_metadata.BioSample(dataset, name)
+            bioSample.setIndividualId(individualId)
+            dataset.addBioSample(bioSample)
+
+        def search(name=None, individualId=None):
+            return [
+                bioSample.getLocalId() for bioSample in
+                dataset.searchBioSamples(name, individualId)]
+
+        self.assertEqual(search(), ["a", "b", "c", "d"])
+        self.assertEqual(search(name=""), ["a", "b", "c", "d"])
+        self.assertEqual(search(name="b"), ["b"])
+        self.assertEqual(search(individualId="i1"), ["a", "c"])
+        self.assertEqual(search(name="c", individualId="i1"), ["c"])
+        self.assertEqual(search(name="b", individualId="i1"), [])
+        self.assertEqual(search(name="x"), [])
+        # The indexes are rebuilt when objects are added
+        bioSample = bio_metadata.BioSample(dataset, "e")
+        bioSample.setIndividualId("i1")
+        dataset.addBioSample(bioSample)
+        self.assertEqual(search(individualId="i1"), ["a", "c", "e"])
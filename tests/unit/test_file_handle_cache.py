@@ -9,6 +9,7 @@ from __future__ import unicode_literals
 import os
 import shutil
 import tempfile
+import threading
 import unittest
 import uuid
 
@@ -24,43 +25,131 @@ class TestFileHandleCache(datamodel.PysamFileHandleCache, unittest.TestCase):
         self._tempdir = tempfile.mkdtemp(prefix="ga4gh_file_cache",
                                          dir=tempfile.gettempdir())
 
+    def _genFileName(self):
+        return os.path.join(self._tempdir, str(uuid.uuid4()))
+
+    def _openMethod(self, dataFile):
+        return open(dataFile, 'w')
+
     def _getFileHandle(self, dataFile):
-        def openMethod(dataFile):
-            return open(dataFile, 'w')
-        return self.getFileHandle(dataFile, openMethod)
+        # Checks a handle out and straight back in again
+        with self.fileHandle(dataFile, self._openMethod) as handle:
+            return handle
 
-    def testGetFileHandle(self):
-        def genFileName(x):
-            return os.path.join(self._tempdir, str(uuid.uuid4()))
+    def _getCachedFileNames(self):
+        return [dataFile for dataFile, _ in self._cache]
 
+    def testGetFileHandle(self):
         # Set cache size to 9 files max
         self.setMaxCacheSize(9)
 
         # Build a list of 10 files and add their handles to the cache
-        fileList = map(genFileName, range(0, 10))
+        fileList = [self._genFileName() for _ in range(10)]
 
         for f in fileList:
             handle = self._getFileHandle(f)
-            self.assertEquals(self._cache.count((f, handle)), 1)
-
-        self.assertEquals(len(self._memoTable), len(self._cache))
+            self.assertEqual(self._cache[(f, id(handle))], handle)
 
         # Ensure that the first added file has been removed from the cache
-        self.assertEquals(filter(lambda x: x[0] == fileList[0], self._cache),
-                          [])
-
-        topIndex = len(self._cache) - 1
+        self.assertEqual(len(self._cache), 9)
+        self.assertNotIn(fileList[0], self._getCachedFileNames())
+        self.assertEqual(set(self.getCachedFiles()), set(fileList[1:]))
 
         # Update priority of this file and ensure it's no longer the
         # least recently used
-        self.assertEquals(self._cache[topIndex][0], fileList[1])
+        self.assertEqual(self._getCachedFileNames()[0], fileList[1])
+        self._getFileHandle(fileList[1])
+        self.assertNotEqual(self._getCachedFileNames()[0], fileList[1])
+        self.assertEqual(self._getCachedFileNames()[-1], fileList[1])
+
+    def testCounters(self):
+        self.setMaxCacheSize(1)
+        fileList = [self._genFileName() for _ in range(2)]
+        firstHandle = self._getFileHandle(fileList[0])
+        self.assertEqual(self._getFileHandle(fileList[0]), firstHandle)
         self._getFileHandle(fileList[1])
-        self.assertNotEqual(self._cache[topIndex][0], fileList[1])
-        self.assertEquals(self._cache[0][0], fileList[1])
+        self.assertEqual(self.getNumHits(), 1)
+        self.assertEqual(self.getNumMisses(), 2)
+        self.assertEqual(self.getNumEvictions(), 1)
+        self.assertTrue(firstHandle.closed)
+
+    def testCheckOutIsExclusive(self):
+        dataFile = self._genFileName()
+        handle = self.checkOutFileHandle(dataFile, self._openMethod)
+        otherHandle = self.checkOutFileHandle(dataFile, self._openMethod)
+        self.assertIsNot(handle, otherHandle)
+        self.assertEqual(self.getNumCheckedOut(), 2)
+        self.assertEqual(self.getCachedFiles(), [])
+        # Both handles are cached once checked in, and the most recently
+        # checked in is handed out first.
+        self.checkInFileHandle(handle)
+        self.checkInFileHandle(otherHandle)
+        self.assertEqual(self.getNumCheckedOut(), 0)
+        self.assertEqual(len(self._cache), 2)
+        self.assertIs(
+            self.checkOutFileHandle(dataFile, self._openMethod),
+            otherHandle)
+        self.assertIs(
+            self.checkOutFileHandle(dataFile, self._openMethod), handle)
+        self.checkInFileHandle(handle)
+        self.checkInFileHandle(otherHandle)
+
+    def testCheckOutAcrossThreads(self):
+        dataFile = self._genFileName()
+        handles = []
+
+        def getHandle():
+            handles.append(self._getFileHandle(dataFile))
+
+        # Handles are not tied to threads, so a handle checked in by one
+        # thread is reused by another.
+        getHandle()
+        thread = threading.Thread(target=getHandle)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(handles), 2)
+        self.assertIs(handles[0], handles[1])
+        self.assertEqual(self.getNumMisses(), 1)
+
+    def testCheckedOutHandleNotClosed(self):
+        self.setMaxCacheSize(1)
+        fileList = [self._genFileName() for _ in range(2)]
+        handle = self.checkOutFileHandle(fileList[0], self._openMethod)
+        otherHandle = self._getFileHandle(fileList[1])
+        self._getFileHandle(self._genFileName())
+        self.assertEqual(self.getNumEvictions(), 1)
+        self.assertTrue(otherHandle.closed)
+        self.assertFalse(handle.closed)
+        self.checkInFileHandle(handle)
+        self.assertFalse(handle.closed)
+        self.assertEqual(self.getCachedFiles(), [fileList[0]])
+
+    def testCheckedInHandleStaysCached(self):
+        dataFile = self._genFileName()
+        handle = self.checkOutFileHandle(dataFile, self._openMethod)
+        self.checkInFileHandle(handle)
+        self.assertFalse(handle.closed)
+        self.assertEqual(self._getFileHandle(dataFile), handle)
+
+    def testClear(self):
+        handles = [
+            self._getFileHandle(self._genFileName()) for _ in range(3)]
+        checkedOutHandle = self.checkOutFileHandle(
+            self._genFileName(), self._openMethod)
+        self.clear()
+        self.assertEqual(len(self._cache), 0)
+        self.assertTrue(all(handle.closed for handle in handles))
+        self.assertFalse(checkedOutHandle.closed)
+        self.checkInFileHandle(checkedOutHandle)
+        self.assertTrue(checkedOutHandle.closed)
+        self.assertEqual(len(self._cache), 0)
+        self.assertEqual(self._maxCacheSize, 50)
 
     def testSetCacheMaxSize(self):
         self.assertRaises(ValueError, self.setMaxCacheSize, 0)
         self.assertRaises(ValueError, self.setMaxCacheSize, -1)
 
     def tearDown(self):
+        for handle in self._cache.values():
+            handle.close()
         shutil.rmtree(self._tempdir)
@@ -167,6 +167,8 @@ class ImportGraphLayerChecker(object):
                       'ga4gh/gff3Parser.py',
                       'ga4gh/sqliteBackend.py'],
         'libraries': ['ga4gh/converters.py',
+                      'ga4gh/npy.py',
+                      'ga4gh/prefork.py',
                       'ga4gh/configtest.py'],
         'protocol': ['ga4gh/protocol.py',
                      'ga4gh/pb.py',
@@ -9,6 +9,7 @@ import unittest
 import random
 
 import ga4gh.backend as backend
+import ga4gh.datamodel as datamodel
 
 
 def setUp():
@@ -84,6 +85,9 @@ class IntervalSet(object):
         self.end = end
         self.intervals = sorted(intervals, key=lambda x: x[0])
 
+    def getId(self):
+        return "intervalSet"
+
     def get(self, start, end):
         """
         Returns an iterator over all intervals in this set that intersect
@@ -109,10 +113,12 @@ class TrivialIntervalIterator(backend.IntervalIterator):
     The simplest possible instance of the interval iterator
     used to test the iteration code.
     """
-    def __init__(self, intervalSet, start, end, pageToken=None):
+    def __init__(
+            self, intervalSet, start, end, pageToken=None, cursorCache=None):
         self.intervalSet = intervalSet
         request = FakeRequest(start, end, pageToken)
-        super(TrivialIntervalIterator, self).__init__(request, None)
+        super(TrivialIntervalIterator, self).__init__(
+            request, intervalSet, cursorCache)
 
     def _getContainer(self):
         return None
@@ -127,6 +133,24 @@ class TrivialIntervalIterator(backend.IntervalIterator):
         return interval[1]
 
 
+class ConvertingIntervalIterator(TrivialIntervalIterator):
+    """
+    An interval iterator over raw records which keeps track of the
+    records that were converted.
+    """
+    def __init__(self, *args, **kwargs):
+        self.numConversions = 0
+        super(ConvertingIntervalIterator, self).__init__(*args, **kwargs)
+
+    def _searchRecords(self, start, end):
+        for interval in self.intervalSet.get(start, end):
+            yield interval[0], interval
+
+    def _convertRecord(self, record):
+        self.numConversions += 1
+        return record
+
+
 class TestIntervalIterator(unittest.TestCase):
     """
     A class to systematically test the paging code over interval search
@@ -252,3 +276,221 @@ class TestIntervalIterator(unittest.TestCase):
                     self.verifyEmptyInterval(intervalSet, start, end)
                 else:
                     self.verifyInterval(intervalSet, start, end)
+
+    def testSkippedRecordsNotConverted(self):
+        for intervalSet in self.testIntervalSets:
+            start, end = intervalSet.start, intervalSet.end
+            allIntervals = list(intervalSet.get(start, end))
+            topIterator = list(ConvertingIntervalIterator(
+                intervalSet, start, end))
+            for index, (_, pageToken) in enumerate(topIterator[:-1]):
+                iterator = ConvertingIntervalIterator(
+                    intervalSet, start, end, pageToken)
+                self.assertEqual(iterator.numConversions, 0)
+                first, _ = next(iterator)
+                self.assertEqual(first, allIntervals[index + 1])
+                self.assertEqual(iterator.numConversions, 1)
+
+    def testSkipRecords(self):
+        for intervalSet in self.testIntervalSets:
+            start, end = intervalSet.start, intervalSet.end
+            allIntervals = list(intervalSet.get(start, end))
+            iterator = ConvertingIntervalIterator(intervalSet, start, end)
+            pageTokens = iterator.skipRecords(3)
+            pageTokens.extend(iterator.skipRecords(len(allIntervals)))
+            self.assertEqual(iterator.numConversions, 0)
+            self.assertEqual(len(pageTokens), len(allIntervals))
+            self.assertIsNone(iterator.suspend())
+            # Iteration picked up from each page token starts at the
+            # corresponding record.
+            for pageToken, interval in zip(pageTokens, allIntervals):
+                iterator = ConvertingIntervalIterator(
+                    intervalSet, start, end, pageToken)
+                self.assertEqual(next(iterator)[0], interval)
+
+
+class TestIntervalCursors(unittest.TestCase):
+    """
+    Tests for resuming interval iteration from suspended cursors.
+    """
+    def setUp(self):
+        self.intervalSet = IntervalSet(0, 100, randomIntervals(0, 100, 100))
+        self.allIntervals = list(
+            self.intervalSet.get(self.intervalSet.start, self.intervalSet.end))
+
+    def getPages(self, pageSize, cursorCache):
+        """
+        Returns the list of pages of intervals and the page tokens used,
+        suspending the iterator at the end of each page.
+        """
+        pages = []
+        pageTokens = []
+        pageToken = None
+        while True:
+            iterator = TrivialIntervalIterator(
+                self.intervalSet, self.intervalSet.start,
+                self.intervalSet.end, pageToken, cursorCache)
+            page = []
+            nextPageToken = None
+            for interval, nextPageToken in iterator:
+                page.append(interval)
+                if len(page) == pageSize:
+                    break
+            pages.append(page)
+            if nextPageToken is None:
+                break
+            pageToken = iterator.suspend()
+            pageTokens.append(pageToken)
+        return pages, pageTokens
+
+    def testPagingWithCursors(self):
+        cursorCache = backend.IntervalCursorCache()
+        for pageSize in [1, 2, 7, 50, 1000]:
+            pages, pageTokens = self.getPages(pageSize, cursorCache)
+            self.assertEqual(sum(pages, []), self.allIntervals)
+            for pageToken in pageTokens:
+                self.assertEqual(pageToken.count(":"), 2)
+            # Every cursor is consumed by the following page.
+            self.assertEqual(cursorCache.getNumCursors(), 0)
+
+    def testPagingWithoutCursors(self):
+        pages, pageTokens = self.getPages(7, None)
+        self.assertEqual(sum(pages, []), self.allIntervals)
+        for pageToken in pageTokens:
+            self.assertEqual(pageToken.count(":"), 1)
+
+    def testMissingCursorFallsBack(self):
+        cursorCache = backend.IntervalCursorCache()
+        iterator = TrivialIntervalIterator(
+            self.intervalSet, self.intervalSet.start, self.intervalSet.end,
+            cursorCache=cursorCache)
+        firstPage = [next(iterator)[0] for _ in range(10)]
+        pageToken = iterator.suspend()
+        # Resume twice from the same token; the second time, the cursor
+        # has been consumed and we must re-seek from the anchor.
+        for _ in range(2):
+            iterator = TrivialIntervalIterator(
+                self.intervalSet, self.intervalSet.start,
+                self.intervalSet.end, pageToken, cursorCache)
+            rest = [interval for interval, _ in iterator]
+            self.assertEqual(firstPage + rest, self.allIntervals)
+
+    def testMismatchedCursorIgnored(self):
+        cursorCache = backend.IntervalCursorCache()
+        iterator = TrivialIntervalIterator(
+            self.intervalSet, self.intervalSet.start, self.intervalSet.end,
+            cursorCache=cursorCache)
+        first = next(iterator)[0]
+        searchIterator = iterator._searchIterator
+        pageToken = iterator.suspend()
+        # A different search must not pick up the stored cursor.
+        iterator = TrivialIntervalIterator(
+            self.intervalSet, self.intervalSet.start,
+            self.intervalSet.end + 10, pageToken, cursorCache)
+        self.assertEqual(cursorCache.getNumCursors(), 0)
+        # The cursor taken from the cache is closed.
+        self.assertIsNone(next(searchIterator, None))
+        rest = [interval for interval, _ in iterator]
+        self.assertEqual([first] + rest, self.allIntervals)
+
+    def testNoCursorsWhenReadingAhead(self):
+        cursorCache = backend.IntervalCursorCache()
+        prefetchSize = datamodel.PysamDatamodelMixin.prefetchSize
+        datamodel.PysamDatamodelMixin.setPrefetchSize(64)
+        try:
+            iterator = TrivialIntervalIterator(
+                self.intervalSet, self.intervalSet.start,
+                self.intervalSet.end, cursorCache=cursorCache)
+            first = next(iterator)[0]
+            searchIterator = iterator._searchIterator
+            pageToken = iterator.suspend()
+        finally:
+            datamodel.PysamDatamodelMixin.setPrefetchSize(prefetchSize)
+        self.assertEqual(pageToken.count(":"), 1)
+        self.assertEqual(cursorCache.getNumCursors(), 0)
+        # The search iterator is closed rather than left reading ahead.
+        self.assertIsNone(next(searchIterator, None))
+        iterator = TrivialIntervalIterator(
+            self.intervalSet, self.intervalSet.start,
+            self.intervalSet.end, pageToken, cursorCache)
+        rest = [interval for interval, _ in iterator]
+        self.assertEqual([first] + rest, self.allIntervals)
+
+
+class FakeCursor(object):
+    """
+    A stand-in for an IntervalCursor, which records whether it is closed.
+    """
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestIntervalCursorCache(unittest.TestCase):
+    """
+    Tests the IntervalCursorCache eviction policies.
+    """
+    def testTakeOnce(self):
+        cache = backend.IntervalCursorCache()
+        cursor = FakeCursor()
+        cursorId = cache.add(cursor)
+        self.assertEqual(cache.getNumCursors(), 1)
+        self.assertIs(cache.take(cursorId), cursor)
+        self.assertIsNone(cache.take(cursorId))
+        self.assertEqual(cache.getNumCursors(), 0)
+        self.assertFalse(cursor.closed)
+
+    def testMaxSize(self):
+        cache = backend.IntervalCursorCache(maxCacheSize=3)
+        cursors = [FakeCursor() for _ in range(5)]
+        cursorIds = [cache.add(cursor) for cursor in cursors]
+        self.assertEqual(cache.getNumCursors(), 3)
+        self.assertIsNone(cache.take(cursorIds[0]))
+        self.assertIsNone(cache.take(cursorIds[1]))
+        for j in range(2, 5):
+            self.assertIs(cache.take(cursorIds[j]), cursors[j])
+        # Evicted cursors are closed.
+        self.assertEqual(
+            [cursor.closed for cursor in cursors],
+            [True, True, False, False, False])
+
+    def testDisabled(self):
+        cache = backend.IntervalCursorCache(maxCacheSize=0)
+        self.assertIsNone(cache.add(FakeCursor()))
+        self.assertEqual(cache.getNumCursors(), 0)
+
+    def testTimeToLive(self):
+        cache = backend.IntervalCursorCache()
+        cursorId = cache.add(FakeCursor())
+        # Age the entry artificially.
+        timestamp, cursor = cache._cursors[cursorId]
+        cache._cursors[cursorId] = timestamp - 61, cursor
+        self.assertIsNone(cache.take(cursorId))
+        self.assertEqual(cache.getNumCursors(), 0)
+        self.assertTrue(cursor.closed)
+
+    def testCloseCursor(self):
+        closed = []
+
+        def searchRecords():
+            try:
+                yield 0, "record"
+                yield 1, "record"
+            finally:
+                closed.append(True)
+
+        searchIterator = searchRecords()
+        next(searchIterator)
+        cursor = backend.IntervalCursor(
+            None, searchIterator, None, None, 0, 0)
+        cursor.close()
+        self.assertEqual(closed, [True])
+        # Cursors over plain iterators can be closed as well.
+        backend.IntervalCursor(None, iter([]), None, None, 0, 0).close()
+
+    def testBadValues(self):
+        cache = backend.IntervalCursorCache()
+        self.assertRaises(ValueError, cache.setMaxCacheSize, -1)
+        self.assertRaises(ValueError, cache.setTimeToLive, 0)
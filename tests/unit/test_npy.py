@@ -0,0 +1,86 @@
+"""
+Tests for the NumPy array encoding
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import array
+import ast
+import io
+import math
+import struct
+import unittest
+import zipfile
+
+import ga4gh.npy as npy
+
+
+def decodeArray(data):
+    """
+    Returns the (header, data) of the specified .npy encoding, where
+    header is the dict describing the array.
+    """
+    prefixLength = len(npy.NPY_MAGIC) + 2
+    (headerLength,) = struct.unpack(
+        str("<H"), data[len(npy.NPY_MAGIC):prefixLength])
+    headerStr = data[prefixLength:prefixLength + headerLength]
+    return (
+        ast.literal_eval(headerStr.decode("ascii")),
+        data[prefixLength + headerLength:])
+
+
+class TestNpy(unittest.TestCase):
+    """
+    Tests the .npy and .npz encodings
+    """
+    def testEncodeArray(self):
+        data = npy.encodeArray("<i1", (2, 3), [0, 1, -1, 2, 127, -128])
+        self.assertTrue(data.startswith(npy.NPY_MAGIC))
+        header, arrayData = decodeArray(data)
+        self.assertEqual(len(data) % 16, len(arrayData) % 16)
+        self.assertEqual(header, {
+            'descr': '<i1', 'fortran_order': False, 'shape': (2, 3)})
+        self.assertEqual(
+            list(struct.unpack(str("<6b"), arrayData)),
+            [0, 1, -1, 2, 127, -128])
+
+    def testEncodeFloatArray(self):
+        data = npy.encodeArray("<f4", (3,), [0.5, -100, float("nan")])
+        header, arrayData = decodeArray(data)
+        self.assertEqual(header['shape'], (3,))
+        values = struct.unpack(str("<3f"), arrayData)
+        self.assertEqual(values[:2], (0.5, -100))
+        self.assertTrue(math.isnan(values[2]))
+
+    def testEncodeArrayFromArray(self):
+        values = array.array(str("h"), [1, -2, 300, -32768])
+        self.assertEqual(
+            npy.encodeArray("<i2", (2, 2), values),
+            npy.encodeArray("<i2", (2, 2), list(values)))
+
+    def testEncodeEmptyArray(self):
+        header, arrayData = decodeArray(npy.encodeArray("<i8", (0, 4), []))
+        self.assertEqual(header['shape'], (0, 4))
+        self.assertEqual(arrayData, b"")
+
+    def testEncodeByteStringArray(self):
+        data = npy.encodeArray("|S3", (2,), [b"ab", b"cde"])
+        header, arrayData = decodeArray(data)
+        self.assertEqual(header['descr'], '|S3')
+        self.assertEqual(arrayData, b"ab\0cde")
+
+    def testShapeMismatch(self):
+        self.assertRaises(
+            ValueError, npy.encodeArray, "<i4", (2, 2), [1, 2, 3])
+
+    def testEncodeArchive(self):
+        data = npy.encodeArchive([
+            ("a", "<i4", (1,), [7]),
+            ("b", "<f8", (2,), [1.0, 2.0]),
+        ])
+        archive = zipfile.ZipFile(io.BytesIO(data))
+        self.assertEqual(sorted(archive.namelist()), ["a.npy", "b.npy"])
+        header, arrayData = decodeArray(archive.read("a.npy"))
+        self.assertEqual(header['descr'], '<i4')
+        self.assertEqual(struct.unpack(str("<i"), arrayData), (7,))
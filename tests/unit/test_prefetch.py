@@ -0,0 +1,78 @@
+"""
+Tests the prefetching of records in a separate thread
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import sys
+import threading
+import traceback
+import unittest
+
+import ga4gh.datamodel as datamodel
+
+
+class TestPrefetch(unittest.TestCase):
+    """
+    Tests for datamodel.prefetch
+    """
+    def _getItems(self, numItems, producerThreads):
+        for i in range(numItems):
+            producerThreads.add(threading.current_thread())
+            yield i
+
+    def testItemsInOrder(self):
+        for numItems in [0, 1, 63, 64, 65, 1000]:
+            for maxSize in [0, 1, 64, 200]:
+                producerThreads = set()
+                items = datamodel.prefetch(
+                    self._getItems(numItems, producerThreads), maxSize)
+                self.assertEqual(list(items), list(range(numItems)))
+
+    def testSeparateThread(self):
+        producerThreads = set()
+        list(datamodel.prefetch(self._getItems(10, producerThreads), 10))
+        self.assertNotIn(threading.current_thread(), producerThreads)
+        producerThreads = set()
+        list(datamodel.prefetch(self._getItems(10, producerThreads), 0))
+        self.assertEqual(producerThreads, set([threading.current_thread()]))
+
+    def testClose(self):
+        numThreads = threading.active_count()
+        producerThreads = set()
+        items = datamodel.prefetch(
+            self._getItems(100000, producerThreads), 64)
+        self.assertEqual(next(items), 0)
+        items.close()
+        self.assertEqual(threading.active_count(), numThreads)
+        for thread in producerThreads:
+            self.assertFalse(thread.is_alive())
+
+    def testException(self):
+        def getItems():
+            yield 1
+            raise ValueError("error")
+        items = datamodel.prefetch(getItems(), 10)
+        self.assertEqual(next(items), 1)
+        self.assertRaises(ValueError, next, items)
+
+    def testExceptionTraceback(self):
+        def getItems():
+            raise ValueError("error")
+            yield
+        items = datamodel.prefetch(getItems(), 10)
+        try:
+            next(items)
+        except ValueError:
+            stack = traceback.extract_tb(sys.exc_info()[2])
+        # The traceback runs to where the error was raised in the thread.
+        self.assertEqual(stack[-1][2], "getItems")
+
+    def testSetPrefetchSize(self):
+        self.assertRaises(
+            ValueError, datamodel.PysamDatamodelMixin.setPrefetchSize, -1)
+        self.assertRaises(
+            ValueError, datamodel.PysamDatamodelMixin.setHtslibThreads, 0)
+        self.assertEqual(
+            datamodel.PysamDatamodelMixin.getPysamOpenOptions(), {})
@@ -0,0 +1,224 @@
+"""
+Tests the pre-forking server
+"""
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import signal
+import socket
+import threading
+import time
+import unittest
+
+import ga4gh.prefork as prefork
+
+
+def simpleApp(environ, startResponse):
+    size = int(environ["PATH_INFO"].strip("/") or 0)
+    startResponse(
+        str("200 OK"), [(str("Content-Length"), str(size))])
+    return [b"x" * size]
+
+
+class StreamingApp(object):
+    """
+    A WSGI application that streams a response of numChunks chunks,
+    recording how many of them have been read.
+    """
+    chunkSize = 65536
+
+    def __init__(self, numChunks):
+        self.numChunks = numChunks
+        self.numChunksRead = 0
+        self.closed = False
+
+    def __call__(self, environ, startResponse):
+        startResponse(str("200 OK"), [])
+        return self._generateChunks()
+
+    def _generateChunks(self):
+        try:
+            for _ in range(self.numChunks):
+                self.numChunksRead += 1
+                yield b"x" * self.chunkSize
+        finally:
+            self.closed = True
+
+
+def pidApp(environ, startResponse):
+    startResponse(str("200 OK"), [])
+    return [str(os.getpid()).encode("ascii")]
+
+
+class ServerClient(object):
+    """
+    Sends requests to a server and reads their responses over a socket.
+    """
+    def __init__(self, address, receiveBufferSize=None, timeout=10):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if receiveBufferSize is not None:
+            self._socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF, receiveBufferSize)
+        self._socket.settimeout(timeout)
+        self._socket.connect(address)
+
+    def sendRequest(self, size):
+        self._socket.sendall(
+            "GET /{} HTTP/1.0\r\n\r\n".format(size).encode("ascii"))
+
+    def readResponse(self):
+        """
+        Returns the body of the response, which is read until the server
+        closes the connection.
+        """
+        chunks = []
+        while True:
+            chunk = self._socket.recv(65536)
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+        self._socket.close()
+        return b"".join(chunks).split(b"\r\n\r\n", 1)[1]
+
+
+class TestBufferedResponses(unittest.TestCase):
+    """
+    Tests a ThreadPoolWSGIServer sending responses from a ResponseWriter.
+    """
+    # Larger than the socket buffers, so that the writer sends a response
+    # over many polls when the client reads it slowly.
+    responseSize = 16 * 1024 * 1024
+
+    def startServer(
+            self, app=simpleApp, numThreads=1, sendTimeout=60,
+            maxPendingBytes=64 * 1024 * 1024):
+        self._server = prefork.ThreadPoolWSGIServer("127.0.0.1", 0, app)
+        self._server.startThreads(
+            numThreads, bufferResponses=True, sendTimeout=sendTimeout,
+            maxPendingBytes=maxPendingBytes)
+        self._serverThread = threading.Thread(
+            target=self._server.serve_forever)
+        self._serverThread.daemon = True
+        self._serverThread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._serverThread.join()
+        self._server.stopThreads()
+        self._server.server_close()
+
+    def getClient(self, receiveBufferSize=None, timeout=10):
+        return ServerClient(
+            self._server.server_address, receiveBufferSize, timeout)
+
+    def testFullResponse(self):
+        self.startServer()
+        for size in [0, 10, self.responseSize]:
+            client = self.getClient()
+            client.sendRequest(size)
+            self.assertEqual(client.readResponse(), b"x" * size)
+
+    def testSlowReader(self):
+        self.startServer()
+        slowClient = self.getClient(receiveBufferSize=4096)
+        slowClient.sendRequest(self.responseSize)
+        # The only request thread is free to handle the next request
+        # while the slow client's response is being sent.
+        time.sleep(0.5)
+        client = self.getClient()
+        client.sendRequest(10)
+        self.assertEqual(client.readResponse(), b"x" * 10)
+        self.assertEqual(
+            slowClient.readResponse(), b"x" * self.responseSize)
+
+    def testSendTimeout(self):
+        self.startServer(sendTimeout=0.5)
+        stalledClient = self.getClient(receiveBufferSize=4096)
+        stalledClient.sendRequest(self.responseSize)
+        time.sleep(2.5)
+        response = stalledClient.readResponse()
+        self.assertLess(len(response), self.responseSize)
+        # The server still handles other requests.
+        client = self.getClient()
+        client.sendRequest(10)
+        self.assertEqual(client.readResponse(), b"x" * 10)
+
+    def testStreamedBodyReadAsSent(self):
+        numChunks = self.responseSize // StreamingApp.chunkSize
+        app = StreamingApp(numChunks)
+        self.startServer(app)
+        slowClient = self.getClient(receiveBufferSize=4096)
+        slowClient.sendRequest(0)
+        time.sleep(0.5)
+        # Only the chunks that fit in the socket buffers have been read
+        # from the application.
+        self.assertLess(app.numChunksRead, numChunks // 4)
+        self.assertEqual(
+            slowClient.readResponse(), b"x" * self.responseSize)
+        self.assertEqual(app.numChunksRead, numChunks)
+        self.assertTrue(app.closed)
+
+    def testAbandonedStreamedBodyClosed(self):
+        app = StreamingApp(self.responseSize // StreamingApp.chunkSize)
+        self.startServer(app, sendTimeout=0.5)
+        stalledClient = self.getClient(receiveBufferSize=4096)
+        stalledClient.sendRequest(0)
+        time.sleep(2.5)
+        self.assertTrue(app.closed)
+        self.assertLess(
+            len(stalledClient.readResponse()), self.responseSize)
+
+    def testMaxPendingBytes(self):
+        self.startServer(numThreads=2, maxPendingBytes=1024 * 1024)
+        slowClient = self.getClient(receiveBufferSize=4096)
+        slowClient.sendRequest(self.responseSize)
+        time.sleep(0.5)
+        # The response to this client waits until the slow client's
+        # response, which exceeds the limit, has been sent.
+        client = self.getClient(timeout=0.5)
+        client.sendRequest(10)
+        self.assertRaises(socket.timeout, client.readResponse)
+        client = self.getClient()
+        client.sendRequest(10)
+        self.assertEqual(
+            slowClient.readResponse(), b"x" * self.responseSize)
+        self.assertEqual(client.readResponse(), b"x" * 10)
+
+
+class TestPreforkServer(unittest.TestCase):
+    """
+    Tests serving requests from forked workers.
+    """
+    def setUp(self):
+        server = prefork.PreforkServer(
+            pidApp, "127.0.0.1", 0, numWorkers=1, maxRequests=1)
+        self._address = server.getServerAddress()
+        self._masterPid = os.fork()
+        if self._masterPid == 0:
+            exitCode = 0
+            try:
+                server.serveForever()
+            except Exception:
+                exitCode = 1
+            finally:
+                os._exit(exitCode)
+
+    def tearDown(self):
+        os.kill(self._masterPid, signal.SIGTERM)
+        _, status = os.waitpid(self._masterPid, 0)
+        self.assertTrue(os.WIFEXITED(status))
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+    def getWorkerPid(self):
+        client = ServerClient(self._address)
+        client.sendRequest(0)
+        return int(client.readResponse())
+
+    def testWorkersRecycled(self):
+        workerPids = [self.getWorkerPid() for _ in range(3)]
+        self.assertNotIn(self._masterPid, workerPids)
+        self.assertNotIn(os.getpid(), workerPids)
+        # Each worker exits after its request and is replaced.
+        self.assertEqual(len(set(workerPids)), 3)
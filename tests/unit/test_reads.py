@@ -8,6 +8,7 @@ from __future__ import unicode_literals
 
 import unittest
 
+import ga4gh.datamodel as datamodel
 import ga4gh.datamodel.reads as reads
 import ga4gh.protocol as protocol
 
@@ -247,3 +248,134 @@ class TestSamFlags(unittest.TestCase):
             self.flag, reads.SamFlags.FIRST_IN_PAIR))
         self.assertTrue(reads.SamFlags.isFlagSet(
             self.flag, reads.SamFlags.FAILED_QUALITY_CHECK))
+
+
+class FakeSamFile(object):
+    """
+    A stand-in for a pysam AlignmentFile.
+    """
+    references = ("chr1", "chr2")
+
+
+class FakeRead(object):
+    """
+    A stand-in for a pysam AlignedSegment.
+    """
+    def __init__(self, flag):
+        self.flag = flag
+        self.query_qualities = [30, 31, 32]
+        self.query_sequence = "ACG"
+        self.mapping_quality = 60
+        self.reference_id = 1
+        self.reference_start = 100
+        self.cigar = [(4, 1), (0, 2)]
+        self.template_length = 250
+        self.query_name = "read1"
+        self.tags = [("RG", "rg1"), ("NM", 0)]
+        self.next_reference_id = 0
+        self.next_reference_start = 300
+
+
+class FakeReadGroupSet(object):
+    """
+    A stand-in for a read group set.
+    """
+    def getCompoundId(self):
+        return datamodel.ReadGroupSetCompoundId(
+            datamodel.DatasetCompoundId(None, "dataset"), "readGroupSet")
+
+
+class TestReadAlignmentConverter(unittest.TestCase):
+    """
+    Tests the conversion of pysam reads into GA4GH ReadAlignments.
+    """
+    def setUp(self):
+        self.converter = reads.ReadAlignmentConverter(
+            FakeSamFile(), FakeReadGroupSet())
+
+    def testMappedRead(self):
+        flag = (
+            reads.SamFlags.READ_PAIRED | reads.SamFlags.READ_PROPER_PAIR |
+            reads.SamFlags.READ_REVERSE_STRAND |
+            reads.SamFlags.FIRST_IN_PAIR | reads.SamFlags.DUPLICATE_READ)
+        alignment = self.converter.convert(FakeRead(flag), "readGroupId")
+        position = alignment.alignment.position
+        self.assertEqual(position.reference_name, "chr2")
+        self.assertEqual(position.position, 100)
+        self.assertEqual(position.strand, protocol.NEG_STRAND)
+        self.assertEqual(alignment.alignment.mapping_quality, 60)
+        self.assertEqual(
+            [(unit.operation, unit.operation_length)
+             for unit in alignment.alignment.cigar],
+            [(protocol.CigarUnit.CLIP_SOFT, 1),
+             (protocol.CigarUnit.ALIGNMENT_MATCH, 2)])
+        self.assertEqual(list(alignment.aligned_quality), [30, 31, 32])
+        self.assertEqual(alignment.next_mate_position.reference_name, "chr1")
+        self.assertEqual(alignment.next_mate_position.position, 300)
+        self.assertEqual(
+            alignment.next_mate_position.strand, protocol.POS_STRAND)
+        self.assertEqual(alignment.info["NM"].values[0].string_value, "0")
+        self.assertTrue(alignment.duplicate_fragment)
+        self.assertFalse(alignment.improper_placement)
+        self.assertFalse(alignment.secondary_alignment)
+        self.assertEqual(alignment.number_reads, 2)
+        self.assertEqual(alignment.read_number, 0)
+        self.assertEqual(alignment.read_group_id, "readGroupId")
+        self.assertEqual(alignment.id, str(datamodel.ReadAlignmentCompoundId(
+            FakeReadGroupSet().getCompoundId(), "read1")))
+
+    def testUnmappedRead(self):
+        flag = reads.SamFlags.READ_UNMAPPED | reads.SamFlags.MATE_UNMAPPED
+        alignment = self.converter.convert(FakeRead(flag), "readGroupId")
+        self.assertFalse(alignment.HasField("alignment"))
+        self.assertEqual(alignment.next_mate_position.ByteSize(), 0)
+        self.assertTrue(alignment.improper_placement)
+        self.assertEqual(alignment.number_reads, 1)
+        self.assertEqual(alignment.read_number, -1)
+
+    def testReadNumbers(self):
+        first = reads.SamFlags.FIRST_IN_PAIR
+        second = reads.SamFlags.SECOND_IN_PAIR
+        for flag, readNumber in [
+                (0, -1), (first, 0), (second, 1), (first | second, 2)]:
+            alignment = self.converter.convert(FakeRead(flag), "id")
+            self.assertEqual(alignment.read_number, readNumber)
+
+    def testFieldMask(self):
+        fieldMask = protocol.FieldMask(["id", "aligned_sequence"])
+        flag = reads.SamFlags.READ_PAIRED | reads.SamFlags.FIRST_IN_PAIR
+        alignment = self.converter.convert(
+            FakeRead(flag), "readGroupId", fieldMask)
+        expected = self.converter.convert(FakeRead(flag), "readGroupId")
+        self.assertEqual(alignment, protocol.ReadAlignment(
+            id=expected.id, aligned_sequence=expected.aligned_sequence))
+
+
+class TestAlignmentDataMixin(unittest.TestCase):
+    """
+    Tests the handling of pysam reads shared by alignment files.
+    """
+    def setUp(self):
+        self.alignmentData = reads.AlignmentDataMixin()
+
+    def testPysamReadStart(self):
+        flags = reads.SamFlags
+        for flag, start in [
+                (0, 100), (flags.READ_UNMAPPED, 300),
+                (flags.READ_UNMAPPED | flags.MATE_UNMAPPED, 0)]:
+            self.assertEqual(
+                self.alignmentData._getPysamReadStart(FakeRead(flag)),
+                start)
+
+    def testConverterReused(self):
+        converter = self.alignmentData._getReadAlignmentConverter(
+            FakeSamFile(), FakeReadGroupSet())
+        self.assertIs(
+            self.alignmentData._getReadAlignmentConverter(
+                FakeSamFile(), FakeReadGroupSet()),
+            converter)
+        # No file is opened to convert a read once the converter exists.
+        alignment = self.alignmentData.convertReadAlignment(
+            FakeRead(0), FakeReadGroupSet(), "readGroupId")
+        self.assertEqual(
+            alignment, converter.convert(FakeRead(0), "readGroupId"))
@@ -6,6 +6,10 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import random
+import shutil
+import tempfile
 import unittest
 
 import ga4gh.backend as backend
@@ -91,3 +95,52 @@ class TestAbstractReference(unittest.TestCase):
             self.assertRaises(
                 exceptions.ReferenceRangeErrorException,
                 self._reference.checkQueryRange, badRange[0], badRange[1])
+
+
+class TestMmapFastaFile(unittest.TestCase):
+    """
+    Tests reading bases from an uncompressed FASTA file via its faidx index.
+    """
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp(prefix="ga4gh_mmap_fasta",
+                                         dir=tempfile.gettempdir())
+        self._dataFile = os.path.join(self._tempdir, "test.fa")
+        randomNumberGenerator = random.Random(1)
+        self._sequences = {}
+        lineBases = 60
+        with open(self._dataFile, "w") as fastaFile, \
+                open(self._dataFile + ".fai", "w") as indexFile:
+            for name, length in [("seq1", 1000), ("seq2", 120)]:
+                sequence = "".join(
+                    randomNumberGenerator.choice("ACGT")
+                    for _ in range(length))
+                self._sequences[name] = sequence
+                fastaFile.write(">{}\n".format(name))
+                indexFile.write("{}\t{}\t{}\t{}\t{}\n".format(
+                    name, length, fastaFile.tell(), lineBases,
+                    lineBases + 1))
+                for i in range(0, length, lineBases):
+                    fastaFile.write(sequence[i:i + lineBases] + "\n")
+
+    def tearDown(self):
+        shutil.rmtree(self._tempdir)
+
+    def testFetch(self):
+        self.assertTrue(references.MmapFastaFile.isSupported(self._dataFile))
+        fastaFile = references.MmapFastaFile(self._dataFile)
+        for name, sequence in self._sequences.items():
+            length = len(sequence)
+            for start, end in [
+                    (0, length), (0, 1), (59, 61), (60, 120),
+                    (length - 1, length)]:
+                self.assertEqual(
+                    fastaFile.fetch(name.encode(), start, end),
+                    sequence[start:end])
+        fastaFile.close()
+
+    def testCompressedNotSupported(self):
+        with open(self._dataFile, "wb") as fastaFile:
+            fastaFile.write(b"\x1f\x8b")
+        self.assertFalse(references.MmapFastaFile.isSupported(self._dataFile))
+        os.remove(self._dataFile + ".fai")
+        self.assertFalse(references.MmapFastaFile.isSupported(self._dataFile))
@@ -35,6 +35,38 @@ class SearchResponseBuilderTest(unittest.TestCase):
                 builder.getSerializedResponse(), class_)
             self.assertEqual(instance, otherInstance)
 
+    def testIntegrityProtobuf(self):
+        for class_ in [responseClass for _, _, responseClass in
+                       protocol.postMethods]:
+            instance = class_()
+            valueList = getattr(instance, getValueListName(class_))
+            valueList.add()
+            valueList.add()
+            instance.next_page_token = "token"
+            builder = protocol.SearchResponseBuilder(
+                class_, len(valueList), 2 ** 32, protocol.PROTOBUF_MIMETYPE)
+            for value in valueList:
+                builder.addValue(value)
+            builder.setNextPageToken(instance.next_page_token)
+            otherInstance = protocol.deserialize(
+                builder.getSerializedResponse(), class_,
+                protocol.PROTOBUF_MIMETYPE)
+            self.assertEqual(instance, otherInstance)
+
+    def testEncodeVarint(self):
+        self.assertEqual(protocol.encodeVarint(0), b"\x00")
+        self.assertEqual(protocol.encodeVarint(1), b"\x01")
+        self.assertEqual(protocol.encodeVarint(127), b"\x7f")
+        self.assertEqual(protocol.encodeVarint(300), b"\xac\x02")
+
+    def testDecodeVarint(self):
+        for value in [0, 1, 127, 128, 300, 2**32, 2**63]:
+            data = b"\xff" + protocol.encodeVarint(value)
+            self.assertEqual(
+                protocol.decodeVarint(data, 1), (value, len(data)))
+        self.assertRaises(
+            protocol.message.DecodeError, protocol.decodeVarint, b"\x80")
+
     def testPageSizeOverflow(self):
         # Verifies that the page size behaviour is correct when we keep
         # filling after full is True.
@@ -78,7 +110,7 @@ class SearchResponseBuilderTest(unittest.TestCase):
         typicalValue.start = 1
         typicalValue.end = 2
         typicalValue.reference_bases = "AAAAAAAA"
-        typicalValueLength = typicalValue.ByteSize()
+        typicalValueLength = len(protocol.toJson(typicalValue))
         for numValues in range(1, 10):
             maxBufferSize = numValues * typicalValueLength
             builder = protocol.SearchResponseBuilder(
@@ -108,3 +140,95 @@ class SearchResponseBuilderTest(unittest.TestCase):
             instance = protocol.fromJson(builder.getSerializedResponse(),
                                          responseClass)
             self.assertEqual(nextPageToken, instance.next_page_token)
+
+    def testSerializedResponseChunks(self):
+        responseClass = protocol.SearchVariantsResponse
+        value = protocol.Variant()
+        value.reference_bases = "A" * 100
+        for chunkSize in [1, 10, 1000, 2 ** 16]:
+            builder = protocol.SearchResponseBuilder(
+                responseClass, 100, 2 ** 32)
+            for _ in range(20):
+                builder.addValue(value)
+            builder.setNextPageToken("token")
+            chunks = list(builder.getSerializedResponseChunks(chunkSize))
+            self.assertEqual(
+                "".join(chunks), builder.getSerializedResponse())
+            if chunkSize >= 2 ** 16:
+                self.assertEqual(len(chunks), 1)
+            instance = protocol.fromJson(
+                builder.getSerializedResponse(), responseClass)
+            self.assertEqual(len(instance.variants), 20)
+            self.assertEqual(instance.next_page_token, "token")
+
+
+class BatchRequestTest(unittest.TestCase):
+    """
+    Tests the deserialisation of batches of search requests.
+    """
+    def testJsonBatch(self):
+        requests = protocol.deserializeBatchRequest(
+            '{"requests": [{"variantSetId": "a", "start": 3}, {}]}',
+            protocol.SearchVariantsRequest)
+        self.assertEqual(requests, [
+            protocol.SearchVariantsRequest(variant_set_id="a", start=3),
+            protocol.SearchVariantsRequest()])
+        for data in [
+                '[]', '{"requests": {}}', '{"requests": [1]}',
+                '{"requests": [{"notAField": 1}]}']:
+            self.assertRaises(
+                ValueError, protocol.deserializeBatchRequest, data,
+                protocol.SearchVariantsRequest)
+
+    def testProtobufBatch(self):
+        requests = [
+            protocol.SearchReadsRequest(reference_id="a", start=j)
+            for j in range(3)]
+        data = b"".join(
+            protocol.encodeLengthDelimitedField(1, r.SerializeToString())
+            for r in requests)
+        self.assertEqual(
+            protocol.deserializeBatchRequest(
+                data, protocol.SearchReadsRequest,
+                protocol.PROTOBUF_MIMETYPE),
+            requests)
+        self.assertRaises(
+            protocol.message.DecodeError, protocol.deserializeBatchRequest,
+            data[:-1], protocol.SearchReadsRequest,
+            protocol.PROTOBUF_MIMETYPE)
+
+
+class FieldMaskTest(unittest.TestCase):
+    """
+    Tests the FieldMask class used for partial responses.
+    """
+    def testParse(self):
+        descriptor = protocol.ReadAlignment.DESCRIPTOR
+        fieldMask = protocol.FieldMask.parse(
+            descriptor, "id, alignedSequence,read_group_id")
+        for fieldName in ["id", "aligned_sequence", "read_group_id"]:
+            self.assertTrue(fieldMask.includes(fieldName))
+        self.assertFalse(fieldMask.includes("aligned_quality"))
+        for fields in ["", "id,notAField", "AlignedSequence"]:
+            self.assertRaises(
+                ValueError, protocol.FieldMask.parse, descriptor, fields)
+
+    def testAllFields(self):
+        self.assertTrue(protocol.ALL_FIELDS.includes("anything"))
+        self.assertIs(
+            protocol.ALL_FIELDS.union(["id"]), protocol.ALL_FIELDS)
+        variant = protocol.Variant(id="id", start=1)
+        self.assertEqual(
+            protocol.ALL_FIELDS.apply(variant),
+            protocol.Variant(id="id", start=1))
+
+    def testApply(self):
+        fieldMask = protocol.FieldMask(["id"])
+        variant = protocol.Variant(id="id", start=1, end=2)
+        variant.calls.add().call_set_id = "callSetId"
+        self.assertEqual(fieldMask.apply(variant), protocol.Variant(id="id"))
+        fieldMask = fieldMask.union(["start"])
+        self.assertTrue(fieldMask.includes("start"))
+        variant = protocol.Variant(id="id", start=1, end=2)
+        self.assertEqual(
+            fieldMask.apply(variant), protocol.Variant(id="id", start=1))
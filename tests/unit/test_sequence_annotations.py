@@ -7,10 +7,16 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
 import unittest
 
 import ga4gh.datamodel.sequenceAnnotations as features
 import ga4gh.datamodel.datasets as datasets
+import ga4gh.sqliteBackend as sqliteBackend
 
 
 class TestAbstractFeatureSet(unittest.TestCase):
@@ -26,3 +32,111 @@ class TestAbstractFeatureSet(unittest.TestCase):
     def testGetFeatureIdFailsWithNullInput(self):
         self.assertEqual("",
                          self._featureSet.getCompoundIdForFeatureId(None))
+
+
+class TestFeatureBins(unittest.TestCase):
+    """
+    Tests the UCSC binning of feature intervals.
+    """
+    def testGetBin(self):
+        self.assertEqual(sqliteBackend.getBin(0, 1), 585)
+        self.assertEqual(sqliteBackend.getBin(0, 2**17), 585)
+        self.assertEqual(sqliteBackend.getBin(0, 2**17 + 1), 73)
+        self.assertEqual(sqliteBackend.getBin(2**17, 2**17), 586)
+        self.assertEqual(sqliteBackend.getBin(0, 2**29), 0)
+        self.assertEqual(sqliteBackend.getBin(2**29, 2**30), 0)
+
+    def testBinRangesContainOverlappingBins(self):
+        randomNumberGenerator = random.Random(1)
+        for _ in range(1000):
+            start = randomNumberGenerator.randint(0, 2**28)
+            end = start + randomNumberGenerator.randint(0, 2**24)
+            featureBin = sqliteBackend.getBin(start, end)
+            queryStart = randomNumberGenerator.randint(
+                max(0, start - 2**20), end)
+            queryEnd = queryStart + randomNumberGenerator.randint(1, 2**20)
+            if queryStart >= max(end, start + 1) or queryEnd <= start:
+                continue
+            ranges = sqliteBackend.getBinRanges(queryStart, queryEnd)
+            self.assertTrue(any(
+                first <= featureBin <= last for first, last in ranges))
+
+
+class TestGff3DbBackend(unittest.TestCase):
+    """
+    Tests that feature range queries return the same features whether
+    or not the database has bins.
+    """
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp(prefix="ga4gh_gff3_db",
+                                         dir=tempfile.gettempdir())
+        randomNumberGenerator = random.Random(1)
+        rows = []
+        for featureId in range(2, 1000):
+            start = randomNumberGenerator.randint(0, 2**20)
+            end = start + randomNumberGenerator.randint(0, 2**18)
+            rows.append((
+                featureId, None, "[]",
+                randomNumberGenerator.choice(["chr1", "chr2"]), "",
+                randomNumberGenerator.choice(["gene", "exon"]),
+                start, end, 0, "+", "", "", "", "{}",
+                sqliteBackend.getBin(start, end)))
+        self._binnedDbFile = self._createDb("binned.db", rows, True)
+        self._unbinnedDbFile = self._createDb("unbinned.db", rows, False)
+
+    def tearDown(self):
+        sqliteBackend.connectionPool.closeAll()
+        shutil.rmtree(self._tempdir)
+
+    def _createDb(self, fileName, rows, binned):
+        dbFile = os.path.join(self._tempdir, fileName)
+        columns = features._featureColumns
+        if not binned:
+            columns = [column for column in columns if column[0] != "bin"]
+            rows = [row[:-1] for row in rows]
+        dbconn = sqlite3.connect(dbFile)
+        dbconn.execute("CREATE TABLE FEATURE ({})".format(", ".join(
+            "{} {}".format(name, type_) for name, type_ in columns)))
+        dbconn.executemany("INSERT INTO FEATURE VALUES ({})".format(
+            ", ".join(["?"] * len(columns))), rows)
+        if binned:
+            dbconn.execute(
+                "CREATE INDEX feature_bin "
+                "ON FEATURE(reference_name, bin, start, end)")
+        dbconn.commit()
+        dbconn.close()
+        return dbFile
+
+    def _searchFeatures(self, dbFile, **kwargs):
+        with features.Gff3DbBackend(dbFile) as dataSource:
+            return [
+                feature["id"] for feature in
+                dataSource.searchFeaturesInDb(**kwargs)]
+
+    def testRangeQueries(self):
+        for start, end in [(0, 1), (1000, 2**17), (2**19, 2**21), (0, 2**32)]:
+            kwargs = {"referenceName": "chr1", "start": start, "end": end}
+            binnedIds = self._searchFeatures(self._binnedDbFile, **kwargs)
+            unbinnedIds = self._searchFeatures(self._unbinnedDbFile, **kwargs)
+            self.assertEqual(binnedIds, unbinnedIds)
+
+    def testPagedRangeQuery(self):
+        kwargs = {"referenceName": "chr2", "start": 2**19, "end": 2**20}
+        allIds = self._searchFeatures(self._binnedDbFile, **kwargs)
+        pagedIds = []
+        pageToken = None
+        with features.Gff3DbBackend(self._binnedDbFile) as dataSource:
+            while True:
+                page = dataSource.searchFeaturesInDb(
+                    pageToken, 10, **kwargs)
+                pagedIds.extend(feature["id"] for feature in page)
+                if len(page) < 10:
+                    break
+                pageToken = features.getFeaturePageToken(page[-1])
+        self.assertEqual(pagedIds, allIds)
+
+    def testIsBinned(self):
+        with features.Gff3DbBackend(self._binnedDbFile) as dataSource:
+            self.assertTrue(dataSource.isBinned())
+        with features.Gff3DbBackend(self._unbinnedDbFile) as dataSource:
+            self.assertFalse(dataSource.isBinned())
@@ -0,0 +1,97 @@
+"""
+Tests the SQLite connection pool
+"""
+
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import ga4gh.sqliteBackend as sqliteBackend
+
+
+class TestSqliteConnectionPool(unittest.TestCase):
+    """
+    Tests the pooling, configuration and eviction of connections.
+    """
+    def setUp(self):
+        self._tempdir = tempfile.mkdtemp(prefix="ga4gh_sqlite_pool",
+                                         dir=tempfile.gettempdir())
+        self._dbFiles = []
+        for i in range(3):
+            dbFile = os.path.join(self._tempdir, "db{}.sqlite".format(i))
+            dbconn = sqlite3.connect(dbFile)
+            dbconn.execute("CREATE TABLE test (id INTEGER, name TEXT)")
+            dbconn.execute("INSERT INTO test VALUES (?, ?)", (i, "x"))
+            dbconn.commit()
+            dbconn.close()
+            self._dbFiles.append(dbFile)
+        self._pool = sqliteBackend.SqliteConnectionPool(2)
+
+    def tearDown(self):
+        self._pool.closeAll()
+        shutil.rmtree(self._tempdir)
+
+    def testConnectionReused(self):
+        dbFile = self._dbFiles[0]
+        dbconn = self._pool.acquire(dbFile)
+        self.assertEqual(self._pool.getNumIdleConnections(), 0)
+        self._pool.release(dbFile, dbconn)
+        self.assertEqual(self._pool.getNumIdleConnections(), 1)
+        self.assertIs(self._pool.acquire(dbFile), dbconn)
+        self.assertIsNot(self._pool.acquire(dbFile), dbconn)
+
+    def testConnectionsReadOnly(self):
+        dbconn = self._pool.acquire(self._dbFiles[0])
+        row = dbconn.execute("SELECT * FROM test").fetchone()
+        self.assertEqual(row[0], 0)
+        self.assertRaises(
+            sqlite3.OperationalError, dbconn.execute,
+            "INSERT INTO test VALUES (1, 'y')")
+        self.assertEqual(
+            dbconn.execute("PRAGMA query_only").fetchone()[0], 1)
+
+    def testLeastRecentlyUsedEvicted(self):
+        connections = [self._pool.acquire(f) for f in self._dbFiles]
+        for dbFile, dbconn in zip(self._dbFiles, connections):
+            self._pool.release(dbFile, dbconn)
+        self.assertEqual(self._pool.getNumIdleConnections(), 2)
+        # The connection to the first file was closed on eviction
+        self.assertRaises(
+            sqlite3.ProgrammingError, connections[0].execute, "SELECT 1")
+        self.assertIsNot(self._pool.acquire(self._dbFiles[0]), connections[0])
+        self.assertIs(self._pool.acquire(self._dbFiles[2]), connections[2])
+
+    def testSetMaxPoolSize(self):
+        self.assertRaises(ValueError, self._pool.setMaxPoolSize, -1)
+        for dbFile in self._dbFiles[:2]:
+            self._pool.release(dbFile, self._pool.acquire(dbFile))
+        self._pool.setMaxPoolSize(0)
+        self.assertEqual(self._pool.getNumIdleConnections(), 0)
+        dbFile = self._dbFiles[0]
+        self._pool.release(dbFile, self._pool.acquire(dbFile))
+        self.assertEqual(self._pool.getNumIdleConnections(), 0)
+
+    def testDataSourceConnectionPerThread(self):
+        dataSource = sqliteBackend.SqliteBackedDataSource(
+            self._dbFiles[0], self._pool)
+        otherConnections = []
+
+        def enterDataSource():
+            with dataSource:
+                otherConnections.append(dataSource._dbconn)
+
+        with dataSource:
+            dbconn = dataSource._dbconn
+            thread = threading.Thread(target=enterDataSource)
+            thread.start()
+            thread.join()
+            self.assertIs(dataSource._dbconn, dbconn)
+        self.assertIsNot(otherConnections[0], dbconn)
+        self.assertEqual(self._pool.getNumIdleConnections(), 2)
@@ -6,6 +6,7 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import math
 import unittest
 
 import ga4gh.exceptions as exceptions
@@ -81,3 +82,51 @@ class TestAbstractVariantSet(unittest.TestCase):
     def testVariantSetProtocolElement(self):
         self.assertRaises(AttributeError,
                           self._variantSet.toProtocolElement)
+
+
+class TestGenotypeMatrix(unittest.TestCase):
+    """
+    Unit tests for filling genotype matrices.
+    """
+    def testAddVariants(self):
+        matrix = variants.GenotypeMatrix(["a", "b"])
+        matrix.addVariant(0, 1, [[0, 1], None])
+        matrix.addVariant(5, 6, [[1], [0, 1, 1]])
+        self.assertEqual(matrix.getStarts(), [0, 5])
+        self.assertEqual(matrix.getEnds(), [1, 6])
+        self.assertEqual(matrix.getPloidy(), 3)
+        self.assertEqual(matrix.getGenotypes().typecode, "b")
+        # The first row is widened when the second has a higher ploidy
+        self.assertEqual(
+            list(matrix.getGenotypes()),
+            [0, 1, -1, -1, -1, -1, 1, -1, -1, 0, 1, 1])
+        self.assertFalse(matrix.hasGenotypeLikelihoods())
+        self.assertIsNone(matrix.getGenotypeLikelihoods())
+
+    def testManyAlleles(self):
+        matrix = variants.GenotypeMatrix(["a"])
+        matrix.addVariant(0, 1, [[0, 1]])
+        matrix.addVariant(1, 2, [[200, None]])
+        self.assertEqual(matrix.getGenotypes().typecode, "h")
+        self.assertEqual(list(matrix.getGenotypes()), [0, 1, 200, -1])
+
+    def testGenotypeLikelihoods(self):
+        matrix = variants.GenotypeMatrix(["a", "b"], includeLikelihoods=True)
+        matrix.addVariant(0, 1, [[0], [1]], [[-0.5, -1], None])
+        matrix.addVariant(1, 2, [[0], [1]])
+        self.assertTrue(matrix.hasGenotypeLikelihoods())
+        self.assertEqual(matrix.getNumLikelihoods(), 2)
+        likelihoods = matrix.getGenotypeLikelihoods()
+        self.assertEqual(len(likelihoods), 8)
+        self.assertEqual(list(likelihoods[:2]), [-0.5, -1])
+        self.assertTrue(all(math.isnan(value) for value in likelihoods[2:]))
+
+    def testMaxCells(self):
+        matrix = variants.GenotypeMatrix(["a", "b"], maxCells=4)
+        matrix.addVariant(0, 1, [[0], [1]])
+        matrix.addVariant(1, 2, [[0], [1]])
+        self.assertRaises(
+            exceptions.GenotypeMatrixTooLargeException,
+            matrix.addVariant, 2, 3, [[0], [1]])
+        self.assertEqual(matrix.getStarts(), [0, 1])
+        self.assertEqual(len(matrix.getGenotypes()), 4)
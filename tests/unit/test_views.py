@@ -5,13 +5,17 @@ from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import io
 import unittest
+import json
 import logging
+import zipfile
 
 import tests.paths as paths
 
 import ga4gh.datamodel as datamodel
 import ga4gh.frontend as frontend
+import ga4gh.npy as npy
 import ga4gh.protocol as protocol
 
 
@@ -296,6 +300,158 @@ class TestFrontend(unittest.TestCase):
             response.data, protocol.SearchVariantsResponse)
         self.assertEqual(len(responseData.variants), 1)
 
+    def testVariantsSearchProtobuf(self):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSetId
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 1
+        headers = {
+            'Content-type': protocol.PROTOBUF_MIMETYPE,
+            'Origin': self.exampleUrl,
+        }
+        response = self.app.post(
+            '/variants/search', headers=headers,
+            data=request.SerializeToString())
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.mimetype, protocol.PROTOBUF_MIMETYPE)
+        responseData = protocol.SearchVariantsResponse()
+        responseData.ParseFromString(response.data)
+        self.assertEqual(len(responseData.variants), 1)
+        # A JSON request can ask for a binary response and vice versa.
+        headers['Content-type'] = protocol.MIMETYPE
+        headers['Accept'] = protocol.PROTOBUF_MIMETYPE
+        response = self.app.post(
+            '/variants/search', headers=headers,
+            data=protocol.toJson(request))
+        self.assertEqual(response.mimetype, protocol.PROTOBUF_MIMETYPE)
+        otherResponseData = protocol.SearchVariantsResponse()
+        otherResponseData.ParseFromString(response.data)
+        self.assertEqual(responseData, otherResponseData)
+
+    def testGenotypeMatrix(self):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSetId
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 10
+        headers = {
+            'Content-type': 'application/json',
+            'Origin': self.exampleUrl,
+        }
+        for path, arrayNames in [
+                ('/variants/genotypematrix',
+                    ["call_set_ids", "end", "genotype", "start"]),
+                ('/variants/genotypematrix?includeLikelihoods=true',
+                    ["call_set_ids", "end", "genotype",
+                     "genotype_likelihood", "start"])]:
+            response = self.app.post(
+                path, headers=headers, data=protocol.toJson(request))
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(response.mimetype, npy.MIMETYPE)
+            archive = zipfile.ZipFile(io.BytesIO(response.data))
+            self.assertEqual(
+                sorted(archive.namelist()),
+                [name + ".npy" for name in arrayNames])
+        request.call_set_ids.append("not a call set")
+        response = self.app.post(
+            '/variants/genotypematrix', headers=headers,
+            data=protocol.toJson(request))
+        self.assertEqual(404, response.status_code)
+
+    def testVariantsBatchSearch(self):
+        requests = []
+        for start, end in [(5, 10), (0, 3), (5, 10)]:
+            request = protocol.SearchVariantsRequest()
+            request.variant_set_id = self.variantSetId
+            request.reference_name = "1"
+            request.start = start
+            request.end = end
+            request.page_size = 2
+            requests.append(request)
+        headers = {
+            'Content-type': 'application/json',
+            'Origin': self.exampleUrl,
+        }
+        data = json.dumps({
+            "requests": [protocol.toJsonDict(r) for r in requests]})
+        response = self.app.post(
+            '/variants/batchsearch', headers=headers, data=data)
+        self.assertEqual(200, response.status_code)
+        responses = json.loads(response.data)["responses"]
+        self.assertEqual(len(responses), len(requests))
+        for request, batchResponse in zip(requests, responses):
+            singleResponse = protocol.fromJson(
+                self.sendPostRequest('/variants/search', request).data,
+                protocol.SearchVariantsResponse)
+            batchResponse = protocol.fromJson(
+                json.dumps(batchResponse), protocol.SearchVariantsResponse)
+            self.assertEqual(
+                [v.id for v in batchResponse.variants],
+                [v.id for v in singleResponse.variants])
+            self.assertEqual(
+                batchResponse.next_page_token == "",
+                singleResponse.next_page_token == "")
+        # The same batch in the protobuf wire format
+        headers['Content-type'] = protocol.PROTOBUF_MIMETYPE
+        data = b"".join(
+            protocol.encodeLengthDelimitedField(1, r.SerializeToString())
+            for r in requests)
+        response = self.app.post(
+            '/variants/batchsearch', headers=headers, data=data)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.mimetype, protocol.PROTOBUF_MIMETYPE)
+        batchResponses = protocol.deserializeBatchRequest(
+            response.data, protocol.SearchVariantsResponse,
+            protocol.PROTOBUF_MIMETYPE)
+        self.assertEqual(len(batchResponses), len(requests))
+        self.assertEqual(batchResponses[0], batchResponses[2])
+        # Malformed batches are rejected
+        for data in ['{"requests": {}}', '{"requests": [1]}']:
+            response = self.app.post(
+                '/variants/batchsearch', data=data,
+                headers={'Content-type': 'application/json'})
+            self.assertEqual(400, response.status_code)
+        # So are batches of more than MAX_BATCH_SEARCH_REQUESTS
+        data = json.dumps({"requests": [
+            protocol.toJsonDict(requests[0])
+            for _ in range(frontend.app.config[
+                "MAX_BATCH_SEARCH_REQUESTS"] + 1)]})
+        response = self.app.post(
+            '/variants/batchsearch', data=data,
+            headers={'Content-type': 'application/json'})
+        self.assertEqual(400, response.status_code)
+
+    def testGetReadGroupProtobuf(self):
+        headers = {'Accept': protocol.PROTOBUF_MIMETYPE}
+        response = self.app.get(
+            '/readgroups/{}'.format(self.readGroupId), headers=headers)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.mimetype, protocol.PROTOBUF_MIMETYPE)
+        readGroup = protocol.ReadGroup()
+        readGroup.ParseFromString(response.data)
+        self.assertEqual(readGroup.id, self.readGroupId)
+
+    def testReferenceBasesRaw(self):
+        path = "/references/{}/bases".format(self.referenceId)
+        bases = self.reference.getBases(0, self.reference.getLength())
+        response = self.app.get(path, headers={'Accept': 'text/plain'})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(response.mimetype, 'text/plain')
+        self.assertEqual(response.data, bases)
+        # A range is served as partial content
+        response = self.app.get(path, headers={'Range': 'bytes=10-19'})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(response.data, bases[10:20])
+        self.assertEqual(
+            response.headers['Content-Range'],
+            'bytes 10-19/{}'.format(len(bases)))
+        response = self.app.get(path, headers={'Range': 'bytes=-5'})
+        self.assertEqual(response.data, bases[-5:])
+        response = self.app.get(
+            path, headers={'Range': 'bytes={}-'.format(len(bases))})
+        self.assertEqual(416, response.status_code)
+
     def testVariantSetsSearch(self):
         response = self.sendVariantSetsSearch()
         self.assertEqual(200, response.status_code)
@@ -375,6 +531,31 @@ class TestFrontend(unittest.TestCase):
             responseData.alignments[0].id,
             self.readAlignmentId)
 
+    def testPartialResponses(self):
+        request = protocol.SearchVariantsRequest()
+        request.variant_set_id = self.variantSetId
+        request.reference_name = "1"
+        request.start = 0
+        request.end = 1
+        response = self.sendPostRequest(
+            '/variants/search?fields=id,referenceBases', request)
+        self.assertEqual(200, response.status_code)
+        responseData = protocol.fromJson(
+            response.data, protocol.SearchVariantsResponse)
+        self.assertEqual(len(responseData.variants), 1)
+        variant = responseData.variants[0]
+        self.assertEqual(variant.id, self.variantId)
+        self.assertNotEqual(variant.reference_bases, "")
+        self.assertEqual(len(variant.calls), 0)
+        self.assertEqual(variant.end, 0)
+        response = self.sendPostRequest(
+            '/variants/search?fields=id,notAField', request)
+        self.assertEqual(400, response.status_code)
+        response = self.sendPostRequest(
+            '/variantsets/search?fields=id',
+            protocol.SearchVariantSetsRequest(dataset_id=self.datasetId))
+        self.assertEqual(400, response.status_code)
+
     def testDatasetsSearch(self):
         response = self.sendDatasetsSearch()
         responseData = protocol.fromJson(